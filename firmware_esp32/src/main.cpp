@@ -14,9 +14,13 @@
 #define CMD_BEAT_SYNC 0x01
 #define CMD_FX_BLINK  0x03
 #define CMD_FX_STATIC 0x04
+#define CMD_BEAT_TIMED 0x05
+#define CMD_CLOCK_SYNC_REQUEST 0x10
+#define CMD_CLOCK_SYNC_REPLY   0x11
 
 IPAddress multicastAddress(239, 1, 1, 1);
 unsigned int multicastPort = 1234;
+unsigned int clockSyncPort = 1235;
 
 struct UdpPacket {
   byte command;
@@ -26,6 +30,27 @@ struct UdpPacket {
   uint32_t packet_id; 
 } __attribute__((packed));
 
+// Beat gửi trước: sáng lúc target_us theo đồng hồ server; server lặp lại cùng packet_id vài lần
+struct TimedPacket {
+  byte command;
+  byte r;
+  byte g;
+  byte b;
+  uint32_t packet_id;
+  uint32_t target_us;
+  byte repeat;
+  byte reserved[3];
+} __attribute__((packed));
+
+// Đồng bộ đồng hồ kiểu NTP: t0 (gậy gửi), t1 (server nhận), t2 (server trả), t3 (gậy nhận)
+struct ClockSyncPacket {
+  byte command;
+  byte reserved[3];
+  uint32_t t0;
+  uint32_t t1;
+  uint32_t t2;
+} __attribute__((packed));
+
 enum LightstickState {
   MODE_OFF,
   MODE_LOCAL, 
@@ -42,7 +67,38 @@ bool udpInitialized = false;
 unsigned long lastUdpPacketTime = 0;
 const unsigned long UDP_TIMEOUT = 6000;
 
+WiFiUDP clockUdp;
+IPAddress serverIP;
+bool haveServer = false;
+bool clockSynced = false;
+int32_t clockOffsetUs = 0; // server_us - local_us
+unsigned long lastClockSyncTime = 0;
+const unsigned long CLOCK_SYNC_INTERVAL = 1000;
+const unsigned long CLOCK_SYNC_RETRY_INTERVAL = 50; // chưa đồng bộ: hỏi dồn để kịp các bản lặp của beat đầu
+#define CLOCK_SAMPLES 8
+int32_t sampleOffsetUs[CLOCK_SAMPLES];
+uint32_t sampleRttUs[CLOCK_SAMPLES];
+int sampleCount = 0;
+int sampleNext = 0;
+
+#define PENDING_BEATS 16
+#define RECENT_IDS 32
+struct PendingBeat {
+  bool used;
+  uint32_t packet_id;
+  uint32_t fire_us;
+  byte r, g, b;
+};
+PendingBeat pendingBeats[PENDING_BEATS];
+// Server đang gửi beat hẹn giờ: keep-alive 8 byte màu đen chỉ giữ kết nối, không tắt màu beat
+bool timedMode = false;
+uint32_t recentIds[RECENT_IDS];
+int recentNext = 0;
+
 void disconnectServer();
+void resetClockSync();
+void clearPendingBeats();
+void applySyncColor(byte r, byte g, byte b);
 bool connectWiFi(); 
 void checkWiFiConnection();
 void resetWiFiAndGoToLocal();
@@ -80,6 +136,7 @@ bool connectWiFi() {
     if (udp.beginMulticast(multicastAddress, multicastPort)) {
         Serial.println("UDP Multicast listener started.");
         udpInitialized = true;
+        clockUdp.begin(clockSyncPort);
     } else {
         Serial.println("UDP listener FAILED.");
         udpInitialized = false;
@@ -104,6 +161,7 @@ bool startWiFiManagerPortal() {
         if (udp.beginMulticast(multicastAddress, multicastPort)) {
             Serial.println("UDP Multicast listener started.");
             udpInitialized = true;
+            clockUdp.begin(clockSyncPort);
         } else {
             Serial.println("UDP listener FAILED.");
             udpInitialized = false;
@@ -129,6 +187,7 @@ void checkWiFiConnection() {
           if (udp.beginMulticast(multicastAddress, multicastPort)) {
               Serial.println("UDP Multicast listener re-started.");
               udpInitialized = true;
+              clockUdp.begin(clockSyncPort);
           } else {
               Serial.println("UDP listener FAILED.");
               udpInitialized = false;
@@ -142,6 +201,8 @@ void checkWiFiConnection() {
       if (WiFi.status() != WL_CONNECTED) {
           Serial.println("WiFi connection lost! -> MODE_LOCAL");
           udp.stop();
+          clockUdp.stop();
+          resetClockSync();
           udpInitialized = false;
           currentState = MODE_LOCAL; 
           color_set_mode(MODE_STATIC_WHITE);
@@ -150,6 +211,99 @@ void checkWiFiConnection() {
   }
 }
 
+void clearPendingBeats() {
+  for (int i = 0; i < PENDING_BEATS; i++) pendingBeats[i].used = false;
+}
+
+void resetClockSync() {
+  haveServer = false;
+  clockSynced = false;
+  timedMode = false;
+  sampleCount = 0;
+  sampleNext = 0;
+  clearPendingBeats();
+}
+
+void applySyncColor(byte r, byte g, byte b) {
+  if (r == 0 && g == 0 && b == 0) {
+      color_set_sync_color(0);
+  } else {
+      color_set_sync_color(circleL.Color(r, g, b));
+  }
+}
+
+void sendClockSyncRequest() {
+  ClockSyncPacket req = {};
+  req.command = CMD_CLOCK_SYNC_REQUEST;
+  req.t0 = micros();
+  clockUdp.beginPacket(serverIP, clockSyncPort);
+  clockUdp.write((byte*)&req, sizeof(req));
+  clockUdp.endPacket();
+}
+
+void handleClockSyncReply() {
+  ClockSyncPacket rep;
+  clockUdp.read((byte*)&rep, sizeof(rep));
+  uint32_t t3 = micros();
+  if (rep.command != CMD_CLOCK_SYNC_REPLY) return;
+  uint32_t rtt = (t3 - rep.t0) - (rep.t2 - rep.t1);
+  // Cộng ở 64 bit: hai hiệu int32 cùng dấu có thể tràn khi lệch đồng hồ lớn (vd. lần đồng bộ đầu)
+  int32_t offset = (int32_t)(((int64_t)(int32_t)(rep.t1 - rep.t0) + (int64_t)(int32_t)(rep.t2 - t3)) / 2);
+  sampleOffsetUs[sampleNext] = offset;
+  sampleRttUs[sampleNext] = rtt;
+  sampleNext = (sampleNext + 1) % CLOCK_SAMPLES;
+  if (sampleCount < CLOCK_SAMPLES) sampleCount++;
+  // Mẫu có RTT nhỏ nhất trong cửa sổ gần đây ít bị hàng đợi Wi-Fi làm lệch nhất
+  int best = 0;
+  for (int i = 1; i < sampleCount; i++) {
+    if (sampleRttUs[i] < sampleRttUs[best]) best = i;
+  }
+  clockOffsetUs = sampleOffsetUs[best];
+  clockSynced = true;
+}
+
+bool seenRecently(uint32_t packet_id) {
+  for (int i = 0; i < RECENT_IDS; i++) {
+    if (recentIds[i] == packet_id) return true;
+  }
+  recentIds[recentNext] = packet_id;
+  recentNext = (recentNext + 1) % RECENT_IDS;
+  return false;
+}
+
+void scheduleTimedBeat(const TimedPacket& cmd) {
+  // Chỉ gọi khi đã đồng bộ đồng hồ (target_us theo đồng hồ server)
+  uint32_t fire_us = cmd.target_us - (uint32_t)clockOffsetUs;
+  if ((int32_t)(fire_us - micros()) <= 0) {
+    applySyncColor(cmd.r, cmd.g, cmd.b);
+    return;
+  }
+  int slot = -1;
+  for (int i = 0; i < PENDING_BEATS; i++) {
+    if (!pendingBeats[i].used) { slot = i; break; }
+  }
+  if (slot < 0) {
+    // Hết chỗ: bắn ngay beat sớm nhất để lấy chỗ
+    slot = 0;
+    for (int i = 1; i < PENDING_BEATS; i++) {
+      if ((int32_t)(pendingBeats[i].fire_us - pendingBeats[slot].fire_us) < 0) slot = i;
+    }
+    applySyncColor(pendingBeats[slot].r, pendingBeats[slot].g, pendingBeats[slot].b);
+  }
+  pendingBeats[slot] = { true, cmd.packet_id, fire_us, cmd.r, cmd.g, cmd.b };
+}
+
+void servicePendingBeats() {
+  uint32_t now = micros();
+  for (int i = 0; i < PENDING_BEATS; i++) {
+    if (pendingBeats[i].used && (int32_t)(now - pendingBeats[i].fire_us) >= 0) {
+      pendingBeats[i].used = false;
+      applySyncColor(pendingBeats[i].r, pendingBeats[i].g, pendingBeats[i].b);
+      Serial.printf("LOG,FIRE,%u,%lu\n", pendingBeats[i].packet_id, millis());
+    }
+  }
+}
+
 void loop() {
   input_scan(); 
   checkWiFiConnection(); 
@@ -163,24 +317,59 @@ void loop() {
           Serial.printf("LOG,RECV,%u,%u,%u,%u,%u,%lu\n", 
               cmd.packet_id, cmd.command, cmd.r, cmd.g, cmd.b, recv_time_ms);
           lastUdpPacketTime = recv_time_ms;
+          serverIP = udp.remoteIP();
+          haveServer = true;
+          if (currentState != MODE_SYNC) {
+              currentState = MODE_SYNC;
+          }
+          bool keepAlive = cmd.command == CMD_BEAT_SYNC && cmd.r == 0 && cmd.g == 0 && cmd.b == 0;
+          if (!keepAlive) {
+              // Gói 8 byte có màu: server đã về chế độ thường, bỏ các beat hẹn giờ còn chờ để không đè màu mới
+              timedMode = false;
+              clearPendingBeats();
+          }
+          // Chế độ hẹn giờ: keep-alive chỉ làm mới lastUdpPacketTime, không tắt màu beat đang sáng/sắp sáng
+          if ((cmd.command == CMD_BEAT_SYNC || cmd.command == CMD_FX_STATIC || cmd.command == CMD_FX_BLINK) && !(keepAlive && timedMode)) {
+              applySyncColor(cmd.r, cmd.g, cmd.b);
+          }
+      } else if (packetSize == sizeof(TimedPacket)) {
+          unsigned long recv_time_ms = millis(); 
+          TimedPacket cmd;
+          udp.read((byte*)&cmd, sizeof(cmd));
+          lastUdpPacketTime = recv_time_ms;
+          serverIP = udp.remoteIP();
+          haveServer = true;
           if (currentState != MODE_SYNC) {
               currentState = MODE_SYNC;
           }
-          if (cmd.command == CMD_BEAT_SYNC || cmd.command == CMD_FX_STATIC || cmd.command == CMD_FX_BLINK) {
-              if (cmd.r == 0 && cmd.g == 0 && cmd.b == 0) {
-                  color_set_sync_color(0);
-              } else {
-                  color_set_sync_color(circleL.Color(cmd.r, cmd.g, cmd.b));
-              }
+          if (cmd.command == CMD_BEAT_TIMED) timedMode = true;
+          // Chưa đồng bộ thì không biết target_us ứng với lúc nào ở gậy: bỏ qua (không đánh dấu đã thấy),
+          // bản lặp sau của cùng beat sẽ được hẹn giờ khi đồng bộ xong
+          if (cmd.command == CMD_BEAT_TIMED && clockSynced && !seenRecently(cmd.packet_id)) {
+              Serial.printf("LOG,RECV,%u,%u,%u,%u,%u,%lu\n", 
+                  cmd.packet_id, cmd.command, cmd.r, cmd.g, cmd.b, recv_time_ms);
+              scheduleTimedBeat(cmd);
           }
       } else if (packetSize > 0) {
           udp.flush();
       }
+
+      if (clockUdp.parsePacket() == sizeof(ClockSyncPacket)) {
+          handleClockSyncReply();
+      } else {
+          clockUdp.flush();
+      }
+      if (currentState == MODE_SYNC && haveServer && millis() - lastClockSyncTime > (clockSynced ? CLOCK_SYNC_INTERVAL : CLOCK_SYNC_RETRY_INTERVAL)) {
+          lastClockSyncTime = millis();
+          sendClockSyncRequest();
+      }
+      servicePendingBeats();
   }
   
   if (currentState == MODE_SYNC && (millis() - lastUdpPacketTime > UDP_TIMEOUT)) {
       Serial.println("UDP Timeout! State: SYNC -> WIFI_CONNECTED");
       currentState = MODE_WIFI_CONNECTED; 
+      resetClockSync();
       color_set_mode(MODE_STATIC_WHITE);
   }
 
@@ -294,6 +483,8 @@ void loop() {
 
 void disconnectServer() {
   udp.stop();
+  clockUdp.stop();
+  resetClockSync();
   WiFi.disconnect(true);
   WiFi.mode(WIFI_OFF);
   udpInitialized = false;
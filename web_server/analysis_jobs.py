@@ -0,0 +1,273 @@
+import os
+import io
+import time
+import uuid
+import json
+import socket
+import pstats
+import cProfile
+import logging
+import threading
+import multiprocessing
+from multiprocessing import connection, forkserver, util
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+import beat_analysis
+
+logger = logging.getLogger()
+
+JOB_RETENTION_SECONDS = 600
+JOB_FINAL_STATES = ('done', 'error')
+WORKER_NICE = 5  # worker phân tích nhường CPU cho thread gửi gói
+# forkserver nhưng process server được fork (không exec) từ server lúc chưa mở socket/thread nào (xem web.py):
+# worker (kể cả khi dựng lại pool sau khi một worker chết) fork từ process đơn luồng đó nên an toàn, không giữ
+# socket của server, và không chạy lại web.py (__mp_main__) như spawn/forkserver thường vì __main__ đã có sẵn
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else None
+PROFILE_TOP_FUNCTIONS = 40
+
+JOBS_FINISHED = metrics.counter('lightstick_analysis_jobs_total', 'Job phân tích đã kết thúc, theo kết quả', ('status',))
+STAGE_SECONDS = metrics.histogram('lightstick_analysis_stage_seconds', 'Thời gian từng giai đoạn analyze_beats (đo trong worker)', metrics.STAGE_BUCKETS, ('stage', 'path'))
+JOB_SECONDS = metrics.histogram('lightstick_analysis_job_seconds', 'Thời gian chạy một job trong worker (tới khi xong giai đoạn cuối)', metrics.STAGE_BUCKETS, ('path',))
+QUEUE_WAIT_SECONDS = metrics.histogram('lightstick_analysis_queue_wait_seconds', 'Từ lúc xếp hàng tới khi worker bắt đầu job', metrics.STAGE_BUCKETS)
+
+_worker_progress_queue = None
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+def _start_forkserver():
+    server = forkserver._forkserver
+    if server._forkserver_pid is not None: return
+    with socket.socket(socket.AF_UNIX) as listener:
+        address = connection.arbitrary_address('AF_UNIX')
+        listener.bind(address)
+        if not util.is_abstract_socket_namespace(address): os.chmod(address, 0o600)
+        listener.listen()
+        alive_r, alive_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(alive_w)
+                forkserver.main(listener.fileno(), alive_r, [])
+            finally: os._exit(0)
+        os.close(alive_r)
+    # ensure_running() thấy process còn sống thì dùng luôn, không exec forkserver mới
+    server._forkserver_address = address; server._forkserver_alive_fd = alive_w; server._forkserver_pid = pid
+
+
+def _watch_parent():
+    # Server chết (kể cả SIGKILL, không chạy atexit) -> pipe sentinel tới server đóng -> worker tự thoát thay vì mồ côi
+    multiprocessing.parent_process().join()
+    os._exit(0)
+
+
+def _init_worker(progress_queue, prewarm):
+    global _worker_progress_queue
+    _worker_progress_queue = progress_queue
+    threading.Thread(target=_watch_parent, name="ParentWatchdog", daemon=True).start()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(processName)s] %(message)s')
+    try: os.nice(WORKER_NICE)
+    except (AttributeError, OSError): pass
+    if prewarm:
+        try: beat_analysis.warm_up()
+        except Exception as e: logger.warning(f"Làm nóng worker thất bại (job đầu sẽ chậm hơn): {e}")
+    progress_queue.put((None, 'ready', os.getpid()))
+
+
+def _spawn_probe():
+    pass
+
+
+def _run_job(job_id, filepath, user_tempo, profile_dir=None):
+    def progress(stage, fraction):
+        _worker_progress_queue.put((job_id, stage, fraction))
+    if not profile_dir: return beat_analysis.analyze_beats(filepath, user_tempo, progress=progress)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try: result = beat_analysis.analyze_beats(filepath, user_tempo, progress=progress)
+    finally: profiler.disable()
+    try: _dump_profile(profile_dir, job_id, filepath, profiler, result)
+    except OSError as e: logger.warning(f"Job {job_id}: không ghi được profile vào {profile_dir}: {e}")
+    return result
+
+
+def _dump_profile(profile_dir, job_id, filepath, profiler, result):
+    # <job>.prof đọc bằng pstats/snakeviz; <job>.txt = thời gian từng giai đoạn + hàm tốn nhất (cumulative)
+    os.makedirs(profile_dir, exist_ok=True)
+    base = os.path.join(profile_dir, f"{job_id}")
+    profiler.dump_stats(base + ".prof")
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+    summary = {"file": os.path.basename(filepath), "success": result.get("success"), "streaming": result.get("streaming"),
+               "stage_seconds": result.get("stage_seconds", {})}
+    with open(base + ".txt", 'w', encoding='utf-8') as f:
+        f.write(json.dumps(summary, ensure_ascii=False, indent=2) + "\n\n" + out.getvalue())
+    logger.info(f"Job {job_id}: đã ghi profile {base}.prof")
+
+
+class AnalysisJobQueue:
+    def __init__(self, max_workers, max_pending, on_done, on_error, prewarm=False, profile_dir=None):
+        self.max_workers = max_workers
+        self.prewarm = prewarm
+        self.profile_dir = profile_dir
+        self.ready_workers = set()
+        self.max_pending = max_pending
+        self.on_done = on_done
+        self.on_error = on_error
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._progress_queue = None
+        self._listener = None
+        self.restarts = 0
+
+    def _ensure_started(self):
+        if self._executor is not None: return
+        if START_METHOD == 'forkserver': _start_forkserver()
+        ctx = multiprocessing.get_context(START_METHOD)
+        self._progress_queue = ctx.Queue()
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=ctx, initializer=_init_worker, initargs=(self._progress_queue, self.prewarm))
+        # Mỗi lần submit khi chưa có worker rảnh sinh thêm một worker: đủ max_workers probe là dựng đủ pool
+        for _ in range(self.max_workers):
+            self._executor.submit(_spawn_probe)
+        self._listener = threading.Thread(target=self._listen_progress, args=(self._progress_queue,), name="AnalysisProgressThread", daemon=True)
+        self._listener.start()
+        logger.info(f"Job queue: khởi động {self.max_workers} worker phân tích.")
+
+    def start(self):
+        # Fork process sinh worker rồi dựng sẵn đủ worker (prewarm: mỗi worker tự làm nóng trong initializer)
+        # thay vì đợi upload đầu tiên. Không chặn: thread gửi/HTTP chạy ngay, worker nạp librosa ở process riêng.
+        with self._lock: self._ensure_started()
+
+    def _restart(self, executor):
+        # Một worker chết (OOM, segfault trong librosa/soundfile) làm cả pool thành BrokenProcessPool vĩnh viễn:
+        # bỏ pool đó, dựng pool mới (fork từ forkserver). Nhiều callback cùng báo một pool hỏng chỉ dựng lại một lần
+        with self._lock:
+            if self._executor is not executor: return
+            logger.error("Job queue: worker phân tích chết, dựng lại pool.")
+            executor.shutdown(wait=False, cancel_futures=True)
+            # worker bị giết có thể đang giữ lock ghi của hàng đợi tiến độ cũ: không để thoát server phải chờ nó
+            self._progress_queue.cancel_join_thread(); self._progress_queue.put(None)
+            self._executor = None; self.ready_workers.clear(); self.restarts += 1
+            self._ensure_started()
+
+    def _listen_progress(self, progress_queue):
+        while True:
+            msg = progress_queue.get()
+            if msg is None: break
+            job_id, stage, fraction = msg
+            with self._lock:
+                # (None, 'ready', pid): worker xong initializer (đã làm nóng nếu bật prewarm); bỏ qua tin từ pool cũ
+                if job_id is None:
+                    if progress_queue is self._progress_queue: self.ready_workers.add(fraction)
+                    continue
+                job = self._jobs.get(job_id)
+                if job is None or job["status"] in JOB_FINAL_STATES: continue
+                job["status"] = 'running'; job["stage"] = stage; job["progress"] = fraction
+                if job["started_at"] is None: job["started_at"] = time.time()
+
+    def submit(self, filepath, filename, user_tempo, cache_key, position=None):
+        with self._lock:
+            self._prune()
+            pending = sum(1 for j in self._jobs.values() if j["status"] not in JOB_FINAL_STATES)
+            if pending >= self.max_pending:
+                raise JobQueueFull(f"Đang có {pending} file chờ phân tích, thử lại sau.")
+            self._ensure_started()
+            job_id = uuid.uuid4().hex[:12]
+            job = {
+                "id": job_id, "filename": filename, "status": 'queued', "stage": None, "progress": 0.0,
+                "error": None, "submitted_at": time.time(), "started_at": None, "finished_at": None,
+                "beats": 0, "tempo": 0.0, "cache_key": cache_key, "position": position
+            }
+            self._jobs[job_id] = job
+            executor = self._executor
+        try:
+            try: future = executor.submit(_run_job, job_id, filepath, user_tempo, self.profile_dir)
+            except BrokenProcessPool:
+                # Worker chết lúc pool đang rảnh (không job nào báo lỗi): dựng lại rồi thử lại một lần
+                self._restart(executor)
+                with self._lock: executor = self._executor
+                future = executor.submit(_run_job, job_id, filepath, user_tempo, self.profile_dir)
+        except Exception:
+            with self._lock: del self._jobs[job_id]
+            raise
+        future.add_done_callback(lambda f, job_id=job_id, executor=executor: self._finish(job_id, f, executor))
+        logger.info(f"Job {job_id}: đã xếp hàng phân tích '{filename}'.")
+        return job_id
+
+    def _finish(self, job_id, future, executor):
+        try:
+            result = future.result()
+        except BrokenProcessPool:
+            # Mọi job đang chờ/chạy trong pool hỏng đều nhận lỗi này -> đánh dấu error, pool được dựng lại
+            logger.error(f"Job {job_id}: worker phân tích chết giữa chừng.")
+            result = {"success": False, "error": "Worker phân tích bị dừng đột ngột (hết bộ nhớ?), hãy thử lại."}
+            self._restart(executor)
+        except Exception as e:
+            logger.error(f"Job {job_id}: worker lỗi: {e}", exc_info=True)
+            result = {"success": False, "error": f"Lỗi worker phân tích: {type(e).__name__}"}
+        with self._lock:
+            job = self._jobs[job_id]
+        if result["success"]:
+            result["filename"] = job["filename"]
+            try: self.on_done(job, result)
+            except Exception as e:
+                logger.error(f"Job {job_id}: lỗi xử lý kết quả: {e}", exc_info=True)
+                result = {"success": False, "error": f"Lỗi xử lý kết quả: {type(e).__name__}"}
+        with self._lock:
+            job["finished_at"] = time.time()
+            if result["success"]:
+                job.update(status='done', stage='done', progress=1.0, beats=len(result["beats"]), tempo=result["tempo"])
+                logger.info(f"Job {job_id}: xong '{job['filename']}' sau {job['finished_at'] - job['submitted_at']:.1f}s.")
+            else:
+                job.update(status='error', error=result["error"])
+                logger.error(f"Job {job_id}: thất bại '{job['filename']}': {result['error']}")
+        self._observe(job, result)
+        if not result["success"]: self.on_error(job, result["error"])
+
+    def _observe(self, job, result):
+        # Chạy trong thread callback của executor (một thread ghi duy nhất cho các series này)
+        JOBS_FINISHED.labels(job["status"]).inc()
+        if job["started_at"] is not None: QUEUE_WAIT_SECONDS.labels().observe(max(0.0, job["started_at"] - job["submitted_at"]))
+        stage_seconds = result.get("stage_seconds")
+        if not stage_seconds: return
+        path = 'streaming' if result.get("streaming") else 'full'
+        for stage, seconds in stage_seconds.items(): STAGE_SECONDS.labels(stage, path).observe(seconds)
+        JOB_SECONDS.labels(path).observe(sum(stage_seconds.values()))
+
+    def _prune(self):
+        now = time.time()
+        for job_id in [j["id"] for j in self._jobs.values() if j["status"] in JOB_FINAL_STATES and now - j["finished_at"] > JOB_RETENTION_SECONDS]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return self._public(job) if job else None
+
+    def list(self):
+        with self._lock:
+            return [self._public(j) for j in self._jobs.values()]
+
+    def _public(self, job):
+        return {k: v for k, v in job.items() if k != "cache_key"}
+
+    def stats(self):
+        with self._lock:
+            statuses = [j["status"] for j in self._jobs.values()]
+            return {"workers": self.max_workers, "started": self._executor is not None, "prewarm": self.prewarm, "ready": len(self.ready_workers), "restarts": self.restarts,
+                    "queued": statuses.count('queued'), "running": statuses.count('running'), "profile_dir": self.profile_dir}
+
+    def shutdown(self):
+        if self._executor is None: return
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._progress_queue.put(None)
+        self._executor = None
+
+
+def default_worker_count():
+    return max(1, (os.cpu_count() or 2) - 1)
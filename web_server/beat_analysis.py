@@ -0,0 +1,409 @@
+import os
+import sys
+import time
+import logging
+
+try:
+    import numpy as np
+    from timeline import BEAT_FEATURE_DTYPE
+except ImportError:
+    logging.basicConfig(level=logging.ERROR); logger = logging.getLogger(); logger.error("LỖI: pip install Flask librosa soundfile numpy scipy"); exit()
+
+logger = logging.getLogger()
+
+# librosa (kéo theo scipy/numba, vài giây) và soundfile (libsndfile) chỉ nạp khi thực sự đọc/phân tích,
+# trong worker; server điều khiển/gửi gói import module này chỉ để lấy tham số cache
+librosa = None
+soundfile = None
+
+def load_librosa():
+    global librosa
+    if librosa is None:
+        import librosa as _librosa
+        librosa = _librosa
+    return librosa
+
+def load_soundfile():
+    global soundfile
+    if soundfile is None:
+        import soundfile as _soundfile
+        soundfile = _soundfile
+    return soundfile
+
+ANALYSIS_VERSION = 4
+ANALYSIS_HOP_LENGTH = 512
+ANALYSIS_N_FFT = 2048
+HPSS_MARGIN = 3.0
+HPSS_KERNEL_FRAMES = 31
+BEAT_TIGHTNESS = 200
+
+# File dài hơn ngưỡng này được phân tích theo khối (bộ nhớ cố định) thay vì load toàn bộ
+STREAMING_MIN_DURATION = 600.0
+STREAMING_ANALYSIS_SR = 22050
+STREAMING_READ_BLOCK = 65536
+STREAMING_BLOCK_FRAMES = 512
+STREAMING_TEMPO_CHUNK_FRAMES = 2048
+
+# Đặc trưng theo beat: năng lượng dải thấp/trung/cao (ranh giới Hz) trong cửa sổ quanh beat, từ trung điểm
+# với beat trước tới trung điểm với beat sau (tối đa BEAT_FEATURE_HALF_FRAMES mỗi phía): beat frame lệch
+# vài frame so với tiếng gõ thật vẫn lấy trọn tiếng gõ, bài đều đều cho đặc trưng đều
+BAND_EDGES_HZ = (250.0, 2000.0)
+BEAT_FEATURE_HALF_FRAMES = 16
+BEATS_PER_BAR = 4
+# Ranh giới đoạn: novelty = khác biệt đặc trưng trung bình SECTION_WINDOW_BEATS beat trước/sau,
+# đỉnh cách nhau ít nhất SECTION_MIN_BEATS, vượt mean + SECTION_THRESHOLD_STD * std và SECTION_MIN_NOVELTY
+# (ngưỡng tuyệt đối để bài đều đều không bị cắt vụn)
+SECTION_WINDOW_BEATS = 16
+SECTION_MIN_BEATS = 32
+SECTION_THRESHOLD_STD = 2.0
+SECTION_MIN_NOVELTY = 0.5
+
+# Clip click tổng hợp để làm nóng worker (nạp librosa + JIT numba cho cả hai nhánh phân tích)
+WARMUP_DURATION = 4.0
+WARMUP_BPM = 120.0
+
+# Tiến độ (0..1) khi bắt đầu mỗi giai đoạn, dùng cho /jobs/<id>
+ANALYSIS_STAGES = {"decode": 0.0, "hpss": 0.15, "onset": 0.6, "tempo": 0.75, "beat_track": 0.85, "features": 0.93, "done": 1.0}
+
+def analysis_params(user_tempo):
+    return {
+        "version": ANALYSIS_VERSION,
+        "hop_length": ANALYSIS_HOP_LENGTH,
+        "hpss_margin": HPSS_MARGIN,
+        "tightness": BEAT_TIGHTNESS,
+        "band_edges_hz": list(BAND_EDGES_HZ),
+        "section_window_beats": SECTION_WINDOW_BEATS,
+        "section_min_novelty": SECTION_MIN_NOVELTY,
+        "streaming_min_duration": STREAMING_MIN_DURATION,
+        "streaming_sr": STREAMING_ANALYSIS_SR,
+        "user_tempo": float(user_tempo) if user_tempo and user_tempo > 0 else 0.0
+    }
+
+def should_stream(filepath):
+    load_soundfile()
+    try: info = soundfile.info(filepath)
+    except Exception: return False  # libsndfile không đọc được (m4a/aac...) -> dùng librosa.load
+    return info.frames / float(info.samplerate) >= STREAMING_MIN_DURATION
+
+def _chunked_tempo(onset_env_perc, sr, hop_length_analysis):
+    # Trung bình tempogram theo từng đoạn envelope, tránh ma trận (384 x số frame) của cả bài
+    acc = None; frames = 0
+    for start in range(0, len(onset_env_perc), STREAMING_TEMPO_CHUNK_FRAMES):
+        tg = librosa.feature.tempogram(onset_envelope=onset_env_perc[start:start + STREAMING_TEMPO_CHUNK_FRAMES], sr=sr, hop_length=hop_length_analysis)
+        acc = tg.sum(axis=1) if acc is None else acc + tg.sum(axis=1)
+        frames += tg.shape[1]
+    if acc is None: return 0.0
+    return librosa.feature.tempo(sr=sr, hop_length=hop_length_analysis, tg=(acc / frames)[:, None], aggregate=np.mean)
+
+def _beats_from_onset(onset_env_perc, sr, hop_length_analysis, user_tempo, report, streaming=False):
+    report("tempo")
+    local_tempo = 0.0
+    if user_tempo and user_tempo > 0:
+        logger.info(f"Sử dụng Tempo do người dùng cung cấp: {user_tempo:.0f} BPM.")
+        local_tempo = float(user_tempo)
+    else:
+        logger.info("Ước tính tempo từ Librosa...")
+        if streaming: tempo_estimate = _chunked_tempo(onset_env_perc, sr, hop_length_analysis)
+        else: tempo_estimate = librosa.feature.tempo(onset_envelope=onset_env_perc, sr=sr, hop_length=hop_length_analysis)
+        if isinstance(tempo_estimate, np.ndarray): tempo_value = float(tempo_estimate[0]) if len(tempo_estimate) > 0 else 0.0
+        else: tempo_value = float(tempo_estimate)
+        local_tempo = round(tempo_value)
+        logger.info(f"Tempo ước tính (làm tròn): {local_tempo:.0f} BPM.")
+
+    calculated_tempo = float(local_tempo)
+    beats_with_intensity = []
+
+    report("beat_track")
+    if calculated_tempo > 0 and len(onset_env_perc) > 0:
+        # streaming: truyền thẳng bpm để beat_track không ước tính lại tempo trên toàn bộ envelope
+        tempo_arg = {"bpm": calculated_tempo} if streaming else {"start_bpm": calculated_tempo}
+        _, beat_frames = librosa.beat.beat_track(onset_envelope=onset_env_perc, sr=sr, hop_length=hop_length_analysis, units='frames', tightness=BEAT_TIGHTNESS, **tempo_arg)
+        beat_times = librosa.frames_to_time(beat_frames, sr=sr, hop_length=hop_length_analysis)
+        beat_intensities_raw = onset_env_perc[beat_frames]
+
+        max_intensity = np.max(beat_intensities_raw) if len(beat_intensities_raw) > 0 else 0.0
+        if max_intensity > 0:
+            beat_intensities_norm = beat_intensities_raw / max_intensity
+            logger.info(f"Đã chuẩn hóa {len(beat_intensities_norm)} cường độ (Max: {max_intensity:.2f})")
+        else:
+            logger.warning("Không phát hiện cường độ, dùng 1.0 cho tất cả.")
+            beat_intensities_norm = np.ones_like(beat_intensities_raw)
+
+        beats_with_intensity = list(zip(beat_times.tolist(), beat_intensities_norm.tolist()))
+        logger.info(f"Căn chỉnh {len(beats_with_intensity)} beats theo tempo {calculated_tempo:.0f} BPM.")
+
+    if len(beats_with_intensity) == 0:
+        logger.warning("Beat track thất bại, dùng onset detect dự phòng...")
+        onset_frames = librosa.onset.onset_detect(onset_envelope=onset_env_perc, sr=sr, hop_length=hop_length_analysis, units='frames', backtrack=False)
+        onset_times = librosa.frames_to_time(onset_frames, sr=sr, hop_length=hop_length_analysis)
+        beats_with_intensity = list(zip(onset_times.tolist(), np.ones_like(onset_times).tolist()))
+        logger.info(f"Dự phòng cuối: Sử dụng {len(beats_with_intensity)} onsets.")
+
+    return calculated_tempo, beats_with_intensity
+
+def _full_onset_envelope(filepath, report):
+    report("decode")
+    y, sr = librosa.load(filepath, sr=None, mono=True)
+    duration = librosa.get_duration(y=y, sr=sr)
+    logger.info(f"Đã tải. SR: {sr} Hz, Dài: {duration:.2f}s.")
+    logger.info("Thực hiện tách Harmonic/Percussive (HPSS)...")
+    report("hpss")
+    # Một STFT dùng chung: HPSS + ISTFT y hệt librosa.effects.percussive (onset/beat không đổi so với trước),
+    # biên độ của chính STFT đó cho đặc trưng dải
+    stft = librosa.stft(y, n_fft=ANALYSIS_N_FFT, hop_length=ANALYSIS_HOP_LENGTH)
+    mag = np.abs(stft)
+    _, stft_perc = librosa.decompose.hpss(stft, kernel_size=HPSS_KERNEL_FRAMES, margin=HPSS_MARGIN)
+    del stft
+    y_percussive = librosa.istft(stft_perc, dtype=y.dtype, n_fft=ANALYSIS_N_FFT, hop_length=ANALYSIS_HOP_LENGTH, length=len(y))
+    del stft_perc, y
+    logger.info("HPSS hoàn tất.")
+
+    report("onset")
+    onset_env_perc = librosa.onset.onset_strength(y=y_percussive, sr=sr, hop_length=ANALYSIS_HOP_LENGTH, aggregate=np.median)
+    return onset_env_perc, sr, ANALYSIS_HOP_LENGTH, _frame_features(mag, sr, ANALYSIS_N_FFT)
+
+def _frame_features(mag, sr, n_fft):
+    # (4, frame): năng lượng 3 dải + spectral centroid, tính từ phổ biên độ đã có sẵn
+    freqs = np.fft.rfftfreq(n_fft, 1.0 / sr)
+    edges = np.searchsorted(freqs, BAND_EDGES_HZ)
+    power = mag ** 2
+    bands = [power[lo:hi].sum(axis=0) for lo, hi in zip((0, *edges), (*edges, len(freqs)))]
+    total = mag.sum(axis=0)
+    centroid = np.divide(freqs @ mag, total, out=np.zeros_like(total), where=total > 0)
+    return np.vstack(bands + [centroid]).astype(np.float32)
+
+def _beat_windows(frames):
+    # [start, end) quanh mỗi beat: tới trung điểm với beat kề, không quá BEAT_FEATURE_HALF_FRAMES mỗi phía
+    gaps = np.diff(frames)
+    prev_gap = np.concatenate([[2 * BEAT_FEATURE_HALF_FRAMES], gaps])
+    next_gap = np.concatenate([gaps, [2 * BEAT_FEATURE_HALF_FRAMES]])
+    before = np.minimum(prev_gap // 2, BEAT_FEATURE_HALF_FRAMES)
+    after = np.minimum(next_gap - next_gap // 2, BEAT_FEATURE_HALF_FRAMES)
+    return frames - before, frames + np.maximum(1, after)
+
+def _window_mean(values, start, end):
+    # Trung bình values[:, start:end] cho mọi beat, bằng tổng tích luỹ (không lặp theo beat)
+    cs = np.concatenate([np.zeros((values.shape[0], 1)), np.cumsum(values, axis=1, dtype=np.float64)], axis=1)
+    start = np.clip(start, 0, values.shape[1]); end = np.clip(end, 0, values.shape[1])
+    count = np.maximum(1, end - start)
+    return (cs[:, end] - cs[:, start]) / count
+
+def _sections(vectors, bar_position):
+    # Novelty bằng hiệu trung bình cửa sổ trước/sau mỗi beat (cumsum), ranh giới bám vào phách mạnh
+    n = len(vectors)
+    w = SECTION_WINDOW_BEATS
+    section = np.zeros(n, dtype=np.uint16)
+    if n < 2 * w: return section
+    cs = np.concatenate([np.zeros((1, vectors.shape[1])), np.cumsum(vectors, axis=0)])
+    idx = np.arange(w, n - w + 1)
+    novelty = np.linalg.norm((cs[idx + w] - cs[idx]) / w - (cs[idx] - cs[idx - w]) / w, axis=1)
+    threshold = max(SECTION_MIN_NOVELTY, novelty.mean() + SECTION_THRESHOLD_STD * novelty.std())
+    candidates = idx[(novelty > threshold) & (bar_position[idx] == 0)]
+    strength = dict(zip(idx.tolist(), novelty.tolist()))
+    boundaries = []
+    for b in sorted(candidates.tolist(), key=lambda b: -strength[b]):
+        if all(abs(b - other) >= SECTION_MIN_BEATS for other in boundaries): boundaries.append(b)
+    for b in boundaries: section[b:] += 1
+    return section
+
+def beat_features(frame_features, beat_times, intensities, sr, hop_length):
+    beat_frames = librosa.time_to_frames(np.asarray(beat_times), sr=sr, hop_length=hop_length)
+    features = np.zeros(len(beat_frames), dtype=BEAT_FEATURE_DTYPE)
+    if not len(beat_frames) or not frame_features.shape[1]: return features
+    energy = frame_features[:3]
+    start, end = _beat_windows(beat_frames)
+    bands = _window_mean(energy, start, end)
+    weight = energy.sum(axis=0)
+    centroid = _window_mean(np.vstack([frame_features[3] * weight, weight]), start, end)
+    peak = bands.max(axis=1, keepdims=True)
+    bands = np.divide(bands, peak, out=np.zeros_like(bands), where=peak > 0)
+    features['low'], features['mid'], features['high'] = bands
+    features['centroid'] = np.divide(centroid[0], centroid[1], out=np.zeros(len(beat_frames)), where=centroid[1] > 0)
+
+    # Phách mạnh: pha (0..BEATS_PER_BAR-1) có bass + onset trung bình lớn nhất
+    accent = bands[0] + np.asarray(intensities, dtype=np.float64)
+    phase = int(np.argmax([accent[p::BEATS_PER_BAR].mean() if len(accent[p::BEATS_PER_BAR]) else 0.0 for p in range(BEATS_PER_BAR)]))
+    features['bar_position'] = (np.arange(len(beat_frames)) - phase) % BEATS_PER_BAR
+
+    spread = max(1.0, float(features['centroid'].max()))
+    vectors = np.column_stack([np.log1p(10 * bands.T), features['centroid'] / spread])
+    features['section'] = _sections(vectors, features['bar_position'])
+    return features
+
+class _StreamingOnset:
+    # Onset envelope của phần percussive, tính theo từng khối frame STFT.
+    # Giữ HPSS_KERNEL_FRAMES//2 frame ngữ cảnh hai phía để median filter của HPSS
+    # cho kết quả như khi chạy trên toàn bộ phổ; bộ nhớ chỉ phụ thuộc kích thước khối.
+    def __init__(self, sr, n_fft, hop):
+        self.sr = sr
+        self.n_fft = n_fft
+        self.hop = hop
+        self.window = librosa.filters.get_window('hann', self.n_fft, fftbins=True).astype(np.float32)[:, None]
+        self.feature_chunks = []
+        self.mel_basis = librosa.filters.mel(sr=sr, n_fft=self.n_fft)
+        self.context = HPSS_KERNEL_FRAMES // 2 + 1
+        self.samples = np.zeros(self.n_fft // 2, dtype=np.float32)  # đệm như center=True
+        self.pending = np.zeros((self.n_fft // 2 + 1, 0), dtype=np.float32)
+        self.pending_done = 0
+        self.prev_mel_db = None
+        # librosa.onset.onset_strength dịch envelope lag + n_fft // (2 * hop) frame
+        self.onset_chunks = [np.zeros(1 + self.n_fft // (2 * self.hop), dtype=np.float32)]
+        self.n_frames = 0
+
+    def push(self, samples):
+        self.samples = np.concatenate([self.samples, samples])
+        chunk_len = self.n_fft + self.hop * (STREAMING_BLOCK_FRAMES - 1)
+        while len(self.samples) >= chunk_len:
+            self._spectrum(self.samples[:chunk_len])
+            self.samples = self.samples[self.hop * STREAMING_BLOCK_FRAMES:]
+            self._hpss(final=False)
+
+    def finish(self):
+        tail = np.concatenate([self.samples, np.zeros(self.n_fft // 2, dtype=np.float32)])
+        if len(tail) >= self.n_fft: self._spectrum(tail)
+        self.samples = np.zeros(0, dtype=np.float32)
+        self._hpss(final=True)
+        frame_features = np.concatenate(self.feature_chunks, axis=1) if self.feature_chunks else np.zeros((4, 0), dtype=np.float32)
+        return np.concatenate(self.onset_chunks)[:self.n_frames], frame_features
+
+    def _spectrum(self, chunk):
+        frames = librosa.util.frame(chunk, frame_length=self.n_fft, hop_length=self.hop)
+        mag = np.abs(np.fft.rfft(frames * self.window, axis=0)).astype(np.float32)
+        self.feature_chunks.append(_frame_features(mag, self.sr, self.n_fft))
+        self.pending = np.concatenate([self.pending, mag], axis=1)
+        self.n_frames += mag.shape[1]
+
+    def _hpss(self, final):
+        end = self.pending.shape[1] if final else self.pending.shape[1] - self.context
+        if end <= self.pending_done: return
+        _, perc = librosa.decompose.hpss(self.pending, kernel_size=HPSS_KERNEL_FRAMES, margin=HPSS_MARGIN)
+        self._onset(perc[:, self.pending_done:end])
+        keep = min(self.pending.shape[1], 2 * self.context)
+        self.pending_done = max(0, end - (self.pending.shape[1] - keep))
+        self.pending = self.pending[:, self.pending.shape[1] - keep:]
+
+    def _onset(self, perc):
+        mel_db = librosa.power_to_db(self.mel_basis @ (perc ** 2), top_db=None)
+        if self.prev_mel_db is not None: mel_db_lag = np.concatenate([self.prev_mel_db, mel_db], axis=1)
+        else: mel_db_lag = mel_db
+        if mel_db_lag.shape[1] > 1:
+            self.onset_chunks.append(np.median(np.maximum(0.0, np.diff(mel_db_lag, axis=1)), axis=0).astype(np.float32))
+        self.prev_mel_db = mel_db[:, -1:]
+
+def _streaming_onset_envelope(filepath, report, analysis_sr=STREAMING_ANALYSIS_SR):
+    info = soundfile.info(filepath)
+    native_sr = info.samplerate
+    sr = analysis_sr or native_sr
+    resampler = None
+    if sr != native_sr:
+        try:
+            import soxr
+            resampler = soxr.ResampleStream(native_sr, sr, 1, dtype='float32')
+        except ImportError:
+            logger.warning("Thiếu soxr, phân tích streaming ở SR gốc.")
+            sr = native_sr
+    # Giữ độ dài frame (giây) như nhánh load toàn bộ ở SR gốc
+    hop = max(64, int(round(ANALYSIS_HOP_LENGTH * sr / native_sr)))
+    n_fft = hop * (ANALYSIS_N_FFT // ANALYSIS_HOP_LENGTH)
+    logger.info(f"Phân tích streaming: {info.frames / native_sr:.1f}s, SR gốc {native_sr} Hz -> {sr} Hz, hop {hop}, khối {STREAMING_BLOCK_FRAMES} frame.")
+
+    onset = _StreamingOnset(sr, n_fft, hop)
+    read = 0
+    for block in soundfile.blocks(filepath, blocksize=STREAMING_READ_BLOCK, dtype='float32', always_2d=True):
+        mono = block.mean(axis=1, dtype=np.float32)
+        read += len(mono)
+        if resampler is not None: mono = resampler.resample_chunk(mono)
+        onset.push(mono)
+        if info.frames > 0: report("hpss", ANALYSIS_STAGES["hpss"] + (ANALYSIS_STAGES["tempo"] - ANALYSIS_STAGES["hpss"]) * min(1.0, read / info.frames))
+    if resampler is not None: onset.push(resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True))
+    onset_env, frame_features = onset.finish()
+    return onset_env, sr, hop, frame_features
+
+def analyze_beats(filepath, user_tempo=None, progress=None, streaming=None):
+    # Thời gian từng giai đoạn đo tại chỗ chuyển stage (report), trả kèm kết quả cho /metrics;
+    # 'init' = nạp librosa + chọn nhánh, chỉ đáng kể ở worker chưa làm nóng
+    stage_seconds = {}
+    current = ["init", time.perf_counter()]
+    def report(stage, fraction=None):
+        if stage != current[0]:
+            now = time.perf_counter()
+            stage_seconds[current[0]] = stage_seconds.get(current[0], 0.0) + now - current[1]
+            current[0] = stage; current[1] = now
+        if progress: progress(stage, ANALYSIS_STAGES[stage] if fraction is None else fraction)
+    try:
+        load_librosa(); load_soundfile()
+        if streaming is None: streaming = should_stream(filepath)
+        logger.info(f"Phân tích (HPSS + Cường độ{', streaming' if streaming else ''}): {os.path.basename(filepath)}...")
+        if streaming: onset_env_perc, sr, hop_length_analysis, frame_features = _streaming_onset_envelope(filepath, report)
+        else: onset_env_perc, sr, hop_length_analysis, frame_features = _full_onset_envelope(filepath, report)
+
+        calculated_tempo, beats_with_intensity = _beats_from_onset(onset_env_perc, sr, hop_length_analysis, user_tempo, report, streaming)
+
+        report("features")
+        features = beat_features(frame_features, [b[0] for b in beats_with_intensity], [b[1] for b in beats_with_intensity], sr, hop_length_analysis)
+        logger.info(f"Đặc trưng beat: {int(features['section'].max()) + 1 if len(features) else 0} đoạn, {int((features['bar_position'] == 0).sum())} phách mạnh.")
+
+        report("done")
+        return {
+            "filename": os.path.basename(filepath),
+            "beats": beats_with_intensity,
+            "features": features,
+            "tempo": calculated_tempo,
+            "stage_seconds": stage_seconds,
+            "streaming": streaming,
+            "success": True
+        }
+    except Exception as e:
+        logger.error(f"Lỗi phân tích beat (HPSS Style): {e}", exc_info=True)
+        return {"success": False, "error": f"Lỗi phân tích file: {type(e).__name__}"}
+
+def warm_up():
+    # Chạy một lần mỗi worker trước job đầu tiên, để bài đầu tiên không phải trả thêm vài giây nạp/JIT
+    import tempfile
+    t0 = time.perf_counter()
+    load_librosa(); load_soundfile()
+    sr = STREAMING_ANALYSIS_SR
+    clip = np.zeros(int(WARMUP_DURATION * sr), dtype=np.float32)
+    click = np.sin(2 * np.pi * 1000 * np.arange(int(0.03 * sr)) / sr).astype(np.float32)
+    for start in (np.arange(0.5, WARMUP_DURATION - 0.1, 60.0 / WARMUP_BPM) * sr).astype(np.int64): clip[start:start + len(click)] += click
+    fd, path = tempfile.mkstemp(suffix='.wav'); os.close(fd)
+    level = logger.level; logger.setLevel(logging.WARNING)
+    try:
+        soundfile.write(path, clip, sr)
+        for streaming in (False, True): analyze_beats(path, streaming=streaming)
+    finally:
+        logger.setLevel(level)
+        os.remove(path)
+    elapsed = time.perf_counter() - t0
+    logger.info(f"Worker phân tích đã sẵn sàng sau {elapsed:.2f}s (nạp librosa + JIT).")
+    return elapsed
+
+def compare_modes(filepath, user_tempo=None, tolerance=0.07):
+    import tracemalloc
+    report = {}
+    for mode, streaming in (("full", False), ("streaming", True)):
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        result = analyze_beats(filepath, user_tempo, streaming=streaming)
+        elapsed = time.perf_counter() - t0
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        if not result["success"]: raise RuntimeError(f"{mode}: {result['error']}")
+        report[mode] = {"seconds": elapsed, "peak_mb": peak / 1e6, "beats": len(result["beats"]), "tempo": result["tempo"], "times": np.array([b[0] for b in result["beats"]])}
+    full, stream = report["full"]["times"], report["streaming"]["times"]
+    if len(full) and len(stream):
+        idx = np.clip(np.searchsorted(stream, full), 1, len(stream) - 1) if len(stream) > 1 else np.zeros(len(full), dtype=int)
+        nearest = np.minimum(np.abs(stream[idx] - full), np.abs(stream[idx - 1] - full)) if len(stream) > 1 else np.abs(stream[0] - full)
+        report["beat_agreement"] = float(np.mean(nearest <= tolerance))
+    for mode in ("full", "streaming"): del report[mode]["times"]
+    return report
+
+if __name__ == '__main__':
+    # So sánh thời gian/bộ nhớ: python beat_analysis.py <file> [tempo]
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) < 2: print("Cách dùng: python beat_analysis.py <file> [tempo]"); sys.exit(1)
+    result = compare_modes(sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else None)
+    for mode in ("full", "streaming"):
+        r = result[mode]
+        print(f"{mode:>10}: {r['seconds']:7.2f}s  peak {r['peak_mb']:8.1f} MB  {r['beats']} beats  {r['tempo']:.0f} BPM")
+    if "beat_agreement" in result: print(f"Trùng beat (±70 ms): {result['beat_agreement'] * 100:.1f}%")
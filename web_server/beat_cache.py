@@ -0,0 +1,135 @@
+import os
+import sys
+import json
+import struct
+import hashlib
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+
+import numpy as np
+
+from timeline import BEAT_FEATURE_DTYPE
+
+logger = logging.getLogger()
+
+CACHE_MAGIC = b'BPBC'
+CACHE_VERSION = 2
+CACHE_SUFFIX = '.bin'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# magic(4) | version(u16) | tempo(f64) | số beat(u32), sau đó là time[f64 * n] + intensity[f32 * n]
+# + đặc trưng beat[BEAT_FEATURE_DTYPE * n] (little-endian cố định trong dtype)
+_HEADER = struct.Struct('<4sHdI')
+
+
+def _to_le(arr):
+    if sys.byteorder != 'little': arr.byteswap()
+    return arr
+
+
+def make_key(filepath, params):
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    h.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+
+def encode_entry(tempo, beats, features=None):
+    times = array('d', (b[0] for b in beats))
+    intensities = array('f', (b[1] for b in beats))
+    if features is None or len(features) != len(beats): features = np.zeros(len(beats), dtype=BEAT_FEATURE_DTYPE)
+    return _HEADER.pack(CACHE_MAGIC, CACHE_VERSION, float(tempo), len(beats)) + _to_le(times).tobytes() + _to_le(intensities).tobytes() + np.asarray(features, dtype=BEAT_FEATURE_DTYPE).tobytes()
+
+
+def decode_entry(data):
+    magic, version, tempo, n = _HEADER.unpack_from(data, 0)
+    if magic != CACHE_MAGIC or version != CACHE_VERSION:
+        raise ValueError(f"Cache entry không hợp lệ (magic={magic!r}, version={version})")
+    offset = _HEADER.size
+    size = offset + n * (12 + BEAT_FEATURE_DTYPE.itemsize)
+    if len(data) != size:
+        raise ValueError(f"Cache entry bị cắt cụt ({len(data)} bytes, cần {size})")
+    times = array('d'); times.frombytes(data[offset:offset + n * 8]); _to_le(times)
+    intensities = array('f'); intensities.frombytes(data[offset + n * 8:offset + n * 12]); _to_le(intensities)
+    features = np.frombuffer(data, dtype=BEAT_FEATURE_DTYPE, count=n, offset=offset + n * 12).copy()
+    return {"tempo": tempo, "beats": list(zip(times.tolist(), intensities.tolist())), "features": features}
+
+
+class BeatCache:
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> size, cũ nhất ở đầu
+        self._total_bytes = 0
+        os.makedirs(folder, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + CACHE_SUFFIX)
+
+    def _load_index(self):
+        found = []
+        for name in os.listdir(self.folder):
+            if not name.endswith(CACHE_SUFFIX): continue
+            try: st = os.stat(os.path.join(self.folder, name))
+            except OSError: continue
+            found.append((st.st_mtime, name[:-len(CACHE_SUFFIX)], st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total_bytes += size
+        logger.info(f"Beat cache: {len(self._entries)} mục, {self._total_bytes / 1024:.1f} KB tại {os.path.abspath(self.folder)}")
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            path = self._path(key)
+            try:
+                with open(path, 'rb') as f: entry = decode_entry(f.read())
+                os.utime(path)
+            except (OSError, ValueError, struct.error) as e:
+                logger.warning(f"Beat cache: bỏ mục hỏng {key[:12]}: {e}")
+                self._discard(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, tempo, beats, features=None):
+        data = encode_entry(tempo, beats, features)
+        if len(data) > self.max_bytes:
+            logger.warning(f"Beat cache: mục {len(data)} bytes vượt giới hạn, không lưu.")
+            return
+        path = self._path(key); tmp_path = path + '.tmp'
+        with self._lock:
+            try:
+                with open(tmp_path, 'wb') as f: f.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.error(f"Beat cache: không ghi được {key[:12]}: {e}")
+                return
+            if key in self._entries: self._total_bytes -= self._entries[key]
+            self._entries[key] = len(data); self._entries.move_to_end(key)
+            self._total_bytes += len(data)
+            while self._total_bytes > self.max_bytes and self._entries:
+                oldest = next(iter(self._entries))
+                logger.info(f"Beat cache: loại bỏ (LRU) {oldest[:12]}")
+                self._discard(oldest)
+
+    def _discard(self, key):
+        self._total_bytes -= self._entries.pop(key, 0)
+        try: os.remove(self._path(key))
+        except OSError: pass
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._total_bytes, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
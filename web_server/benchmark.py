@@ -0,0 +1,306 @@
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import socket
+import logging
+import platform
+import resource
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+
+import numpy as np
+
+# Benchmark hiệu năng: python benchmark.py [--quick] [--out report.json] [--compare old.json]
+ANALYSIS_CASES = [(90, 60.0), (120, 60.0), (128, 60.0), (150, 60.0), (174, 60.0), (128, 900.0)]
+QUICK_ANALYSIS_CASES = [(120, 30.0), (150, 30.0)]
+CLICK_SR = 22050
+CLICK_LENGTH = 0.03
+CLICK_NOISE = 0.01
+BEAT_TOLERANCE = 0.07
+SENDER_MODES = {"beat": 5.0, "beat_stress": 2.0, "blink": 5.0, "static": 5.0}
+QUICK_SENDER_MODES = {"beat": 2.0, "beat_stress": 1.0, "blink": 2.0, "static": 2.0}
+BEAT_RATE = 4.0
+STRESS_RATE = 1000.0
+LOOPBACK_IP = '127.0.0.1'
+STARTUP_PORT = 5000
+STARTUP_TIMEOUT = 60.0
+STARTUP_POLL = 0.01
+STOP_TIMEOUT = 10.0
+ANALYSIS_TIMEOUT = 900.0
+RECEIVER_TIMEOUT = 10.0
+RESULT_POLL = 0.5
+COMPARE_METRICS = {"analysis": ("seconds", "peak_rss_mb", "f_measure"), "sender": ("pkts_per_s", "p99_ms", "max_ms", "cpu_percent"),
+                   "startup": ("http_ms", "first_packet_ms", "workers_ready_ms")}
+
+
+def make_click_track(path, bpm, duration, sr=CLICK_SR, seed=0):
+    # Click 1 kHz tắt dần đặt đúng mỗi 60/bpm giây + nhiễu nền nhẹ; trả về mốc beat chuẩn
+    import soundfile as sf
+    times = np.arange(0.5, duration - CLICK_LENGTH, 60.0 / bpm)
+    audio = (CLICK_NOISE * np.random.default_rng(seed).standard_normal(int(duration * sr))).astype(np.float32)
+    n = int(CLICK_LENGTH * sr)
+    t = np.arange(n) / sr
+    click = (np.sin(2 * np.pi * 1000 * t) * np.exp(-t * 150)).astype(np.float32)
+    for i, start in enumerate((times * sr).astype(np.int64)):
+        audio[start:start + n] += click * (1.0 if i % 4 == 0 else 0.6)
+    sf.write(path, audio, sr, subtype='PCM_16')
+    return times
+
+
+def f_measure(estimated, reference, tolerance=BEAT_TOLERANCE):
+    estimated = np.sort(np.asarray(estimated, dtype=np.float64)); reference = np.asarray(reference, dtype=np.float64)
+    if not len(estimated) or not len(reference): return 0.0
+    idx = np.clip(np.searchsorted(estimated, reference), 1, max(1, len(estimated) - 1))
+    left = estimated[idx - 1] if len(estimated) > 1 else estimated[np.zeros(len(reference), dtype=int)]
+    right = estimated[np.minimum(idx, len(estimated) - 1)]
+    nearest = np.where(np.abs(left - reference) <= np.abs(right - reference), idx - 1, np.minimum(idx, len(estimated) - 1))
+    hit = np.abs(estimated[nearest] - reference) <= tolerance
+    matches = len(np.unique(nearest[hit]))  # mỗi beat dự đoán chỉ được ghép một lần
+    precision = matches / len(estimated); recall = matches / len(reference)
+    return 0.0 if matches == 0 else 2 * precision * recall / (precision + recall)
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _analysis_worker(filepath, result_queue):
+    # Chạy trong process mới để peak RSS chỉ phản ánh đúng một lần phân tích
+    logging.basicConfig(level=logging.WARNING)
+    from beat_analysis import analyze_beats, should_stream
+    base_mb = _peak_rss_mb()
+    t0 = time.perf_counter()
+    result = analyze_beats(filepath)
+    elapsed = time.perf_counter() - t0
+    result_queue.put({"seconds": elapsed, "peak_rss_mb": _peak_rss_mb(), "import_rss_mb": base_mb, "streaming": should_stream(filepath),
+                      "success": result["success"], "error": result.get("error"), "tempo": result.get("tempo"),
+                      "beats": [b[0] for b in result.get("beats", [])]})
+
+
+def _get_result(proc, result_queue, timeout, what):
+    # Process con chết (OOM, crash trong librosa...) hoặc treo thì báo lỗi thay vì chờ queue mãi
+    deadline = time.monotonic() + timeout
+    while True:
+        try: return result_queue.get(timeout=RESULT_POLL)
+        except queue.Empty: pass
+        if not proc.is_alive():
+            try: return result_queue.get(timeout=RESULT_POLL)  # kết quả có thể tới ngay trước khi process thoát
+            except queue.Empty: raise RuntimeError(f"{what}: process thoát (exitcode {proc.exitcode}) mà không trả kết quả")
+        if time.monotonic() >= deadline:
+            proc.terminate(); proc.join(STOP_TIMEOUT)
+            raise RuntimeError(f"{what}: quá {timeout:.0f}s không có kết quả")
+
+
+def bench_analysis(cases, workdir):
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for bpm, duration in cases:
+        path = os.path.join(workdir, f"click_{bpm}_{int(duration)}.wav")
+        reference = make_click_track(path, bpm, duration)
+        result_queue = ctx.Queue()
+        proc = ctx.Process(target=_analysis_worker, args=(path, result_queue))
+        proc.start()
+        try: r = _get_result(proc, result_queue, ANALYSIS_TIMEOUT, f"analysis {bpm}bpm_{int(duration)}s")
+        except RuntimeError as e:
+            proc.join(); os.remove(path)
+            print(f"  analysis {bpm}bpm_{int(duration)}s: LỖI {e}")
+            results.append({"case": f"{bpm}bpm_{int(duration)}s", "bpm": bpm, "duration": duration, "success": False, "error": str(e)})
+            continue
+        proc.join()
+        os.remove(path)
+        case = {"case": f"{bpm}bpm_{int(duration)}s", "bpm": bpm, "duration": duration, "streaming": r["streaming"],
+                "seconds": r["seconds"], "realtime_factor": duration / r["seconds"] if r["seconds"] else 0.0,
+                "peak_rss_mb": r["peak_rss_mb"], "import_rss_mb": r["import_rss_mb"], "success": r["success"]}
+        if r["success"]:
+            case.update({"tempo": r["tempo"], "tempo_error": abs(r["tempo"] - bpm), "beats": len(r["beats"]),
+                         "reference_beats": len(reference), "f_measure": f_measure(r["beats"], reference)})
+        else: case["error"] = r["error"]
+        print(f"  analysis {case['case']:>14}: {case['seconds']:6.2f}s  peak {case['peak_rss_mb']:7.1f} MB  "
+              f"F {case.get('f_measure', 0.0):.3f}  tempo {case.get('tempo', 0.0):.1f}")
+        results.append(case)
+    return results
+
+
+def _receiver(port, ready, stop, result_queue):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.bind(('', port))
+    from sender_engine import MULTICAST_GROUP
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(MULTICAST_GROUP) + socket.inet_aton(LOOPBACK_IP))
+    sock.settimeout(0.05)
+    ready.set()
+    count = 0
+    while not stop.is_set():
+        try:
+            while True: sock.recv(64); count += 1
+        except socket.timeout: pass
+    result_queue.put(count)
+
+
+def _sender_program(mode, duration):
+    from timeline import compile_timeline
+    from sender_engine import BeatProgram, BlinkProgram, StaticProgram, CMD_BEAT_SYNC
+    if mode in ("beat", "beat_stress"):
+        rate = STRESS_RATE if mode == "beat_stress" else BEAT_RATE
+        times = np.arange(0.0, duration, 1.0 / rate)
+        beats = list(zip(times.tolist(), np.linspace(0.0, 1.0, len(times)).tolist()))
+        return BeatProgram({"filename": f"bench_{mode}", "beats": beats, "tempo": rate * 60, "timeline": compile_timeline(f"bench_{mode}", beats, CMD_BEAT_SYNC, seed=0)})
+    if mode == "blink": return BlinkProgram()
+    return StaticProgram(255, 0, 0)
+
+
+def bench_sender(modes):
+    from sender_engine import SenderEngine, MULTICAST_PORT
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    engine = SenderEngine()
+    for mode, duration in modes.items():
+        ready, stop, result_queue = ctx.Event(), ctx.Event(), ctx.Queue()
+        rx = ctx.Process(target=_receiver, args=(MULTICAST_PORT, ready, stop, result_queue)); rx.start(); ready.wait(10)
+        program = _sender_program(mode, duration)
+        start_count = engine.sent_count
+        usage0 = resource.getrusage(resource.RUSAGE_SELF); t0 = time.perf_counter()
+        engine.submit(program, LOOPBACK_IP)
+        time.sleep(duration)
+        engine.stop()
+        usage1 = resource.getrusage(resource.RUSAGE_SELF); elapsed = time.perf_counter() - t0
+        timing = engine.scheduler.stats()
+        sent = engine.sent_count - start_count
+        time.sleep(0.2); stop.set()
+        try: received = _get_result(rx, result_queue, RECEIVER_TIMEOUT, f"receiver {mode}"); receiver_error = None
+        except RuntimeError as e: received = None; receiver_error = str(e); print(f"  sender {mode:>12}: LỖI {e}")
+        rx.join()
+        cpu = (usage1.ru_utime - usage0.ru_utime) + (usage1.ru_stime - usage0.ru_stime)
+        case = {"mode": mode, "seconds": elapsed, "sent": sent, "received": received, "pkts_per_s": sent / elapsed,
+                "cpu_seconds": cpu, "cpu_percent": 100.0 * cpu / elapsed, **timing}
+        if receiver_error: case["receiver_error"] = receiver_error
+        print(f"  sender {mode:>12}: {case['pkts_per_s']:8.1f} pkt/s  nhận {received}/{sent}  p99 {timing['p99_ms']:.3f} ms  "
+              f"max {timing['max_ms']:.3f} ms  CPU {case['cpu_percent']:.1f}%")
+        results.append(case)
+    engine.shutdown()
+    return results
+
+
+def _http(path, payload=None, timeout=1.0):
+    import urllib.request
+    data = json.dumps(payload).encode() if payload is not None else None
+    req = urllib.request.Request(f"http://127.0.0.1:{STARTUP_PORT}{path}", data=data, headers={"Content-Type": "application/json"} if data else {})
+    with urllib.request.urlopen(req, timeout=timeout) as resp: return json.loads(resp.read())
+
+
+def _wait_for(check, t0, what):
+    while time.perf_counter() - t0 < STARTUP_TIMEOUT:
+        try:
+            result = check()
+            if result: return result
+        except OSError: pass
+        time.sleep(STARTUP_POLL)
+    raise RuntimeError(f"Quá {STARTUP_TIMEOUT}s chờ {what}")
+
+
+def _stop_server(proc):
+    # SIGINT như Ctrl+C để web.py chạy shutdown_server() (terminate bỏ qua atexit -> worker phân tích mồ côi);
+    # server chạy trong session riêng nên process nào còn sót trong nhóm đều bị giết cùng
+    proc.send_signal(signal.SIGINT)
+    try: proc.wait(STOP_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        print(f"  web.py không dừng sau {STOP_TIMEOUT}s, kill")
+        proc.kill(); proc.wait()
+    try: os.killpg(proc.pid, 0)
+    except ProcessLookupError: return
+    print("  còn process con của web.py sau khi dừng, kill cả nhóm")
+    os.killpg(proc.pid, signal.SIGKILL)
+
+
+def bench_startup(prewarm):
+    # Khởi động lại web.py như sau crash giữa show: thời gian tới khi HTTP trả lời, tới gói đầu tiên
+    # (POST /set_color ngay khi HTTP lên) và tới khi mọi worker phân tích đã làm nóng
+    from sender_engine import MULTICAST_GROUP, MULTICAST_PORT
+    rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    rx.bind(('', MULTICAST_PORT))
+    rx.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(MULTICAST_GROUP) + socket.inet_aton(LOOPBACK_IP))
+    rx.settimeout(STARTUP_TIMEOUT)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web.py')
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ, ANALYSIS_PREWARM='1' if prewarm else '0')
+        t0 = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, script], cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        try:
+            _wait_for(lambda: _http('/status'), t0, "HTTP")
+            http_s = time.perf_counter() - t0
+            _http('/set_color', {"ip": LOOPBACK_IP, "r": 255, "g": 0, "b": 0})
+            rx.recv(64); first_packet_s = time.perf_counter() - t0
+            stats = _http('/stats')["analysis_workers"]
+            if prewarm: stats = _wait_for(lambda: (lambda w: w if w["ready"] >= w["workers"] else None)(_http('/stats')["analysis_workers"]), t0, "worker làm nóng")
+            ready_s = time.perf_counter() - t0 if prewarm else None
+        finally:
+            _stop_server(proc)
+            rx.close()
+    case = {"mode": "prewarm" if prewarm else "lazy", "http_ms": http_s * 1000, "first_packet_ms": first_packet_s * 1000,
+            "stack_loaded_in_server": stats["stack_loaded_in_server"], "workers": stats["workers"]}
+    if ready_s is not None: case["workers_ready_ms"] = ready_s * 1000
+    print(f"  startup {case['mode']:>8}: HTTP {case['http_ms']:7.0f} ms  gói đầu {case['first_packet_ms']:7.0f} ms"
+          + (f"  worker sẵn sàng {case['workers_ready_ms']:7.0f} ms" if ready_s is not None else "")
+          + f"  librosa trong server: {case['stack_loaded_in_server']}")
+    return case
+
+
+def _git_version():
+    try: return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, timeout=5, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.SubprocessError): return ""
+
+
+def compare_reports(old, new):
+    # In chênh lệch các chỉ số chính, ghép theo tên case/mode
+    for section, key in (("analysis", "case"), ("sender", "mode"), ("startup", "mode")):
+        old_cases = {c[key]: c for c in old.get(section, [])}
+        for case in new.get(section, []):
+            base = old_cases.get(case[key])
+            if base is None: continue
+            parts = []
+            for metric in COMPARE_METRICS[section]:
+                if metric not in case or metric not in base: continue
+                delta = case[metric] - base[metric]
+                pct = f" ({delta / base[metric] * 100:+.1f}%)" if base[metric] else ""
+                parts.append(f"{metric} {base[metric]:.3f} -> {case[metric]:.3f}{pct}")
+            print(f"  {section} {case[key]}: " + ", ".join(parts))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark phân tích beat và độ chính xác gửi gói")
+    parser.add_argument('--quick', action='store_true', help="ít case, thời gian ngắn")
+    parser.add_argument('--out', help="ghi báo cáo JSON")
+    parser.add_argument('--compare', help="so sánh với báo cáo JSON trước đó")
+    parser.add_argument('--skip-analysis', action='store_true')
+    parser.add_argument('--skip-sender', action='store_true')
+    parser.add_argument('--skip-startup', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    report = {"version": _git_version(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+              "platform": platform.platform(), "cpu_count": os.cpu_count(), "quick": args.quick}
+    if not args.skip_analysis:
+        print("Phân tích beat:")
+        with tempfile.TemporaryDirectory() as workdir:
+            report["analysis"] = bench_analysis(QUICK_ANALYSIS_CASES if args.quick else ANALYSIS_CASES, workdir)
+    if not args.skip_sender:
+        print("Sender (loopback multicast):")
+        report["sender"] = bench_sender(QUICK_SENDER_MODES if args.quick else SENDER_MODES)
+    if not args.skip_startup:
+        print("Khởi động (time-to-first-packet):")
+        report["startup"] = [bench_startup(prewarm) for prewarm in (False, True)]
+    if args.out:
+        with open(args.out, 'w') as f: json.dump(report, f, indent=2)
+        print(f"Đã ghi báo cáo: {args.out}")
+    if args.compare:
+        with open(args.compare) as f: old = json.load(f)
+        print(f"So sánh với {args.compare} ({old.get('version', '?')}):")
+        compare_reports(old, report)
@@ -0,0 +1,80 @@
+import socket
+import struct
+import logging
+import threading
+
+from scheduler import clock_ns
+
+logger = logging.getLogger()
+
+CLOCK_SYNC_PORT = 1235
+CMD_CLOCK_SYNC_REQUEST = 0x10
+CMD_CLOCK_SYNC_REPLY = 0x11
+# Khớp struct ClockSyncPacket trong firmware_esp32/src/main.cpp
+CLOCK_SYNC_PACKET = struct.Struct('<B3xIII')
+WIRE_MASK = 0xFFFFFFFF
+
+# Đồng hồ chung server <-> gậy: µs kể từ lúc server khởi động, quay vòng 32 bit trên dây
+# (gậy so sánh bằng hiệu int32 nên chỉ cần các mốc cách nhau < 35 phút)
+EPOCH_NS = clock_ns()
+
+
+def server_time_us():
+    return (clock_ns() - EPOCH_NS) // 1000
+
+
+def to_server_us(ns):
+    # ns theo clock_ns() của scheduler -> µs đồng hồ chung
+    return (ns - EPOCH_NS) // 1000
+
+
+class ClockSyncServer:
+    # Trả lời yêu cầu đồng bộ (unicast) của từng gậy: t1 ngay sau khi nhận, t2 ngay trước khi gửi
+    def __init__(self, port=CLOCK_SYNC_PORT, host=''):
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.invalid = 0
+        self._sock = None
+        self._thread = None
+        self._stop = False
+
+    def start(self):
+        if self._thread is not None: return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind((self.host, self.port))
+        except OSError as e:
+            sock.close()
+            logger.error(f"ClockSync: không bind được cổng {self.port}: {e}")
+            return
+        sock.settimeout(0.5)
+        self._sock = sock
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="ClockSyncThread", daemon=True)
+        self._thread.start()
+        logger.info(f"ClockSync: lắng nghe cổng {self.port}")
+
+    def _run(self):
+        while not self._stop:
+            try: data, addr = self._sock.recvfrom(64)
+            except socket.timeout: continue
+            except OSError: break
+            t1 = server_time_us()
+            if len(data) != CLOCK_SYNC_PACKET.size or data[0] != CMD_CLOCK_SYNC_REQUEST:
+                self.invalid += 1; continue
+            _, t0, _, _ = CLOCK_SYNC_PACKET.unpack(data)
+            reply = bytearray(CLOCK_SYNC_PACKET.pack(CMD_CLOCK_SYNC_REPLY, t0, t1 & WIRE_MASK, 0))
+            struct.pack_into('<I', reply, 12, server_time_us() & WIRE_MASK)
+            try: self._sock.sendto(reply, addr); self.requests += 1
+            except OSError as e: logger.warning(f"ClockSync: lỗi trả lời {addr}: {e}")
+
+    def stop(self):
+        if self._thread is None: return
+        self._stop = True
+        self._thread.join(timeout=1.0)
+        self._thread = None
+        self._sock.close(); self._sock = None
+
+    def stats(self):
+        return {"port": self.port, "running": self._thread is not None, "requests": self.requests, "invalid": self.invalid}
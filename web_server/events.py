@@ -0,0 +1,119 @@
+import json
+import queue
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger()
+
+HISTORY_SIZE = 256
+SUBSCRIBER_QUEUE_SIZE = 256
+HEARTBEAT_INTERVAL = 15.0
+SAMPLE_INTERVAL = 0.25
+
+
+def sse_format(kind, data, event_id=None):
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {kind}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+class _Subscriber:
+    def __init__(self):
+        self.queue = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+        self.dropped = False
+
+
+class EventBus:
+    # Trạng thái hiển thị theo từng loại (mode, queue, ip, server_error...) kèm version tăng dần.
+    # set() chỉ tăng version khi giá trị thực sự đổi; version dùng làm ETag và id SSE.
+    # push() cho dữ liệu nhất thời (vị trí beat): chỉ đẩy tới client SSE, không tăng version.
+    def __init__(self):
+        self.version = 0
+        self.state = {}
+        self.history = deque(maxlen=HISTORY_SIZE)
+        self.subscribers = set()
+        self._lock = threading.Lock()
+
+    def set(self, kind, data):
+        with self._lock:
+            if self.state.get(kind) == data: return False
+            self.version += 1
+            self.state[kind] = data
+            event = sse_format(kind, data, self.version)
+            self.history.append((self.version, event))
+            self._broadcast(event)
+            return True
+
+    def push(self, kind, data):
+        with self._lock: self._broadcast(sse_format(kind, data))
+
+    def _broadcast(self, event):
+        for sub in list(self.subscribers):
+            try: sub.queue.put_nowait(event)
+            except queue.Full:
+                # Client quá chậm: ngắt luồng, trình duyệt tự kết nối lại với Last-Event-ID
+                sub.dropped = True; self.subscribers.discard(sub)
+
+    def snapshot(self):
+        with self._lock: return self.version, dict(self.state)
+
+    def subscribe(self, last_event_id=None):
+        # Trả về (subscriber, các event khởi đầu): replay từ history nếu còn đủ, không thì một snapshot
+        sub = _Subscriber()
+        with self._lock:
+            self.subscribers.add(sub)
+            if last_event_id is not None and self.history and self.history[0][0] <= last_event_id + 1:
+                initial = [event for version, event in self.history if version > last_event_id]
+            else:
+                initial = [sse_format('snapshot', self.state, self.version)]
+        return sub, initial
+
+    def unsubscribe(self, sub):
+        with self._lock: self.subscribers.discard(sub)
+
+    def stream(self, last_event_id=None):
+        sub, initial = self.subscribe(last_event_id)
+        try:
+            for event in initial: yield event
+            while not sub.dropped:
+                try: yield sub.queue.get(timeout=HEARTBEAT_INTERVAL)
+                except queue.Empty: yield ": ping\n\n"
+        finally:
+            self.unsubscribe(sub)
+
+
+class StatusSampler:
+    # Thread nền đọc trạng thái sender vài lần/giây và đẩy phần thay đổi lên bus,
+    # để vòng gửi gói không phải tự phát sự kiện cho mỗi beat. wake(): lấy mẫu ngay (vd. hàng đợi vừa đổi)
+    def __init__(self, bus, sample, interval=SAMPLE_INTERVAL):
+        self.bus = bus
+        self.sample = sample
+        self.interval = interval
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None: return
+        self._thread = threading.Thread(target=self._run, name="StatusSamplerThread", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        last_progress = None
+        while True:
+            self._wake.wait(self.interval); self._wake.clear()
+            if self._stop.is_set(): break
+            try:
+                state, progress = self.sample()
+                for kind, data in state.items(): self.bus.set(kind, data)
+                if progress != last_progress:
+                    if progress is not None: self.bus.push('beat', progress)
+                    last_progress = progress
+            except Exception as e: logger.error(f"StatusSampler: lỗi: {e}")
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set(); self._wake.set()
+        if self._thread is not None: self._thread.join(timeout=1.0); self._thread = None
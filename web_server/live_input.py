@@ -0,0 +1,306 @@
+import sys
+import time
+import wave
+import queue
+import logging
+import argparse
+import threading
+import colorsys
+from collections import deque
+
+import numpy as np
+
+from scheduler import clock_ns
+from sender_engine import Program, CMD_BEAT_SYNC
+
+logger = logging.getLogger()
+
+# Chế độ live: âm thanh vào (thiết bị hoặc luồng PCM/WAV qua pipe) -> onset nhân quả -> gói CMD_BEAT_SYNC.
+# Frame ngắn (512 mẫu, hop 128) để độ trễ thuật toán chỉ vài ms; ngân sách tính từ lúc mẫu cuối
+# của frame phát hiện onset được thu tới lúc gói rời server.
+LIVE_N_FFT = 512
+LIVE_HOP = 128
+LIVE_BLOCK = 256
+LIVE_LATENCY_BUDGET_MS = 20.0
+LIVE_COMPRESSION = 100.0       # log(1 + C * |X|) như SuperFlux, bớt nhạy với âm lượng
+LIVE_MAX_FILTER_BINS = 3       # max filter theo tần số trên frame trước: bỏ qua rung/vibrato
+LIVE_THRESHOLD_WINDOW_S = 1.0
+LIVE_THRESHOLD_STD = 2.0
+LIVE_MIN_FLUX = 0.05
+LIVE_MIN_INTERVAL_S = 0.1
+LIVE_STRENGTH_DECAY = 0.999    # mỗi frame; max động để chuẩn hoá cường độ 0..1
+LIVE_HUE_STEP = 0.618034
+LIVE_MIN_INTENSITY = 0.3
+LIVE_QUEUE_BLOCKS = 64
+LIVE_STOP_JOIN_S = 0.05        # chờ thread đọc tự thoát trước khi đóng nguồn (pipe/thiết bị đang chặn)
+PCM_SAMPLE_WIDTH = 2
+
+
+class OnsetDetector:
+    # Spectral flux kiểu SuperFlux, chỉ dùng quá khứ: so phổ log hiện tại với max-filter của frame trước
+    # (phần tăng đột ngột, băng rộng = percussive), ngưỡng thích nghi mean + k*std của ~1 s gần nhất,
+    # bắn ở sườn lên khi vượt ngưỡng, có thời gian chết LIVE_MIN_INTERVAL_S.
+    def __init__(self, sr, n_fft=LIVE_N_FFT, hop=LIVE_HOP):
+        self.sr = sr
+        self.n_fft = n_fft
+        self.hop = hop
+        self.window = np.hanning(n_fft).astype(np.float32)
+        self.tail = np.zeros(n_fft - hop, dtype=np.float32)
+        self.prev = None
+        self.history = deque(maxlen=max(8, int(LIVE_THRESHOLD_WINDOW_S * sr / hop)))
+        self.above = False
+        self.peak = LIVE_MIN_FLUX
+        self.samples_seen = 0        # frame kế tiếp kết thúc ở mẫu thật samples_seen + hop
+        self.last_onset = -sys.maxsize
+        self.min_interval = int(LIVE_MIN_INTERVAL_S * sr)
+
+    def push(self, samples):
+        # Trả về [(chỉ số mẫu cuối của frame phát hiện, cường độ 0..1)] cho các onset trong khối này
+        data = np.concatenate([self.tail, samples.astype(np.float32, copy=False)])
+        n_frames = (len(data) - self.n_fft) // self.hop + 1
+        if n_frames <= 0:
+            self.tail = data; return []
+        frames = np.lib.stride_tricks.sliding_window_view(data, self.n_fft)[::self.hop][:n_frames]
+        spec = np.log1p(LIVE_COMPRESSION * np.abs(np.fft.rfft(frames * self.window, axis=1)))
+        consumed = n_frames * self.hop
+        self.tail = data[consumed:]
+        first_end = self.samples_seen + self.hop
+        self.samples_seen += consumed
+
+        # Max filter theo tần số của frame trước, vector hoá cho cả khối
+        pad = LIVE_MAX_FILTER_BINS // 2
+        prev = np.vstack([spec[:1] if self.prev is None else self.prev, spec[:-1]])
+        padded = np.pad(prev, ((0, 0), (pad, pad)), mode='edge')
+        prev_max = np.lib.stride_tricks.sliding_window_view(padded, LIVE_MAX_FILTER_BINS, axis=1).max(axis=2)
+        flux = np.maximum(0.0, spec - prev_max).mean(axis=1)
+        self.prev = spec[-1:]
+
+        onsets = []
+        for i, value in enumerate(flux.tolist()):
+            end = first_end + i * self.hop
+            if len(self.history) >= 8:
+                hist = np.fromiter(self.history, dtype=np.float64, count=len(self.history))
+                threshold = max(LIVE_MIN_FLUX, hist.mean() + LIVE_THRESHOLD_STD * hist.std())
+            else: threshold = float('inf')
+            self.peak = max(value, self.peak * LIVE_STRENGTH_DECAY)
+            crossing = value > threshold
+            if crossing and not self.above and end - self.last_onset >= self.min_interval:
+                self.last_onset = end
+                onsets.append((end, min(1.0, value / self.peak)))
+            self.above = crossing
+            self.history.append(value)
+        return onsets
+
+
+class PcmStreamSource:
+    # Đọc PCM 16-bit từ file/pipe: WAV (đọc header) hoặc raw s16le khi cho sẵn sample_rate.
+    # realtime=True: phát theo tốc độ thật (file trên đĩa); pipe từ arecord/ffmpeg -re tự giữ nhịp.
+    def __init__(self, stream, sample_rate=None, channels=1, realtime=False, block=LIVE_BLOCK):
+        self.stream = stream
+        self.realtime = realtime
+        self.block = block
+        self.wav = None
+        if sample_rate is None:
+            try: self.wav = wave.open(stream, 'rb')
+            except (wave.Error, EOFError) as e: stream.close(); raise ValueError(f"WAV không hợp lệ: {e}")
+            if self.wav.getsampwidth() != PCM_SAMPLE_WIDTH: stream.close(); raise ValueError(f"Chỉ hỗ trợ PCM 16-bit (sampwidth={self.wav.getsampwidth()})")
+            sample_rate = self.wav.getframerate(); channels = self.wav.getnchannels()
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self._closed = False
+
+    def describe(self):
+        return f"pcm {self.sample_rate} Hz x{self.channels}{' realtime' if self.realtime else ''}"
+
+    def blocks(self):
+        # Sinh (mẫu mono float32, clock_ns lúc thu mẫu cuối của khối)
+        frame_bytes = PCM_SAMPLE_WIDTH * self.channels
+        start_ns = clock_ns(); read = 0
+        while not self._closed:
+            data = self.wav.readframes(self.block) if self.wav else self.stream.read(self.block * frame_bytes)
+            if not data: return
+            data = data[:len(data) - len(data) % frame_bytes]
+            samples = np.frombuffer(data, dtype='<i2').reshape(-1, self.channels).mean(axis=1, dtype=np.float32) / 32768.0
+            read += len(samples)
+            if self.realtime:
+                # Mẫu cuối của khối "được thu" ở start + read/sr, như khi đến từ ADC
+                capture_ns = start_ns + int(read * 1e9 / self.sample_rate)
+                delay = capture_ns - clock_ns()
+                if delay > 0: time.sleep(delay / 1e9)
+                yield samples, capture_ns
+            else: yield samples, clock_ns()
+
+    def close(self):
+        self._closed = True
+        try: self.stream.close()
+        except (OSError, ValueError): pass
+
+
+class DeviceSource:
+    # Thiết bị thu âm qua sounddevice (tuỳ chọn); callback đẩy khối + thời điểm ADC vào queue.
+    # Mở thiết bị ngay khi tạo (lỗi thiết bị/SR báo về người gọi), chỉ bắt đầu thu trong blocks()
+    def __init__(self, device=None, sample_rate=44100, block=LIVE_BLOCK):
+        try: import sounddevice
+        except ImportError: raise RuntimeError("Thiếu sounddevice: pip install sounddevice")
+        self.device = device
+        self.sample_rate = sample_rate
+        self.block = block
+        self.queue = queue.Queue(LIVE_QUEUE_BLOCKS)
+        self.overflows = 0
+        try:
+            self._stream = sounddevice.InputStream(device=device, channels=1, samplerate=sample_rate, blocksize=block,
+                                                   dtype='float32', latency='low', callback=self._callback)
+        except Exception as e: raise RuntimeError(f"Không mở được thiết bị thu âm {device if device is not None else 'mặc định'}: {e}")
+
+    def describe(self):
+        return f"device {self.device if self.device is not None else 'default'} {self.sample_rate} Hz"
+
+    def _callback(self, indata, frames, time_info, status):
+        now_ns = clock_ns()
+        if status: self.overflows += 1
+        # Quy thời điểm ADC của mẫu cuối về clock_ns(): lùi theo khoảng cách tới currentTime
+        age_s = max(0.0, time_info.currentTime - time_info.inputBufferAdcTime - (frames - 1) / self.sample_rate)
+        try: self.queue.put_nowait((indata[:, 0].copy(), now_ns - int(age_s * 1e9)))
+        except queue.Full: self.overflows += 1
+
+    def blocks(self):
+        stream = self._stream
+        if stream is None: return
+        stream.start()
+        while self._stream is not None:
+            try: item = self.queue.get(timeout=0.5)
+            except queue.Empty: continue
+            if item is None: return
+            yield item
+
+    def close(self):
+        stream, self._stream = self._stream, None
+        if stream is not None: stream.stop(); stream.close()
+        try: self.queue.put_nowait(None)
+        except queue.Full: pass
+
+
+class LiveInput:
+    # Thread đọc nguồn âm thanh + chạy OnsetDetector; mỗi onset gọi on_onset(cường độ, clock_ns lúc thu)
+    def __init__(self, source, on_onset, on_end=None):
+        self.source = source
+        self.on_onset = on_onset
+        self.on_end = on_end
+        self.detector = OnsetDetector(source.sample_rate)
+        self.onsets = 0
+        self.received = 0
+        self._thread = None
+        self._stop = False
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="LiveInputThread", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        sr = self.source.sample_rate
+        try:
+            for samples, capture_ns in self.source.blocks():
+                if self._stop: break
+                self.received += len(samples)
+                for end, strength in self.detector.push(samples):
+                    self.onsets += 1
+                    # Mẫu cuối frame phát hiện nằm trước mẫu cuối khối một đoạn (received - end) mẫu
+                    self.on_onset(strength, capture_ns - int((self.received - end) * 1e9 / sr))
+        except Exception as e:
+            # Nguồn bị stop() đóng giữa lúc đọc: lỗi đọc là bình thường khi dừng
+            if not self._stop: logger.error(f"Live input: lỗi đọc nguồn âm thanh: {e}", exc_info=True)
+        finally:
+            self.source.close()
+            if not self._stop:
+                logger.info(f"Live input: hết luồng âm thanh sau {self.onsets} onset.")
+                if self.on_end: self.on_end()
+
+    def stop(self):
+        # Gọi từ thread gửi: báo dừng trước, cho thread đọc xong khối hiện tại và tự đóng nguồn;
+        # chỉ đóng từ đây khi nó còn chặn ở read() (pipe/thiết bị không có dữ liệu). Thread daemon.
+        self._stop = True
+        if self._thread is not None: self._thread.join(LIVE_STOP_JOIN_S)
+        if self._thread is None or self._thread.is_alive(): self.source.close()
+
+
+class LiveProgram(Program):
+    mode = 'live'
+    keep_alive = (CMD_BEAT_SYNC, 0, 0, 0)
+
+    def __init__(self, source, budget_ms=LIVE_LATENCY_BUDGET_MS):
+        self.source = source
+        self.budget_ms = budget_ms
+        self.live = None
+        self.finished = False
+        self.onsets = 0
+        self.over_budget = 0
+
+    def begin(self, engine):
+        self.scheduler = engine.scheduler
+        self.scheduler.start()
+        self.onsets = 0; self.over_budget = 0; self.finished = False
+        # Thread đọc âm thanh không tự gửi: đẩy lệnh 'onset' vào hàng lệnh, thread gửi thức ngay và gửi gói.
+        # Lệnh mang theo program gửi nó: onset/finish còn trong hàng của live trước không áp cho live mới
+        self.live = LiveInput(self.source, lambda strength, capture_ns: engine.notify('onset', self, strength, capture_ns),
+                              lambda: engine.notify('finish', self))
+        self.live.start()
+        logger.info(f"Sender (Live): nhận âm thanh từ {self.source.describe()}, ngân sách {self.budget_ms:.0f} ms...")
+
+    def end(self, engine):
+        # Chưa begin (SenderEngine từ chối program, vd. lỗi socket): vẫn đóng nguồn đã mở
+        if self.live is not None: self.live.stop()
+        else: self.source.close()
+
+    def onset(self, engine, owner, strength, capture_ns):
+        if owner is not self: return
+        r, g, b = (int(c * 255) for c in colorsys.hsv_to_rgb((self.onsets * LIVE_HUE_STEP) % 1.0, 1.0, LIVE_MIN_INTENSITY + (1.0 - LIVE_MIN_INTENSITY) * strength))
+        self.onsets += 1
+        if not engine.send_udp_packet(CMD_BEAT_SYNC, r, g, b, due_ns=capture_ns): return
+        self.scheduler.record(capture_ns, engine.last_sent_ns)
+        if (engine.last_sent_ns - capture_ns) / 1e6 > self.budget_ms: self.over_budget += 1
+
+    def finish(self, engine, owner):
+        if owner is self: self.finished = True
+
+    def next_due_ns(self):
+        # Không có lịch beat; khi nguồn hết, fire() ngay để về idle
+        return 0 if self.finished else None
+
+    def fire(self, engine):
+        return False
+
+    def progress(self):
+        lateness = self.scheduler.lateness
+        return {"source": self.source.describe(), "onsets": self.onsets, "budget_ms": self.budget_ms, "over_budget": self.over_budget,
+                "within_budget": lateness.within_ns(int(self.budget_ms * 1e6)), "latency_p50_ms": lateness.percentile_ns(0.5) / 1e6,
+                "latency_p99_ms": lateness.percentile_ns(0.99) / 1e6, "latency_max_ms": lateness.max_ns / 1e6}
+
+
+if __name__ == '__main__':
+    # Chạy độc lập: python live_input.py --wav song.wav --ip 127.0.0.1 | arecord -f S16_LE -r 44100 | python live_input.py --wav -
+    from sender_engine import SenderEngine
+    parser = argparse.ArgumentParser(description="Chế độ live: onset từ âm thanh vào -> gói beat multicast")
+    parser.add_argument('--wav', help="file WAV hoặc '-' (stdin)")
+    parser.add_argument('--raw', help="PCM s16le thô: file hoặc '-' (stdin), cần --rate")
+    parser.add_argument('--rate', type=int, default=44100)
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('--device', help="tên/số thiết bị sounddevice")
+    parser.add_argument('--realtime', action='store_true', help="đọc file theo tốc độ thật")
+    parser.add_argument('--ip', default='127.0.0.1')
+    parser.add_argument('--budget-ms', type=float, default=LIVE_LATENCY_BUDGET_MS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.wav: source = PcmStreamSource(sys.stdin.buffer if args.wav == '-' else open(args.wav, 'rb'), realtime=args.realtime)
+    elif args.raw: source = PcmStreamSource(sys.stdin.buffer if args.raw == '-' else open(args.raw, 'rb'), args.rate, args.channels, realtime=args.realtime)
+    else: source = DeviceSource(int(args.device) if args.device and args.device.isdigit() else args.device, args.rate)
+    engine = SenderEngine()
+    program = LiveProgram(source, args.budget_ms)
+    engine.submit(program, args.ip)
+    try:
+        while engine.mode == 'live': time.sleep(0.5)
+    except KeyboardInterrupt: pass
+    progress = program.progress()
+    engine.shutdown()
+    print(f"{progress['onsets']} onset, độ trễ vào->gói p50 {progress['latency_p50_ms']:.2f} ms p99 {progress['latency_p99_ms']:.2f} ms "
+          f"max {progress['latency_max_ms']:.2f} ms, trong ngân sách {progress['within_budget'] * 100:.1f}% ({progress['budget_ms']:.0f} ms)")
@@ -0,0 +1,155 @@
+import os
+import re
+import sys
+import json
+import argparse
+
+import numpy as np
+
+from packet_log import read_packet_log, PACKET_LOG_MAGIC
+
+READ_BLOCK_BYTES = 8 * 1024 * 1024
+OFFSET_WINDOW_S = 60.0
+UDP_TIMEOUT_MS = 6000  # khớp UDP_TIMEOUT trong firmware_esp32/src/main.cpp
+LATENCY_PERCENTILES = (50, 90, 99)
+
+_LINE_PATTERNS = {
+    'SENT': re.compile(rb'LOG,SENT,(\d+),(\d+),(\d+),(\d+),(\d+),(\d+)'),
+    'RECV': re.compile(rb'LOG,RECV,(\d+),(\d+),(\d+),(\d+),(\d+),(\d+)'),
+}
+
+
+def _scan_text_log(path, kind):
+    # Đọc từng khối lớn, regex trên bytes bỏ qua dòng rác (log khác, serial lỗi); chỉ giữ id + thời gian
+    pattern = _LINE_PATTERNS[kind]
+    ids = []; times = []
+    tail = b''
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(READ_BLOCK_BYTES)
+            if not block and not tail: break
+            data = tail + block
+            cut = data.rfind(b'\n') + 1 if block else len(data)
+            tail = data[cut:]
+            rows = pattern.findall(data, 0, cut)
+            if rows:
+                arr = np.array(rows, dtype='S20').astype(np.int64)
+                ids.append(arr[:, 0]); times.append(arr[:, 5])
+            if not block: break
+    if not ids: return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    return np.concatenate(ids), np.concatenate(times)
+
+
+def load_sent(path):
+    # Packet log nhị phân (packet_log.py) hoặc log text có dòng LOG,SENT,...,time_ns
+    with open(path, 'rb') as f: is_binary = f.read(len(PACKET_LOG_MAGIC)) == PACKET_LOG_MAGIC
+    if is_binary:
+        records = read_packet_log(path)
+        ids, sent_ns = records['packet_id'].astype(np.int64), records['sent_ns'].astype(np.int64)
+    else:
+        ids, sent_ns = _scan_text_log(path, 'SENT')
+    order = np.argsort(ids, kind='stable')
+    ids, sent_ns = ids[order], sent_ns[order]
+    keep = np.ones(len(ids), dtype=bool); keep[1:] = ids[1:] != ids[:-1]
+    return ids[keep], sent_ns[keep]
+
+
+def load_recv(path):
+    ids, millis = _scan_text_log(path, 'RECV')
+    order = np.argsort(ids, kind='stable')
+    ids, millis = ids[order], millis[order]
+    keep = np.ones(len(ids), dtype=bool); keep[1:] = ids[1:] != ids[:-1]
+    return ids[keep], millis[keep], int(len(ids) - keep.sum())
+
+
+def _run_lengths(mask):
+    # Độ dài các đoạn True liên tiếp
+    padded = np.concatenate(([False], mask, [False])).astype(np.int8)
+    edges = np.flatnonzero(np.diff(padded))
+    return edges[1::2] - edges[::2]
+
+
+def estimate_offset(sent_ns, recv_ms):
+    # Đồng hồ thiết bị (millis từ lúc bật) lệch so với đồng hồ server. Lấy đường bao dưới của
+    # (recv - sent) theo từng cửa sổ rồi fit tuyến tính: hằng số = offset, hệ số góc = trôi đồng hồ.
+    diff_ns = recv_ms * 1_000_000 - sent_ns
+    t_s = (sent_ns - sent_ns[0]) / 1e9
+    window = np.floor(t_s / OFFSET_WINDOW_S).astype(np.int64)
+    starts = np.flatnonzero(np.concatenate(([True], window[1:] != window[:-1])))
+    mins = np.minimum.reduceat(diff_ns, starts)
+    argmins = np.array([s + np.argmin(diff_ns[s:e]) for s, e in zip(starts, np.append(starts[1:], len(diff_ns)))])
+    if len(starts) >= 2:
+        slope, intercept = np.polyfit(t_s[argmins], mins.astype(np.float64), 1)
+    else:
+        slope, intercept = 0.0, float(mins[0])
+    baseline = intercept + slope * t_s
+    return diff_ns - baseline, intercept, slope
+
+
+def analyze_device(name, sent_ids, sent_ns, recv_ids, recv_ms, duplicates=0):
+    pos = np.searchsorted(sent_ids, recv_ids)
+    pos_clipped = np.minimum(pos, len(sent_ids) - 1)
+    matched = (pos < len(sent_ids)) & (sent_ids[pos_clipped] == recv_ids) if len(sent_ids) else np.zeros(len(recv_ids), bool)
+    report = {"device": name, "received": int(len(recv_ids)), "matched": int(matched.sum()),
+              "unknown_ids": int((~matched).sum()), "duplicates": int(duplicates)}
+    if not matched.any(): return report
+    idx = pos[matched]
+    # Cửa sổ quan sát: từ gói đầu tới gói cuối thiết bị nhận được (thiết bị có thể vào/ra giữa chừng)
+    first, last = idx.min(), idx.max()
+    got = np.zeros(last - first + 1, dtype=bool); got[idx - first] = True
+    bursts = _run_lengths(~got)
+    lengths, counts = np.unique(bursts, return_counts=True) if len(bursts) else (np.zeros(0, int), np.zeros(0, int))
+    report["expected"] = int(len(got))
+    report["lost"] = int((~got).sum())
+    report["loss_rate"] = float((~got).mean())
+    report["burst_loss"] = {"count": int(len(bursts)), "max": int(bursts.max()) if len(bursts) else 0,
+                            "mean": float(bursts.mean()) if len(bursts) else 0.0,
+                            "histogram": {str(int(l)): int(c) for l, c in zip(lengths, counts)}}
+
+    s_ns = sent_ns[idx]; r_ms = recv_ms[matched]
+    order = np.argsort(s_ns, kind='stable'); s_ns = s_ns[order]; r_ms = r_ms[order]
+    latency_ns, offset_ns, drift = estimate_offset(s_ns, r_ms)
+    latency_ms = latency_ns / 1e6
+    report["clock"] = {"offset_ms": float(offset_ns / 1e6), "drift_ppm": float(drift / 1e3)}
+    # Độ trễ một chiều tính so với gói nhanh nhất (không biết độ trễ tuyệt đối khi đồng hồ không đồng bộ)
+    report["latency_ms"] = {"mean": float(latency_ms.mean()), "max": float(latency_ms.max()),
+                            **{f"p{p}": float(v) for p, v in zip(LATENCY_PERCENTILES, np.percentile(latency_ms, LATENCY_PERCENTILES))}}
+    transit_delta = np.abs(np.diff(latency_ms))
+    report["jitter_ms"] = {"std": float(latency_ms.std()), "mean_delta": float(transit_delta.mean()) if len(transit_delta) else 0.0,
+                           "p99_delta": float(np.percentile(transit_delta, 99)) if len(transit_delta) else 0.0}
+    gaps = np.diff(r_ms)
+    report["gaps"] = {"max_ms": int(gaps.max()) if len(gaps) else 0, "over_udp_timeout": int((gaps > UDP_TIMEOUT_MS).sum())}
+    return report
+
+
+def analyze(sent_path, recv_paths):
+    sent_ids, sent_ns = load_sent(sent_path)
+    devices = []
+    for path in recv_paths:
+        recv_ids, recv_ms, duplicates = load_recv(path)
+        devices.append(analyze_device(os.path.splitext(os.path.basename(path))[0], sent_ids, sent_ns, recv_ids, recv_ms, duplicates))
+    return {"sent": int(len(sent_ids)), "devices": devices}
+
+
+def _print_summary(report):
+    print(f"Gói đã gửi: {report['sent']}")
+    for d in report["devices"]:
+        if "expected" not in d:
+            print(f"  {d['device']}: nhận {d['received']}, không ghép được gói nào"); continue
+        lat = d["latency_ms"]; jit = d["jitter_ms"]
+        print(f"  {d['device']}: mất {d['lost']}/{d['expected']} ({d['loss_rate']*100:.2f}%), burst max {d['burst_loss']['max']}, "
+              f"trễ p50 {lat['p50']:.1f} ms p99 {lat['p99']:.1f} ms, jitter {jit['std']:.2f} ms, "
+              f"trôi {d['clock']['drift_ppm']:.1f} ppm, khoảng lặng > UDP_TIMEOUT: {d['gaps']['over_udp_timeout']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Ghép log SENT của server với log RECV (serial) của từng thiết bị")
+    parser.add_argument('--sent', required=True, help="packet log .bin (/packet_log) hoặc log text có dòng LOG,SENT")
+    parser.add_argument('--recv', required=True, nargs='+', help="log serial của từng thiết bị (LOG,RECV,...)")
+    parser.add_argument('--json', help="ghi báo cáo JSON ra file")
+    args = parser.parse_args()
+    result = analyze(args.sent, args.recv)
+    _print_summary(result)
+    if args.json:
+        with open(args.json, 'w') as f: json.dump(result, f, indent=2)
+    sys.exit(0)
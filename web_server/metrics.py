@@ -0,0 +1,186 @@
+import abc
+import math
+import bisect
+import threading
+
+# Counter/histogram kiểu Prometheus đủ rẻ để bật thường trực trên đường gửi gói:
+# mỗi series chỉ một thread ghi (thread gửi, thread callback job...) nên ghi không cần lock,
+# lock chỉ dùng khi tạo series mới. Số đọc lúc scrape có thể lệch 1 mẫu, chấp nhận được.
+
+# Giây. Độ trễ gửi so với mốc hẹn / gọi transport.send(): vài µs tới vài chục ms
+LATENESS_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+SEND_BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005)
+# Thời gian từng giai đoạn / cả job phân tích
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class _CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # ô cuối: +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value): return '+Inf' if value > 0 else '-Inf'
+        if math.isnan(value): return 'NaN'
+    return repr(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _label_text(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra: pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Family(abc.ABC):
+    def __init__(self, name, help_text, kind, labelnames):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+
+    def _header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+    @abc.abstractmethod
+    def render(self): ...
+
+
+class _Series(_Family):
+    # Family tự giữ giá trị theo từng bộ nhãn (Counter, Histogram); Callback đọc giá trị lúc scrape nên không có
+    def __init__(self, name, help_text, kind, labelnames):
+        super().__init__(name, help_text, kind, labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    @abc.abstractmethod
+    def _new(self): ...
+
+    def labels(self, *values):
+        # Đường nóng nên giữ lại object trả về thay vì gọi labels() mỗi gói khi nhãn cố định
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames): raise ValueError(f"{self.name}: cần nhãn {self.labelnames}")
+            with self._lock: child = self._children.setdefault(values, self._new())
+        return child
+
+
+class Counter(_Series):
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, 'counter', labelnames)
+
+    def _new(self): return _CounterValue()
+
+    def inc(self, n=1): self.labels().inc(n)
+
+    def render(self):
+        lines = self._header()
+        for values, child in list(self._children.items()):
+            lines.append(f'{self.name}{_label_text(self.labelnames, values)} {_format_value(child.value)}')
+        return lines
+
+
+class Histogram(_Series):
+    def __init__(self, name, help_text, buckets, labelnames=()):
+        super().__init__(name, help_text, 'histogram', labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new(self): return _HistogramValue(self.buckets)
+
+    def observe(self, value): self.labels().observe(value)
+
+    def render(self):
+        lines = self._header()
+        for values, child in list(self._children.items()):
+            counts = list(child.counts); cumulative = 0
+            for le, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_label_text(self.labelnames, values, ("le", _format_value(float(le))))} {cumulative}')
+            labels = _label_text(self.labelnames, values)
+            lines.append(f'{self.name}_sum{labels} {_format_value(child.sum)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Callback(_Family):
+    # Giá trị lấy lúc scrape từ stats() sẵn có (cache, hàng đợi, đích multicast...): không tốn gì trên đường nóng.
+    # fn() trả về số, hoặc dict {tuple nhãn: số}
+    def __init__(self, name, help_text, kind, fn, labelnames=()):
+        super().__init__(name, help_text, kind, labelnames)
+        self.fn = fn
+
+    def render(self):
+        values = self.fn()
+        if not isinstance(values, dict): values = {(): values}
+        lines = self._header()
+        for label_values, value in values.items():
+            if value is None: continue
+            lines.append(f'{self.name}{_label_text(self.labelnames, label_values)} {_format_value(value)}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def _register(self, family):
+        with self._lock:
+            existing = self._families.get(family.name)
+            if existing is not None:
+                # import lại module (reload/test) dùng lại series cũ thay vì báo trùng
+                if type(existing) is type(family) and existing.labelnames == family.labelnames and not isinstance(family, Callback): return existing
+            self._families[family.name] = family
+        return family
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, buckets, labelnames=()):
+        return self._register(Histogram(name, help_text, buckets, labelnames))
+
+    def gauge_callback(self, name, help_text, fn, labelnames=()):
+        return self._register(Callback(name, help_text, 'gauge', fn, labelnames))
+
+    def counter_callback(self, name, help_text, fn, labelnames=()):
+        return self._register(Callback(name, help_text, 'counter', fn, labelnames))
+
+    def render(self):
+        with self._lock: families = list(self._families.values())
+        lines = []
+        for family in families:
+            try: lines.extend(family.render())
+            except Exception as e: lines.append(f'# {family.name}: lỗi đọc số liệu: {type(e).__name__}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+gauge_callback = REGISTRY.gauge_callback
+counter_callback = REGISTRY.counter_callback
+render = REGISTRY.render
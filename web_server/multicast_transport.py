@@ -0,0 +1,208 @@
+import os
+import sys
+import time
+import errno
+import socket
+import struct
+import logging
+import ctypes
+import ctypes.util
+
+logger = logging.getLogger()
+
+DEST_RETRY_SECONDS = 2.0
+MAX_FRAME_SIZE = 64
+FATAL_ERRNOS = (errno.EADDRNOTAVAIL, errno.ENETUNREACH, errno.EHOSTUNREACH)
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+class _sockaddr_in(ctypes.Structure):
+    _fields_ = [('sin_family', ctypes.c_ushort), ('sin_port', ctypes.c_uint16), ('sin_addr', ctypes.c_uint8 * 4), ('sin_zero', ctypes.c_uint8 * 8)]
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32), ('msg_iov', ctypes.POINTER(_iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t), ('msg_flags', ctypes.c_int)]
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _msghdr), ('msg_len', ctypes.c_uint)]
+
+
+def _load_sendmmsg():
+    if not sys.platform.startswith('linux'): return None  # sockaddr_in của BSD/macOS có sin_len
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        fn = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    fn.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int]
+    fn.restype = ctypes.c_int
+    return fn
+
+_sendmmsg = _load_sendmmsg()
+
+
+def parse_destinations(ips, groups, port):
+    # "192.168.1.10, 10.0.0.2" x ["239.1.1.1", "239.1.1.2"] -> mọi cặp (group, port, iface)
+    if isinstance(ips, str): ips = ips.split(',')
+    ips = [ip.strip() for ip in ips if ip and ip.strip()]
+    groups = [g.strip() for g in groups if g and g.strip()]
+    for addr in ips + groups: socket.inet_aton(addr)
+    return [(group, port, ip) for ip in ips for group in groups]
+
+
+class Destination:
+    def __init__(self, group, port, iface):
+        self.group = group; self.port = port; self.iface = iface
+        self.addr = (group, port)
+        self.sent = 0; self.errors = 0; self.dropped = 0
+        self.last_error = ""
+        self.down_until = 0.0
+
+    def is_up(self, now):
+        return now >= self.down_until
+
+    def fail(self, exc, now):
+        self.errors += 1
+        self.last_error = f"{type(exc).__name__}: {exc}"
+        if getattr(exc, 'errno', None) in FATAL_ERRNOS:
+            if self.down_until <= now: logger.error(f"Transport: {self.group} qua {self.iface} lỗi ({exc}), tạm ngưng {DEST_RETRY_SECONDS}s.")
+            self.down_until = now + DEST_RETRY_SECONDS
+
+    def stats(self):
+        return {"group": self.group, "port": self.port, "iface": self.iface, "sent": self.sent, "errors": self.errors,
+                "dropped": self.dropped, "up": self.is_up(time.monotonic()), "last_error": self.last_error}
+
+
+class _InterfaceEndpoint:
+    # Một socket UDP cho mỗi giao diện; gửi cả lô đích bằng một sendmmsg.
+    # Lỗi lấy đồng bộ từ kết quả sendmmsg/sendto nên gán đúng cho từng đích (UDP không connect
+    # không nhận lỗi ICMP bất đồng bộ khi thiếu IP_RECVERR, nên không dựa vào error_received)
+    def __init__(self, iface, sock):
+        self.iface = iface
+        self.sock = sock
+        self.destinations = []
+        self._frame = (ctypes.c_char * MAX_FRAME_SIZE)()
+        self._iov = _iovec(ctypes.cast(self._frame, ctypes.c_void_p), 0)
+        self._addrs = None
+        self._msgs = None
+
+    def set_destinations(self, destinations):
+        self.destinations = destinations
+        n = len(destinations)
+        self._addrs = (_sockaddr_in * n)()
+        self._msgs = (_mmsghdr * n)()
+        for i, dest in enumerate(destinations):
+            self._addrs[i].sin_family = socket.AF_INET
+            self._addrs[i].sin_port = socket.htons(dest.port)
+            self._addrs[i].sin_addr[:] = list(socket.inet_aton(dest.group))
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self._addrs[i]); hdr.msg_namelen = ctypes.sizeof(_sockaddr_in)
+            hdr.msg_iov = ctypes.pointer(self._iov); hdr.msg_iovlen = 1
+
+    def _send_run(self, frame, start, end):
+        # Gửi dests[start:end] (đều đang lên) -> (số đích đã gửi, lỗi của dests[start + số đã gửi] hoặc None).
+        # sendmmsg dừng ở gói lỗi đầu tiên: trả số gói đã gửi, lần gọi sau trả -1 + errno của đúng gói đó
+        if _sendmmsg is None:
+            try: self.sock.sendto(frame, self.destinations[start].addr)
+            except OSError as e: return 0, e
+            return 1, None
+        sent = _sendmmsg(self.sock.fileno(), ctypes.cast(ctypes.addressof(self._msgs) + start * ctypes.sizeof(_mmsghdr), ctypes.POINTER(_mmsghdr)), end - start, 0)
+        if sent < 0:
+            err = ctypes.get_errno()
+            return 0, OSError(err, os.strerror(err))
+        return sent, None
+
+    def send(self, frame, now):
+        dests = self.destinations
+        if not dests: return 0
+        if _sendmmsg is not None: ctypes.memmove(self._frame, frame, len(frame)); self._iov.iov_len = len(frame)
+        ok = 0; i = 0; n = len(dests)
+        while i < n:
+            if not dests[i].is_up(now): i += 1; continue
+            end = i + 1
+            while end < n and dests[end].is_up(now): end += 1
+            while i < end:
+                sent, error = self._send_run(frame, i, end)
+                for dest in dests[i:i + sent]: dest.sent += 1
+                ok += sent; i += sent
+                if error is None: continue
+                if isinstance(error, BlockingIOError):
+                    # Buffer socket đầy: bỏ gói này cho phần còn lại của lô, gói sau đã mang nhịp mới
+                    for dest in dests[i:end]: dest.dropped += 1
+                    i = end
+                else:
+                    dests[i].fail(error, now); i += 1
+        return ok
+
+
+class MulticastTransport:
+    # Đường gửi nóng gọi send() trực tiếp từ thread sender; socket non-blocking, không cần thread/vòng sự kiện riêng
+    def __init__(self, ttl=1):
+        self.ttl = ttl
+        self.endpoints = {}
+        self.destinations = []
+        self.unavailable = []
+
+    def _endpoint(self, iface):
+        endpoint = self.endpoints.get(iface)
+        if endpoint is not None: return endpoint
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((iface, 0))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(iface))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, struct.pack('b', self.ttl))
+            sock.setblocking(False)
+        except OSError:
+            sock.close(); raise
+        endpoint = _InterfaceEndpoint(iface, sock)
+        logger.info(f"Transport: tạo endpoint multicast, bind IP: {iface}")
+        self.endpoints[iface] = endpoint
+        return endpoint
+
+    def configure(self, destinations):
+        # Lỗi tạo socket của một giao diện không chặn các giao diện khác; chỉ raise khi không còn đích nào,
+        # và khi đó giữ nguyên cấu hình cũ (chế độ đang chạy vẫn gửi tiếp)
+        by_iface = {}
+        errors = []
+        for group, port, iface in destinations:
+            by_iface.setdefault(iface, []).append(Destination(group, port, iface))
+        opened = []; unavailable = []
+        for iface, dests in by_iface.items():
+            try: opened.append((self._endpoint(iface), dests))
+            except OSError as e:
+                logger.error(f"Transport: không mở được giao diện {iface}: {e}")
+                for dest in dests: dest.errors += 1; dest.last_error = f"{type(e).__name__}: {e}"; dest.down_until = float('inf')
+                errors.append(e); unavailable.extend(dests)
+        if not opened and errors: raise errors[0]
+        active = []
+        for endpoint, dests in opened:
+            endpoint.set_destinations(dests)
+            active.extend(dests)
+        for iface, endpoint in self.endpoints.items():
+            if iface not in by_iface: endpoint.set_destinations([])
+        self.destinations = active; self.unavailable = unavailable
+
+    def send(self, frame):
+        frame = bytes(frame)  # memoryview của timeline -> bytes 8 byte cho memmove/sendto
+        now = time.monotonic()
+        ok = 0
+        for endpoint in self.endpoints.values():
+            if endpoint.destinations: ok += endpoint.send(frame, now)
+        return ok
+
+    def all_down(self):
+        now = time.monotonic()
+        return bool(self.destinations) and not any(d.is_up(now) for d in self.destinations)
+
+    def last_error(self):
+        return next((d.last_error for d in self.destinations if d.last_error), "")
+
+    def stats(self):
+        return [d.stats() for d in self.destinations + self.unavailable]
+
+    def close(self):
+        for endpoint in self.endpoints.values(): endpoint.sock.close()
+        self.endpoints = {}
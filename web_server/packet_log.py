@@ -0,0 +1,112 @@
+import os
+import time
+import struct
+import logging
+import threading
+
+import numpy as np
+
+logger = logging.getLogger()
+
+# Một bản ghi / gói gửi. scheduled_ns và sent_ns cùng theo đồng hồ Unix (ns) để ghép với log RECV
+PACKET_LOG_DTYPE = np.dtype([('packet_id', '<u4'), ('command', 'u1'), ('r', 'u1'), ('g', 'u1'), ('b', 'u1'),
+                             ('scheduled_ns', '<i8'), ('sent_ns', '<i8')])
+PACKET_LOG_MAGIC = b'BPPL'
+PACKET_LOG_VERSION = 1
+_HEADER = struct.Struct('<4sHH')  # magic, version, kích thước bản ghi
+
+RING_CAPACITY = 65536
+FLUSH_INTERVAL = 0.5
+
+
+def read_packet_log(path):
+    with open(path, 'rb') as f:
+        magic, version, itemsize = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != PACKET_LOG_MAGIC or version != PACKET_LOG_VERSION or itemsize != PACKET_LOG_DTYPE.itemsize:
+            raise ValueError(f"File packet log không hợp lệ: {path}")
+    return np.memmap(path, dtype=PACKET_LOG_DTYPE, mode='r', offset=_HEADER.size) if os.path.getsize(path) > _HEADER.size \
+        else np.zeros(0, dtype=PACKET_LOG_DTYPE)
+
+
+def iter_csv_lines(path, chunk=RING_CAPACITY):
+    records = read_packet_log(path)
+    yield "packet_id,command,r,g,b,scheduled_ns,sent_ns\n"
+    for start in range(0, len(records), chunk):
+        block = records[start:start + chunk]
+        cols = [block[name].tolist() for name in PACKET_LOG_DTYPE.names]
+        yield "".join(f"{i},{c},{r},{g},{b},{s},{t}\n" for i, c, r, g, b, s, t in zip(*cols))
+
+
+class PacketLog:
+    # Ring buffer một người ghi (thread sender) / một người đọc (thread writer), không khoá:
+    # sender chỉ ghi vào ô head rồi tăng head; writer đọc [tail, head) rồi tăng tail.
+    # Ring đầy thì bỏ bản ghi (đếm dropped), không bao giờ chặn thread sender.
+    def __init__(self, folder, capacity=RING_CAPACITY, flush_interval=FLUSH_INTERVAL):
+        self.folder = folder
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.ring = np.zeros(capacity, dtype=PACKET_LOG_DTYPE)
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+        self.written = 0
+        self.path = None
+        self._file = None
+        self._file_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = False
+        self._thread = None
+        self.wall_offset_ns = time.time_ns() - time.perf_counter_ns()
+
+    def start(self):
+        if self._thread is not None: return
+        os.makedirs(self.folder, exist_ok=True)
+        self.path = os.path.join(self.folder, time.strftime("packets-%Y%m%d-%H%M%S.bin"))
+        self._file = open(self.path, 'wb')
+        self._file.write(_HEADER.pack(PACKET_LOG_MAGIC, PACKET_LOG_VERSION, PACKET_LOG_DTYPE.itemsize))
+        self._file.flush()
+        self._thread = threading.Thread(target=self._run, name="PacketLogWriter", daemon=True)
+        self._thread.start()
+        logger.info(f"Packet log: ghi vào {os.path.abspath(self.path)}")
+
+    def record(self, packet_id, command, r, g, b, scheduled_ns, sent_ns):
+        # scheduled_ns/sent_ns theo perf_counter_ns của scheduler, đổi sang đồng hồ Unix khi ghi
+        head = self.head
+        if head - self.tail >= self.capacity:
+            self.dropped += 1; return
+        self.ring[head % self.capacity] = (packet_id, command, r, g, b, scheduled_ns + self.wall_offset_ns, sent_ns + self.wall_offset_ns)
+        self.head = head + 1
+        if head - self.tail >= self.capacity // 2: self._wake.set()
+
+    def flush(self):
+        with self._file_lock:
+            if self._file is None: return 0
+            head = self.head; tail = self.tail
+            if head == tail: return 0
+            start = tail % self.capacity; end = head % self.capacity
+            if start < end: self._file.write(self.ring[start:end].tobytes())
+            else: self._file.write(self.ring[start:].tobytes()); self._file.write(self.ring[:end].tobytes())
+            self._file.flush()
+            self.tail = head
+            self.written += head - tail
+            return head - tail
+
+    def _run(self):
+        while not self._stop:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try: self.flush()
+            except OSError as e: logger.error(f"Packet log: lỗi ghi file: {e}")
+
+    def close(self):
+        if self._thread is None: return
+        self._stop = True; self._wake.set()
+        self._thread.join(timeout=1.0)
+        self._thread = None
+        self.flush()
+        with self._file_lock:
+            self._file.close(); self._file = None
+
+    def stats(self):
+        return {"path": self.path, "written": self.written, "pending": self.head - self.tail, "dropped": self.dropped,
+                "capacity": self.capacity}
@@ -0,0 +1,113 @@
+import time
+import queue
+
+SPIN_THRESHOLD_NS = 1_500_000
+MAX_COARSE_SLEEP_NS = 50_000_000
+OVERSLEEP_EMA_ALPHA = 0.1
+HISTOGRAM_BIN_NS = 50_000
+HISTOGRAM_MAX_NS = 100_000_000
+SYNC_TARGET_NS = 5_000_000
+
+clock_ns = time.perf_counter_ns
+
+
+class LatenessHistogram:
+    # Histogram cố định (bin 50 µs, tối đa 100 ms + 1 bin tràn), chỉ một thread ghi
+    def __init__(self, bin_ns=HISTOGRAM_BIN_NS, max_ns=HISTOGRAM_MAX_NS):
+        self.bin_ns = bin_ns
+        self.bins = [0] * (max_ns // bin_ns + 1)
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def reset(self):
+        self.bins = [0] * len(self.bins)
+        self.count = 0; self.total_ns = 0; self.max_ns = 0
+
+    def record(self, late_ns):
+        if late_ns < 0: late_ns = 0
+        self.bins[min(late_ns // self.bin_ns, len(self.bins) - 1)] += 1
+        self.count += 1
+        self.total_ns += late_ns
+        if late_ns > self.max_ns: self.max_ns = late_ns
+
+    def percentile_ns(self, q):
+        if self.count == 0: return 0
+        rank = q * self.count; seen = 0
+        for i, n in enumerate(self.bins):
+            seen += n
+            # cận trên của bin, nhưng không vượt mẫu lớn nhất thực tế (p99 <= max); bin tràn không có cận trên -> max
+            if seen >= rank: return self.max_ns if i == len(self.bins) - 1 else min((i + 1) * self.bin_ns, self.max_ns)
+        return self.max_ns
+
+    def within_ns(self, limit_ns):
+        if self.count == 0: return 1.0
+        return sum(self.bins[:limit_ns // self.bin_ns]) / self.count
+
+    def stats(self):
+        return {
+            "count": self.count,
+            "mean_ms": (self.total_ns / self.count / 1e6) if self.count else 0.0,
+            "p50_ms": self.percentile_ns(0.50) / 1e6,
+            "p99_ms": self.percentile_ns(0.99) / 1e6,
+            "max_ms": self.max_ns / 1e6,
+            "within_5ms": self.within_ns(SYNC_TARGET_NS)
+        }
+
+
+class BeatScheduler:
+    # Mọi mốc gửi tính tuyệt đối từ anchor_ns (không cộng dồn từ lần gửi trước) nên không trôi.
+    # Ngủ thô tới trước mốc spin_ns (trừ thêm độ ngủ quá đo được), rồi spin tới đúng mốc.
+    def __init__(self, spin_ns=SPIN_THRESHOLD_NS):
+        self.spin_ns = spin_ns
+        self.oversleep_ns = 0
+        self.anchor_ns = clock_ns()
+        self.lateness = LatenessHistogram()
+
+    def start(self, offset_s=0.0):
+        self.anchor_ns = clock_ns() - int(offset_s * 1e9)
+        self.lateness.reset()
+        return self.anchor_ns
+
+    def reanchor(self, offset_s):
+        # Đặt lại mốc (seek/resume/chỉnh trôi) mà không xoá histogram độ trễ
+        self.anchor_ns = clock_ns() - int(offset_s * 1e9)
+        return self.anchor_ns
+
+    def shift(self, delta_s):
+        self.anchor_ns += int(delta_s * 1e9)
+
+    def due_ns(self, offset_s):
+        return self.anchor_ns + int(offset_s * 1e9)
+
+    def elapsed_s(self):
+        return (clock_ns() - self.anchor_ns) / 1e9
+
+    def wait_until(self, target_ns, inbox=None):
+        # Trả về None khi tới mốc, hoặc message nếu inbox (queue.Queue) có lệnh trong lúc ngủ thô.
+        # target_ns None: không có mốc nào, chỉ chờ inbox.
+        while True:
+            if target_ns is None: return inbox.get()
+            remaining = target_ns - clock_ns()
+            if remaining <= 0: return None
+            coarse = remaining - self.spin_ns - self.oversleep_ns
+            if coarse > 0:
+                coarse = min(coarse, MAX_COARSE_SLEEP_NS)
+                t0 = clock_ns()
+                if inbox is None: time.sleep(coarse / 1e9)
+                else:
+                    try: return inbox.get(timeout=coarse / 1e9)
+                    except queue.Empty: pass
+                over = clock_ns() - t0 - coarse
+                self.oversleep_ns += int(OVERSLEEP_EMA_ALPHA * (max(0, over) - self.oversleep_ns))
+            else:
+                while clock_ns() < target_ns: pass
+                return None
+
+    def record(self, target_ns, sent_ns=None):
+        self.lateness.record((clock_ns() if sent_ns is None else sent_ns) - target_ns)
+
+    def stats(self):
+        stats = self.lateness.stats()
+        stats["oversleep_ms"] = self.oversleep_ns / 1e6
+        return stats
@@ -0,0 +1,562 @@
+import time
+import queue
+import bisect
+import struct
+import logging
+import itertools
+import threading
+
+import metrics
+from scheduler import BeatScheduler, clock_ns
+from multicast_transport import MulticastTransport, parse_destinations
+from clock_sync import to_server_us, WIRE_MASK
+
+logger = logging.getLogger()
+
+MULTICAST_GROUP = '239.1.1.1'
+MULTICAST_PORT = 1234
+KEEP_ALIVE_INTERVAL = 0.9
+KEEP_ALIVE_INTERVAL_NS = int(KEEP_ALIVE_INTERVAL * 1e9)
+BLINK_INTERVAL = 0.5
+SUBMIT_ACK_TIMEOUT = 0.5
+DRIFT_DEADBAND = 0.02  # lệch nhỏ hơn coi như trễ HTTP/độ phân giải currentTime, bỏ qua
+DRIFT_GAIN = 0.5       # mỗi lần báo vị trí chỉ bù một phần độ lệch để tránh giật
+DRIFT_SEEK_THRESHOLD = 0.5  # lệch lớn hơn: người dùng tua, nhảy thẳng tới vị trí mới
+
+CMD_BEAT_SYNC = 0x01
+CMD_FX_BLINK = 0x03
+CMD_FX_STATIC = 0x04
+CMD_BEAT_TIMED = 0x05
+
+# Gói beat hẹn giờ 16 byte, khớp struct TimedPacket trong firmware_esp32/src/main.cpp
+TIMED_PACKET = struct.Struct('<BBBBIIB3x')
+LOOKAHEAD_S = 0.15
+TIMED_REPEATS = 3
+
+STATIC_COLORS_LIST = [
+    (255, 0, 0), (255, 128, 0), (255, 255, 0), (0, 255, 0),
+    (0, 255, 255), (0, 0, 255), (128, 0, 255), (255, 0, 255)
+]
+
+COMMAND_NAMES = {CMD_BEAT_SYNC: 'beat', CMD_FX_BLINK: 'blink', CMD_FX_STATIC: 'static', CMD_BEAT_TIMED: 'timed'}
+
+PACKETS_SENT = metrics.counter('lightstick_packets_sent_total', 'Gói UDP đã gửi, theo chế độ và loại gói (keepalive tách riêng khỏi beat)', ('mode', 'kind'))
+SEND_ERRORS = metrics.counter('lightstick_send_errors_total', 'Gói gửi thất bại: all_down = không đích nào nhận, failed = lỗi tạm, exception = lỗi không xác định', ('reason',))
+SEND_SECONDS = metrics.histogram('lightstick_send_seconds', 'Thời gian gọi transport.send() cho một gói', metrics.SEND_BUCKETS)
+SEND_LATENESS = metrics.histogram('lightstick_send_lateness_seconds', 'Gói gửi trễ so với mốc hẹn của scheduler (live: từ lúc thu âm)', metrics.LATENESS_BUCKETS, ('mode',))
+FIRE_SECONDS = metrics.histogram('lightstick_program_fire_seconds', 'Thời gian một lượt fire() của vòng gửi beat/blink/static', metrics.SEND_BUCKETS, ('mode',))
+WAKEUPS = metrics.counter('lightstick_sender_wakeups_total', 'Số lần thread gửi thức dậy, theo lý do', ('reason',))
+MODE_SWITCH_SECONDS = metrics.histogram('lightstick_mode_switch_seconds', 'Từ lúc nhận lệnh đổi chế độ tới gói đầu tiên của chế độ mới', metrics.LATENESS_BUCKETS)
+_SEND_SECONDS = SEND_SECONDS.labels()
+
+_SHUTDOWN = object()
+
+
+class SenderBusy(Exception):
+    pass
+
+
+class _Command:
+    # Lệnh chờ thread gửi xử lý. Người gọi hết giờ chờ thì huỷ lệnh nếu thread chưa lấy ra chạy,
+    # để không báo lỗi cho một lệnh vẫn sẽ được thực hiện muộn
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self._state = None  # 'running' | 'cancelled'
+        self._state_lock = threading.Lock()
+
+    def claim(self):
+        # Thread gửi gọi trước khi chạy lệnh: False = người gọi đã bỏ cuộc, bỏ qua lệnh
+        with self._state_lock:
+            if self._state == 'cancelled': return False
+            self._state = 'running'
+            return True
+
+    def wait(self, timeout, name):
+        if self.done.wait(timeout): return self.result
+        with self._state_lock:
+            if self._state is None:
+                self._state = 'cancelled'
+                raise SenderBusy(f"Thread gửi chưa nhận lệnh '{name}' sau {timeout}s, đã huỷ lệnh")
+        # Đang chạy dở: chờ xong để trả đúng kết quả
+        self.done.wait()
+        return self.result
+
+
+class _Control(_Command):
+    # Lệnh điều khiển program đang chạy (seek/pause/...), thực thi trong thread gửi
+    def __init__(self, action, args):
+        super().__init__()
+        self.action = action
+        self.args = args
+
+
+class _Submit(_Command):
+    # Đổi program; result = True nếu đã áp dụng, False nếu bị từ chối (lỗi socket)
+    def __init__(self, program, ip, groups, requested_ns):
+        super().__init__()
+        self.program = program
+        self.ip = ip
+        self.groups = groups
+        self.requested_ns = requested_ns
+
+
+class Program:
+    mode = 'idle'
+    keep_alive = None  # (command, r, g, b) gửi khi im lặng quá KEEP_ALIVE_INTERVAL
+    track = None
+
+    def begin(self, engine): pass
+
+    def end(self, engine): pass
+
+    def next_due_ns(self): return None
+
+    def fire(self, engine): return False
+
+    def progress(self): return None
+
+
+class BeatProgram(Program):
+    mode = 'beat'
+    keep_alive = (CMD_BEAT_SYNC, 0, 0, 0)
+
+    def __init__(self, track):
+        self.track = track
+        self.timeline = track["timeline"]
+        self.index = 0
+        self.playback_start_time = 0.0
+        self.paused_at = None
+        self.drift_s = 0.0
+        self.resync_ns = 0  # gói có mốc trước thời điểm này là gửi bù sau seek/chỉnh trôi: không tính vào độ trễ
+
+    def begin(self, engine):
+        self.scheduler = engine.scheduler
+        # Bản gửi có mốc trước lúc bắt đầu (beat hẹn giờ trong cửa sổ lookahead đầu bài) cũng là gửi bù
+        self.resync_ns = self.scheduler.start()
+        self.index = 0
+        self.paused_at = None
+        self.playback_start_time = time.time()
+        logger.info(f"Sender (Beat): Bắt đầu gửi {len(self.timeline)} beats '{self.track['filename']}' (timeline {len(self.timeline.buffer)} bytes)...")
+
+    def progress(self):
+        return {"filename": self.track["filename"], "index": self.index, "total": len(self.timeline), "paused": self.paused_at is not None,
+                "position": self.position(), "drift_ms": self.drift_s * 1000.0}
+
+    def position(self):
+        return self.paused_at if self.paused_at is not None else self.scheduler.elapsed_s()
+
+    def _anchor(self, position_s):
+        # Beat kế tiếp = beat đầu tiên có thời điểm >= vị trí mới (tìm nhị phân trên timeline)
+        self.index = bisect.bisect_left(self.timeline.times, position_s)
+        self.scheduler.reanchor(position_s)
+        self.playback_start_time = time.time() - position_s
+        self.resync_ns = clock_ns()
+
+    def _skip_passed(self):
+        # Sau khi dời mốc (chỉnh trôi) beat kế tiếp tìm lại như _anchor; chỉ tiến, không gửi lại beat đã gửi
+        self.index = max(self.index, bisect.bisect_left(self.timeline.times, self.scheduler.elapsed_s()))
+        self.resync_ns = clock_ns()
+
+    def seek(self, engine, position_s):
+        position_s = max(0.0, position_s)
+        if self.paused_at is not None:
+            self.paused_at = position_s
+            self.index = bisect.bisect_left(self.timeline.times, position_s)
+        else: self._anchor(position_s)
+        logger.info(f"Sender (Beat): seek {position_s:.3f}s -> beat {self.index}/{len(self.timeline)}")
+        return self.progress()
+
+    def pause(self, engine, position_s=None):
+        if self.paused_at is None:
+            self.paused_at = max(0.0, self.scheduler.elapsed_s() if position_s is None else position_s)
+            logger.info(f"Sender (Beat): tạm dừng tại {self.paused_at:.3f}s")
+        return self.progress()
+
+    def resume(self, engine, position_s=None):
+        if self.paused_at is not None or position_s is not None:
+            self._anchor(max(0.0, self.paused_at if position_s is None else position_s))
+            self.paused_at = None
+            logger.info(f"Sender (Beat): tiếp tục từ {self.scheduler.elapsed_s():.3f}s (beat {self.index})")
+        return self.progress()
+
+    def report_position(self, engine, position_s):
+        # Vị trí thực của trình phát nhạc: lệch nhỏ thì bù dần, lệch lớn (tua) thì nhảy hẳn
+        if self.paused_at is not None: return self.progress()
+        drift = self.scheduler.elapsed_s() - position_s
+        self.drift_s = drift
+        if abs(drift) >= DRIFT_SEEK_THRESHOLD: return self.seek(engine, position_s)
+        if abs(drift) > DRIFT_DEADBAND:
+            self.scheduler.shift(drift * DRIFT_GAIN)
+            self.playback_start_time += drift * DRIFT_GAIN
+            self._skip_passed()
+        return self.progress()
+
+    def next_due_ns(self):
+        if self.paused_at is not None or self.index >= len(self.timeline): return None
+        return self.scheduler.due_ns(self.timeline.times[self.index])
+
+    def fire(self, engine):
+        due_ns = self.next_due_ns()
+        if not engine.send_timeline_packet(self.timeline, self.index): return False
+        if due_ns >= self.resync_ns: engine.scheduler.record(due_ns, engine.last_sent_ns)
+        self.index += 1
+        if self.index >= len(self.timeline):
+            logger.info("Sender (Beat): Gửi hết beats.")
+            return False
+        return True
+
+
+class TimedBeatProgram(BeatProgram):
+    # Gửi mỗi beat sớm lookahead_s kèm thời điểm sáng theo đồng hồ chung (clock_sync), lặp lại
+    # repeats lần cách nhau lookahead_s/repeats với cùng packet_id; gậy tự hẹn giờ và bỏ bản trùng.
+    def __init__(self, track, lookahead_s=LOOKAHEAD_S, repeats=TIMED_REPEATS):
+        super().__init__(track)
+        self.lookahead_s = lookahead_s
+        self.repeats = max(1, repeats)
+        spacing = lookahead_s / self.repeats
+        schedule = sorted((t - lookahead_s + k * spacing, beat, k) for beat, t in enumerate(self.timeline.times) for k in range(self.repeats))
+        self.send_offsets = [entry[0] for entry in schedule]
+        self.send_beats = [entry[1] for entry in schedule]
+        self.send_copies = [entry[2] for entry in schedule]
+        self.cursor = 0
+        self.beat_packet_ids = {}
+
+    def begin(self, engine):
+        super().begin(engine)
+        self.cursor = 0
+        self.beat_packet_ids = {}
+
+    def _anchor(self, position_s):
+        super()._anchor(position_s)
+        # Các bản gửi có hạn trong cửa sổ lookahead trước vị trí mới được gửi bù ngay
+        self.cursor = bisect.bisect_left(self.send_offsets, position_s - self.lookahead_s)
+
+    def _skip_passed(self):
+        super()._skip_passed()
+        self.cursor = max(self.cursor, bisect.bisect_left(self.send_offsets, self.scheduler.elapsed_s() - self.lookahead_s))
+
+    def next_due_ns(self):
+        if self.paused_at is not None or self.cursor >= len(self.send_offsets): return None
+        return self.scheduler.due_ns(self.send_offsets[self.cursor])
+
+    def fire(self, engine):
+        i = self.cursor
+        self.cursor += 1
+        beat = self.send_beats[i]
+        target_ns = self.scheduler.due_ns(self.timeline.times[beat])
+        if target_ns > clock_ns():  # bỏ bản sao của beat đã qua (sau seek/chỉnh trôi)
+            packet_id = self.beat_packet_ids.get(beat)
+            if packet_id is None: packet_id = self.beat_packet_ids[beat] = next(engine.packet_ids)
+            if self.send_copies[i] == self.repeats - 1: del self.beat_packet_ids[beat]
+            due_ns = self.scheduler.due_ns(self.send_offsets[i])
+            if not engine.send_timed_packet(self.timeline, beat, packet_id, to_server_us(target_ns), self.send_copies[i]): return False
+            if due_ns >= self.resync_ns: engine.scheduler.record(due_ns, engine.last_sent_ns)
+            if beat >= self.index: self.index = beat + 1
+        if self.cursor >= len(self.send_offsets):
+            logger.info("Sender (Beat): Gửi hết beats (hẹn giờ).")
+            return False
+        return True
+
+    def progress(self):
+        progress = super().progress()
+        progress["lookahead_ms"] = self.lookahead_s * 1000.0; progress["repeats"] = self.repeats
+        return progress
+
+
+class BlinkProgram(Program):
+    mode = 'blink'
+
+    def __init__(self):
+        self.tick = 0
+        self.color_index = 0
+
+    def begin(self, engine):
+        self.anchor_ns = engine.scheduler.start()
+        self.tick = 0; self.color_index = 0
+        logger.info("Sender (Effect): Bắt đầu hiệu ứng blink...")
+
+    def next_due_ns(self):
+        return self.anchor_ns + int(self.tick * BLINK_INTERVAL * 1e9)
+
+    def fire(self, engine):
+        due_ns = self.next_due_ns()
+        if self.tick % 2 == 0:
+            r, g, b = STATIC_COLORS_LIST[self.color_index]
+            self.color_index = (self.color_index + 1) % len(STATIC_COLORS_LIST)
+        else:
+            r, g, b = 0, 0, 0
+        if not engine.send_udp_packet(CMD_FX_BLINK, r, g, b): return False
+        engine.scheduler.record(due_ns, engine.last_sent_ns)
+        self.tick += 1
+        return True
+
+
+class StaticProgram(Program):
+    mode = 'static'
+
+    def __init__(self, r, g, b):
+        self.color = (r, g, b)
+        self.tick = 0
+
+    def begin(self, engine):
+        self.anchor_ns = engine.scheduler.start()
+        self.tick = 0
+        logger.info(f"Sender (Static): Bắt đầu màu {self.color[0]},{self.color[1]},{self.color[2]}...")
+
+    def next_due_ns(self):
+        return self.anchor_ns + self.tick * KEEP_ALIVE_INTERVAL_NS
+
+    def fire(self, engine):
+        due_ns = self.next_due_ns()
+        if not engine.send_udp_packet(CMD_FX_STATIC, *self.color): return False
+        engine.scheduler.record(due_ns, engine.last_sent_ns)
+        self.tick += 1
+        return True
+
+
+class SenderEngine:
+    # Một thread gửi duy nhất sống suốt vòng đời server. Đổi chế độ = đưa Program mới vào
+    # hàng lệnh; thread nhận ngay cả khi đang chờ beat kế tiếp, không dựng lại thread/socket.
+    def __init__(self, on_error=None, packet_log=None, text_log=False):
+        self.on_error = on_error
+        self.packet_log = packet_log
+        self.text_log = text_log
+        self.commands = queue.Queue()
+        self.transport = MulticastTransport()
+        self.scheduler = BeatScheduler()
+        self.program = Program()
+        self.ip = ""
+        self.groups = [MULTICAST_GROUP]
+        self.configured = False
+        self.packet_ids = itertools.count(1)
+        self.last_sent_ns = 0
+        self.last_sent_time = 0.0
+        self.due_ns = 0
+        self.sent_count = 0
+        self.switch_stats = {"count": 0, "last_ms": 0.0, "max_ms": 0.0, "total_ms": 0.0}
+        self._switch_requested_ns = None
+        self._sending_keep_alive = False
+        self._send_series = {}  # (mode, command, keep-alive?) -> (counter gói, histogram trễ): tránh tra nhãn mỗi gói
+        self._thread = None
+
+    @property
+    def mode(self):
+        return self.program.mode
+
+    @property
+    def is_syncing(self):
+        return self.program.mode != 'idle'
+
+    @property
+    def track(self):
+        return self.program.track
+
+    @property
+    def progress(self):
+        return self.program.progress()
+
+    def start(self):
+        if self._thread is not None: return
+        if self.packet_log is not None: self.packet_log.start()
+        self._thread = threading.Thread(target=self._run, name="SenderEngineThread", daemon=True)
+        self._thread.start()
+
+    def submit(self, program, ip=None, groups=None, wait=True):
+        # True nếu program đã chạy, False nếu bị từ chối (lỗi socket; program đã được end());
+        # SenderBusy nếu thread gửi không nhận lệnh kịp (lệnh đã huỷ). wait=False: None
+        self.start()
+        command = _Submit(program, ip, groups, clock_ns())
+        self.commands.put(command)
+        if not wait: return None
+        try: return command.wait(SUBMIT_ACK_TIMEOUT, program.mode)
+        except SenderBusy as e:
+            logger.warning(f"Sender: {e}")
+            raise
+
+    def control(self, action, *args):
+        # Trả về kết quả của program.<action>(), hoặc None nếu program hiện tại không hỗ trợ;
+        # SenderBusy nếu thread gửi không nhận lệnh kịp (lệnh đã huỷ, không chạy muộn)
+        self.start()
+        command = _Control(action, args)
+        self.commands.put(command)
+        try: return command.wait(SUBMIT_ACK_TIMEOUT, action)
+        except SenderBusy as e:
+            logger.warning(f"Sender: {e}")
+            raise
+
+    def notify(self, action, *args):
+        # Như control() nhưng không chờ: nguồn sự kiện thời gian thực (live input) đánh thức thread gửi
+        self.start()
+        self.commands.put(_Control(action, args))
+
+    def stop(self, wait=True):
+        return self.submit(Program(), wait=wait)
+
+    def shutdown(self):
+        if self._thread is None: return
+        self.commands.put(_SHUTDOWN)
+        self._thread.join(timeout=1.0)
+        if self._thread.is_alive(): logger.warning("Sender: thread không dừng kịp!")
+        self._thread = None
+        self.transport.close()
+        if self.packet_log is not None: self.packet_log.close()
+
+    def send_udp_packet(self, command_byte, r, g, b, due_ns=None):
+        current_packet_id = next(self.packet_ids)
+        return self.send_packet_bytes(struct.pack('<BBBB I', command_byte, r, g, b, current_packet_id), current_packet_id, command_byte, r, g, b, due_ns)
+
+    def send_timeline_packet(self, timeline, index):
+        current_packet_id = next(self.packet_ids)
+        command_byte, r, g, b = timeline.fields[index]
+        return self.send_packet_bytes(timeline.packet(index, current_packet_id), current_packet_id, command_byte, r, g, b)
+
+    def send_timed_packet(self, timeline, index, packet_id, target_us, repeat):
+        _, r, g, b = timeline.fields[index]
+        return self.send_packet_bytes(TIMED_PACKET.pack(CMD_BEAT_TIMED, r, g, b, packet_id, target_us & WIRE_MASK, repeat), packet_id, CMD_BEAT_TIMED, r, g, b)
+
+    def send_packet_bytes(self, message, current_packet_id, command_byte, r, g, b, due_ns=None):
+        # due_ns: mốc tính độ trễ gửi; mặc định là mốc hẹn của vòng gửi (live truyền thời điểm thu âm)
+        if not self.configured: return False
+        if due_ns is None: due_ns = self.due_ns
+        try:
+            # Gửi cùng một frame tới mọi cặp group/giao diện; chỉ thất bại khi không đích nào nhận
+            send_start_ns = clock_ns()
+            if not self.transport.send(message):
+                if self.transport.all_down():
+                    SEND_ERRORS.labels('all_down').inc()
+                    logger.error(f"Lỗi UDP: mọi đích qua IP {self.ip} đều lỗi ({self.transport.last_error()}). Dừng...")
+                    self._report_error(f"Lỗi UDP: IP {self.ip}?")
+                else:
+                    SEND_ERRORS.labels('failed').inc()
+                    logger.error(f"Lỗi UDP: không gửi được gói {current_packet_id}")
+                return False
+            self.last_sent_ns = clock_ns()
+            self.last_sent_time = time.time()
+            self.sent_count += 1
+
+            key = (self.program.mode, command_byte, self._sending_keep_alive)
+            series = self._send_series.get(key)
+            if series is None:
+                kind = 'keepalive' if key[2] else COMMAND_NAMES.get(command_byte, 'other')
+                series = self._send_series[key] = (PACKETS_SENT.labels(key[0], kind), SEND_LATENESS.labels(key[0]))
+            series[0].value += 1
+            _SEND_SECONDS.observe((self.last_sent_ns - send_start_ns) / 1e9)
+            if due_ns: series[1].observe(max(0, self.last_sent_ns - due_ns) / 1e9)
+
+            if self.packet_log is not None: self.packet_log.record(current_packet_id, command_byte, r, g, b, due_ns or self.last_sent_ns, self.last_sent_ns)
+            if self.text_log: logger.info(f"LOG,SENT,{current_packet_id},{command_byte},{r},{g},{b},{time.time_ns()}")
+
+            if self._switch_requested_ns is not None: self._record_switch(self.last_sent_ns)
+            return True
+
+        except Exception as e: SEND_ERRORS.labels('exception').inc(); logger.error(f"Lỗi UDP không xác định: {e}"); return False
+
+    def destinations(self):
+        return self.transport.stats()
+
+    def stats(self):
+        stats = dict(self.switch_stats)
+        stats["mean_ms"] = stats["total_ms"] / stats["count"] if stats["count"] else 0.0
+        return stats
+
+    def _report_error(self, message):
+        if self.on_error: self.on_error(message)
+
+    def _record_switch(self, now_ns):
+        latency_ms = (now_ns - self._switch_requested_ns) / 1e6
+        self._switch_requested_ns = None
+        s = self.switch_stats
+        s["count"] += 1; s["last_ms"] = latency_ms; s["total_ms"] += latency_ms
+        MODE_SWITCH_SECONDS.labels().observe(latency_ms / 1e3)
+        if latency_ms > s["max_ms"]: s["max_ms"] = latency_ms
+
+    def _apply(self, program, ip, groups, requested_ns):
+        # False: program mới bị từ chối (lỗi socket), program đang chạy và cấu hình socket cũ giữ nguyên
+        previous = self.program.mode
+        if program.mode != 'idle':
+            try:
+                ip = ip or self.ip; groups = groups or self.groups
+                if not self.configured or ip != self.ip or groups != self.groups:
+                    self.transport.configure(parse_destinations(ip, groups, MULTICAST_PORT))
+                    self.configured = True
+                self.ip = ip; self.groups = groups
+            except (OSError, ValueError) as e:
+                logger.error(f"Sender: LỖI SOCKET: {e}" + (f" (giữ chế độ {previous})" if previous != 'idle' else ""))
+                self._report_error(f"Lỗi Socket: {e}. IP?")
+                self._discard(program)
+                return False
+        # Độ trễ đổi chế độ: từ lúc nhận lệnh tới gói đầu tiên của chế độ mới (hoặc tới lúc dừng hẳn)
+        self._switch_requested_ns = requested_ns
+        self._end_program()
+        if program.mode != 'idle':
+            program.begin(self)
+            # Chế độ có keep-alive (beat) gửi ngay một gói để xoá màu của chế độ trước
+            if program.keep_alive is not None: self.last_sent_ns = clock_ns() - KEEP_ALIVE_INTERVAL_NS
+        elif previous != 'idle': self._record_switch(clock_ns())
+        else: self._switch_requested_ns = None
+        self.program = program
+        if previous != program.mode: logger.info(f"Sender: chế độ {previous} -> {program.mode}")
+        return True
+
+    def _discard(self, program):
+        # Program chưa begin nhưng có thể đã giữ tài nguyên (nguồn âm thanh live): end() để giải phóng
+        try: program.end(self)
+        except Exception as e: logger.error(f"Sender: lỗi huỷ chế độ {program.mode}: {e}")
+
+    def _end_program(self):
+        try: self.program.end(self)
+        except Exception as e: logger.error(f"Sender: lỗi kết thúc chế độ {self.program.mode}: {e}")
+        self.program = Program()
+
+    def _next_due(self):
+        program_due = self.program.next_due_ns()
+        if self.program.keep_alive is None: return program_due, False
+        keep_alive_due = self.last_sent_ns + KEEP_ALIVE_INTERVAL_NS
+        # Không có beat sắp tới (đang tạm dừng): chỉ gửi keep-alive để gậy không rơi về UDP_TIMEOUT
+        if program_due is None or keep_alive_due < program_due: return keep_alive_due, True
+        return program_due, False
+
+    def _run(self):
+        logger.info("Sender: thread gửi đã khởi động.")
+        while True:
+            try:
+                due_ns, is_keep_alive = self._next_due()
+                self.due_ns = due_ns
+                msg = self.scheduler.wait_until(due_ns, self.commands)
+                if msg is _SHUTDOWN: break
+                WAKEUPS.labels('due' if msg is None else 'control' if isinstance(msg, _Control) else 'program').inc()
+                if isinstance(msg, _Control):
+                    if not msg.claim(): continue
+                    try:
+                        method = getattr(self.program, msg.action, None)
+                        if method is not None: msg.result = method(self, *msg.args)
+                    finally: msg.done.set()
+                    continue
+                if msg is not None:
+                    if not msg.claim():
+                        self._discard(msg.program)
+                        continue
+                    try: msg.result = self._apply(msg.program, msg.ip, msg.groups, msg.requested_ns)
+                    finally: msg.done.set()
+                    continue
+                if is_keep_alive:
+                    self._sending_keep_alive = True
+                    try: ok = self.send_udp_packet(*self.program.keep_alive)
+                    finally: self._sending_keep_alive = False
+                    if not ok: logger.error(f"Sender ({self.program.mode}): Lỗi gửi keep-alive.")
+                else:
+                    mode = self.program.mode
+                    fire_start_ns = clock_ns()
+                    ok = self.program.fire(self)
+                    FIRE_SECONDS.labels(mode).observe((clock_ns() - fire_start_ns) / 1e9)
+                if not ok:
+                    logger.info(f"Sender: chế độ {self.program.mode} kết thúc -> idle")
+                    self._switch_requested_ns = None
+                    self._end_program()
+            except Exception as e:
+                logger.error(f"Sender: LỖI LUỒNG: {e}", exc_info=True)
+                self._report_error(f"Lỗi: {e}")
+                self._end_program()
+        self._end_program()
+        logger.info("Sender: thread gửi đã dừng.")
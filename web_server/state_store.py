@@ -0,0 +1,132 @@
+import itertools
+import threading
+from collections import OrderedDict
+
+
+class TrackQueue:
+    # Hàng đợi bài theo id (OrderedDict): lấy bài đầu, xoá theo id, đưa lên đầu/cuối đều O(1);
+    # chèn/di chuyển vào giữa chỉ đụng tới các bài phía sau vị trí đích. Thêm index filename -> ids.
+    # Mỗi thay đổi chỉ tăng version rồi gọi on_change(version) sau khi nhả lock; người đọc tự dựng
+    # summary() khi cần (StateStore.publish_queue), nên thao tác ghi không tốn O(n) và không chờ subscriber.
+    def __init__(self, on_change=None):
+        self.on_change = on_change
+        self.version = 0
+        self._tracks = OrderedDict()
+        self._by_filename = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def _changed(self):
+        if self.on_change: self.on_change(self.version)
+
+    def _place(self, track_id, position):
+        if position is None or position >= len(self._tracks) - 1: self._tracks.move_to_end(track_id)
+        elif position <= 0: self._tracks.move_to_end(track_id, last=False)
+        else:
+            # Đưa bài ra cuối rồi đẩy (n - 1 - position) bài đứng sau vị trí đích ra sau nó
+            self._tracks.move_to_end(track_id)
+            tail = list(itertools.islice(reversed(self._tracks), 1, len(self._tracks) - position))
+            for tid in reversed(tail): self._tracks.move_to_end(tid)
+
+    def add(self, track, position=None):
+        with self._lock:
+            track_id = f"t{next(self._ids)}"
+            track["id"] = track_id
+            self._tracks[track_id] = track
+            self._by_filename.setdefault(track["filename"], set()).add(track_id)
+            if position is not None: self._place(track_id, position)
+            self.version += 1
+        self._changed()
+        return track_id
+
+    def _unindex(self, track):
+        ids = self._by_filename.get(track["filename"])
+        if ids is None: return
+        ids.discard(track["id"])
+        if not ids: del self._by_filename[track["filename"]]
+
+    def pop_next(self):
+        with self._lock:
+            if not self._tracks: return None
+            _, track = self._tracks.popitem(last=False)
+            self._unindex(track)
+            self.version += 1
+        self._changed()
+        return track
+
+    def remove(self, track_id):
+        with self._lock:
+            track = self._tracks.pop(track_id, None)
+            if track is None: return None
+            self._unindex(track)
+            self.version += 1
+        self._changed()
+        return track
+
+    def remove_filename(self, filename):
+        with self._lock:
+            ids = list(self._by_filename.pop(filename, ()))
+            for track_id in ids: del self._tracks[track_id]
+            if not ids: return 0
+            self.version += 1
+        self._changed()
+        return len(ids)
+
+    def move(self, track_id, position):
+        with self._lock:
+            if track_id not in self._tracks: return False
+            self._place(track_id, position)
+            self.version += 1
+        self._changed()
+        return True
+
+    def get(self, track_id):
+        with self._lock: return self._tracks.get(track_id)
+
+    def first(self):
+        with self._lock: return next(iter(self._tracks.values()), None)
+
+    def find(self, filename):
+        with self._lock:
+            ids = self._by_filename.get(filename)
+            if not ids: return None
+            return next(track for track_id, track in self._tracks.items() if track_id in ids)
+
+    def summary(self):
+        with self._lock: tracks = list(self._tracks.values())
+        return [{"id": track["id"], "filename": track["filename"], "tempo": track["tempo"]} for track in tracks]
+
+
+class StateStore:
+    # Trạng thái dùng chung giữa các thread Flask: hàng đợi + IP hiện tại. Mọi thay đổi đi qua lock
+    # và được đẩy lên EventBus ngay trong lock, nên version của bus đúng thứ tự các thay đổi.
+    # Hàng đợi thì không đẩy theo từng thao tác: publish_queue() (thread StatusSampler, được on_change
+    # đánh thức) dựng summary một lần cho cả loạt thay đổi.
+    def __init__(self, bus, on_queue_change=None):
+        self.bus = bus
+        self._lock = threading.RLock()
+        self.queue = TrackQueue(on_change=on_queue_change)
+        self._published_queue_version = 0
+        self.current_ip = ""
+        self.current_groups = None
+        bus.set('queue', []); bus.set('ip', "")
+
+    def publish_queue(self):
+        with self._lock:
+            version = self.queue.version
+            if version == self._published_queue_version: return
+            # Đọc version trước summary: thay đổi xen giữa chỉ làm lần sau dựng lại, không bao giờ bỏ sót
+            self._published_queue_version = version
+            self.bus.set('queue', self.queue.summary())
+
+    def set_destination(self, ip, groups):
+        with self._lock:
+            self.current_ip = ip; self.current_groups = groups
+            self.bus.set('ip', ip)
+
+    def snapshot(self):
+        # (version, state) nhất quán: cùng một version của bus
+        return self.bus.snapshot()
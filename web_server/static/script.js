@@ -36,7 +36,59 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
-    let fakeProgressInterval = null;
+    const STAGE_LABELS = {
+        decode: 'Giải mã',
+        hpss: 'Tách HPSS',
+        onset: 'Onset',
+        tempo: 'Tempo',
+        beat_track: 'Căn beat',
+        features: 'Đặc trưng beat',
+        done: 'Hoàn tất'
+    };
+
+    function setProgress(fraction, text) {
+        const percent = Math.floor(fraction * 100);
+        progressBar.style.width = `${percent}%`;
+        progressText.textContent = `${text} ${percent}%`;
+    }
+
+    function finishUpload(message) {
+        progressBar.style.width = '100%';
+        progressText.textContent = message;
+        setTimeout(() => {
+            progressContainer.style.display = 'none';
+            uploadButton.disabled = false;
+            uploadForm.reset();
+            fileNameDisplay.textContent = 'Chưa chọn file';
+        }, 2000);
+        pollStatus();
+    }
+
+    function waitForJob(jobId) {
+        return new Promise((resolve, reject) => {
+            const timer = setInterval(async () => {
+                try {
+                    const response = await fetch(`/jobs/${jobId}`);
+                    if (!response.ok) throw new Error('Mất job phân tích trên server.');
+                    const job = await response.json();
+                    if (job.status === 'done') {
+                        clearInterval(timer);
+                        resolve(job);
+                    } else if (job.status === 'error') {
+                        clearInterval(timer);
+                        reject(new Error(job.error || 'Phân tích thất bại.'));
+                    } else if (job.status === 'running') {
+                        setProgress(job.progress, `Đang phân tích (${STAGE_LABELS[job.stage] || job.stage})...`);
+                    } else {
+                        progressText.textContent = 'Đang chờ worker phân tích...';
+                    }
+                } catch (error) {
+                    clearInterval(timer);
+                    reject(error);
+                }
+            }, 500);
+        });
+    }
     
     uploadForm.addEventListener('submit', async (e) => {
         e.preventDefault(); 
@@ -53,27 +105,7 @@ document.addEventListener('DOMContentLoaded', () => {
         progressContainer.style.display = 'block';
         uploadButton.disabled = true;
         progressBar.style.width = '0%';
-        progressText.textContent = 'Đang tải lên... 0%';
-
-        const startTime = Date.now();
-        const duration = 30000;
-
-        fakeProgressInterval = setInterval(() => {
-            const elapsed = Date.now() - startTime;
-            let progress = elapsed / duration;
-            
-            if (progress >= 1) {
-                progress = 1;
-            }
-            
-            const displayProgress = Math.floor(progress * 90);
-            progressBar.style.width = `${displayProgress}%`;
-            progressText.textContent = `Đang phân tích... ${displayProgress}%`;
-            
-            if (displayProgress >= 90) {
-                 clearInterval(fakeProgressInterval);
-            }
-        }, 100);
+        progressText.textContent = 'Đang tải lên...';
 
         try {
             const response = await fetch('/upload', {
@@ -81,8 +113,6 @@ document.addEventListener('DOMContentLoaded', () => {
                 body: formData,
             });
 
-            clearInterval(fakeProgressInterval);
-
             if (!response.ok) {
                 const errorData = await response.json();
                 throw new Error(errorData.message || 'Lỗi không xác định từ server.');
@@ -90,20 +120,15 @@ document.addEventListener('DOMContentLoaded', () => {
 
             const result = await response.json();
 
-            progressBar.style.width = '100%';
-            progressText.textContent = `Phân tích thành công: ${result.filename} (${Math.round(result.tempo)} BPM)`;
-            
-            setTimeout(() => {
-                progressContainer.style.display = 'none';
-                uploadButton.disabled = false;
-                uploadForm.reset();
-                fileNameDisplay.textContent = 'Chưa chọn file';
-            }, 2000);
-
-            pollStatus();
+            if (result.status === 'queued') {
+                setProgress(0, 'Đang chờ phân tích...');
+                const job = await waitForJob(result.job_id);
+                finishUpload(`Phân tích thành công: ${job.filename} (${Math.round(job.tempo)} BPM)`);
+            } else {
+                finishUpload(`Phân tích thành công: ${result.filename} (${Math.round(result.tempo)} BPM)`);
+            }
 
         } catch (error) {
-            clearInterval(fakeProgressInterval); 
             progressBar.style.width = '0%';
             progressContainer.style.display = 'none';
             uploadButton.disabled = false;
@@ -140,6 +165,43 @@ document.addEventListener('DOMContentLoaded', () => {
         stopButton.click();
     });
 
+    // Giữ đèn khớp với trình phát nhạc: tạm dừng/tiếp tục/tua và báo vị trí định kỳ để bù trôi
+    const POSITION_REPORT_MS = 2000;
+    let beatPaused = false;
+
+    function syncingBeat() {
+        return modeState && modeState.is_syncing && modeState.current_sync_mode === 'beat';
+    }
+
+    function postPlayback(endpoint) {
+        return fetch(endpoint, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ position: audioPlayer.currentTime }),
+        }).catch(err => console.error(`Lỗi tại ${endpoint}:`, err));
+    }
+
+    audioPlayer.addEventListener('pause', () => {
+        if (!syncingBeat() || audioPlayer.ended) return;
+        beatPaused = true;
+        postPlayback('/pause');
+    });
+
+    audioPlayer.addEventListener('play', () => {
+        if (!syncingBeat() || !beatPaused) return;
+        beatPaused = false;
+        postPlayback('/resume');
+    });
+
+    audioPlayer.addEventListener('seeked', () => {
+        if (!syncingBeat()) return;
+        postPlayback('/seek');
+    });
+
+    setInterval(() => {
+        if (syncingBeat() && !audioPlayer.paused && !audioPlayer.seeking) postPlayback('/position');
+    }, POSITION_REPORT_MS);
+
     palette.addEventListener('click', (e) => {
         const target = e.target.closest('.color-box');
         if (!target) return;
@@ -168,7 +230,7 @@ document.addEventListener('DOMContentLoaded', () => {
         if (deleteBtn) {
             const filename = deleteBtn.dataset.filename;
             if (confirm(`Bạn có chắc muốn xóa "${filename}" khỏi hàng đợi?`)) {
-                apiPost('/queue/delete', { filename: filename })
+                apiPost('/queue/delete', { id: deleteBtn.dataset.id })
                     .then(() => {
                         showError(`Đã xóa "${filename}".`, 'success');
                         pollStatus();
@@ -214,79 +276,159 @@ document.addEventListener('DOMContentLoaded', () => {
         setTimeout(() => { errorContainer.style.display = 'none'; }, 3000);
     }
 
-    async function pollStatus() {
-        try {
-            const response = await fetch('/status');
-            if (!response.ok) throw new Error('Mất kết nối server');
+    let lastEtag = null;
+    let lastErrorId = null;
+    let modeState = null;
+    let queueLength = 0;
+    let beatProgress = null;
+    let eventsLive = false;
+    let pollTimer = null;
+
+    function renderMode(mode) {
+        modeState = mode;
+        if (mode.is_syncing) {
+            syncButton.disabled = true;
+            stopButton.disabled = false;
+            let statusText = "Đang đồng bộ...";
+            if (mode.current_sync_mode === 'beat' && mode.current_audio_file) {
+                statusText = mode.current_audio_file;
+                if (beatProgress && beatProgress.filename === mode.current_audio_file) {
+                    statusText += ` (beat ${beatProgress.index}/${beatProgress.total})`;
+                }
+                if (mode.paused) statusText += " - Tạm dừng";
+            } else if (mode.current_sync_mode === 'static') {
+                statusText = "Màu tĩnh";
+            } else if (mode.current_sync_mode === 'blink') {
+                statusText = "Flashy (Đa màu)";
+            } else if (mode.current_sync_mode === 'live') {
+                statusText = "Live (âm thanh trực tiếp)";
+            }
+            nowPlayingText.textContent = statusText;
+        } else {
+            syncButton.disabled = (queueLength === 0);
+            stopButton.disabled = true;
+            nowPlayingText.textContent = "Đã dừng";
+            beatProgress = null;
+            beatPaused = false;
             
-            const data = await response.json();
+            if (!audioPlayer.paused && mode.current_sync_mode !== 'beat') {
+                audioPlayer.pause();
+                audioPlayer.src = "";
+            }
+        }
+    }
 
-            if (data.is_syncing) {
-                syncButton.disabled = true;
-                stopButton.disabled = false;
-                let statusText = "Đang đồng bộ...";
-                if (data.current_sync_mode === 'beat' && data.current_audio_file) {
-                    statusText = data.current_audio_file;
-                } else if (data.current_sync_mode === 'static') {
-                    statusText = "Màu tĩnh";
-                } else if (data.current_sync_mode === 'blink') {
-                    statusText = "Flashy (Đa màu)";
-                }
-                nowPlayingText.textContent = statusText;
-            } else {
-                syncButton.disabled = (data.audio_queue.length === 0);
-                stopButton.disabled = true;
-                nowPlayingText.textContent = "Đã dừng";
+    function renderQueue(queue) {
+        queueLength = queue.length;
+        if (modeState && !modeState.is_syncing) syncButton.disabled = (queueLength === 0);
+
+        queueList.innerHTML = ''; 
+        if (queue.length === 0) {
+            queueList.innerHTML = '<li class="queue-item-empty">Hàng đợi trống</li>';
+        } else {
+            queue.forEach(track => {
+                const li = document.createElement('li');
+                li.className = 'queue-item';
                 
-                if (!audioPlayer.paused && data.current_sync_mode !== 'beat') {
-                    audioPlayer.pause();
-                    audioPlayer.src = "";
-                }
-            }
+                const infoDiv = document.createElement('div');
+                infoDiv.className = 'queue-item-info';
+                
+                const nameSpan = document.createElement('span');
+                nameSpan.textContent = track.filename;
+                
+                const tempoSpan = document.createElement('span');
+                tempoSpan.className = 'queue-item-tempo';
+                tempoSpan.textContent = `${Math.round(track.tempo)} BPM`;
+                
+                infoDiv.appendChild(nameSpan);
+                infoDiv.appendChild(tempoSpan);
+                
+                const deleteBtn = document.createElement('span');
+                deleteBtn.className = 'queue-item-delete';
+                deleteBtn.innerHTML = '&times;'; // Ký tự 'X'
+                deleteBtn.dataset.filename = track.filename; 
+                deleteBtn.dataset.id = track.id;
+                
+                li.appendChild(infoDiv);
+                li.appendChild(deleteBtn);
+                queueList.appendChild(li);
+            });
+        }
+    }
 
-            queueList.innerHTML = ''; 
-            if (data.audio_queue.length === 0) {
-                queueList.innerHTML = '<li class="queue-item-empty">Hàng đợi trống</li>';
-            } else {
-                data.audio_queue.forEach(track => {
-                    const li = document.createElement('li');
-                    li.className = 'queue-item';
-                    
-                    const infoDiv = document.createElement('div');
-                    infoDiv.className = 'queue-item-info';
-                    
-                    const nameSpan = document.createElement('span');
-                    nameSpan.textContent = track.filename;
-                    
-                    const tempoSpan = document.createElement('span');
-                    tempoSpan.className = 'queue-item-tempo';
-                    tempoSpan.textContent = `${Math.round(track.tempo)} BPM`;
-                    
-                    infoDiv.appendChild(nameSpan);
-                    infoDiv.appendChild(tempoSpan);
-                    
-                    const deleteBtn = document.createElement('span');
-                    deleteBtn.className = 'queue-item-delete';
-                    deleteBtn.innerHTML = '&times;'; // Ký tự 'X'
-                    deleteBtn.dataset.filename = track.filename; 
-                    
-                    li.appendChild(infoDiv);
-                    li.appendChild(deleteBtn);
-                    queueList.appendChild(li);
-                });
-            }
+    function renderError(error) {
+        // Lỗi có id tăng dần; lỗi đã có trước khi mở trang thì không hiện lại
+        const id = (error && error.id) || 0;
+        if (lastErrorId !== null && id !== lastErrorId && error.message) {
+            showError(error.message);
+        }
+        lastErrorId = id;
+    }
 
-            if (data.server_error) {
-                showError(data.server_error);
-            }
+    async function pollStatus() {
+        if (eventsLive) return;
+        try {
+            const headers = lastEtag ? { 'If-None-Match': lastEtag } : {};
+            const response = await fetch('/status', { headers, cache: 'no-store' });
+            if (response.status === 304) return;
+            if (!response.ok) throw new Error('Mất kết nối server');
+            lastEtag = response.headers.get('ETag');
+            
+            const data = await response.json();
+            renderQueue(data.audio_queue);
+            renderMode(data);
+            renderError({ id: data.error_id, message: data.server_error });
 
         } catch (error) {
+            lastEtag = null;
             showError(error.message);
             syncButton.disabled = true;
             stopButton.disabled = true;
         }
     }
 
-    pollStatus();
-    setInterval(pollStatus, 2000); 
+    function startPolling() {
+        if (pollTimer) return;
+        pollStatus();
+        pollTimer = setInterval(pollStatus, 2000);
+    }
+
+    function stopPolling() {
+        if (!pollTimer) return;
+        clearInterval(pollTimer);
+        pollTimer = null;
+    }
+
+    function connectEvents() {
+        if (!window.EventSource) {
+            startPolling();
+            return;
+        }
+        const events = new EventSource('/events');
+        events.onopen = () => {
+            eventsLive = true;
+            stopPolling();
+        };
+        events.onerror = () => {
+            // EventSource tự kết nối lại; trong lúc chờ thì poll /status (có ETag)
+            eventsLive = false;
+            startPolling();
+        };
+        events.addEventListener('snapshot', (e) => {
+            const state = JSON.parse(e.data);
+            renderQueue(state.queue || []);
+            if (state.mode) renderMode(state.mode);
+            renderError(state.server_error);
+        });
+        events.addEventListener('mode', (e) => renderMode(JSON.parse(e.data)));
+        events.addEventListener('queue', (e) => renderQueue(JSON.parse(e.data)));
+        events.addEventListener('server_error', (e) => renderError(JSON.parse(e.data)));
+        events.addEventListener('beat', (e) => {
+            beatProgress = JSON.parse(e.data);
+            if (modeState) renderMode(modeState);
+        });
+    }
+
+    connectEvents();
+    if (!eventsLive) startPolling(); 
 });
\ No newline at end of file
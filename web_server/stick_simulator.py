@@ -0,0 +1,297 @@
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import heapq
+import asyncio
+import logging
+import argparse
+import resource
+import multiprocessing
+from collections import deque
+
+import numpy as np
+
+from timed_sync_sim import NetworkModel
+from sender_engine import TIMED_PACKET, CMD_BEAT_SYNC, CMD_FX_BLINK, CMD_FX_STATIC, CMD_BEAT_TIMED, MULTICAST_GROUP, MULTICAST_PORT
+
+# Tải thử fan-out: hàng nghìn gậy ảo trên loopback, mỗi gậy một socket join 239.1.1.1:1234 như ESP32.
+#   python stick_simulator.py --sticks 5000 --drive beat --duration 30     (tự phát bằng SenderEngine)
+#   python stick_simulator.py --sticks 2000 --drive none --duration 60     (nghe web.py đang chạy)
+LOOPBACK_IP = '127.0.0.1'
+UDP_TIMEOUT_MS = 6000           # khớp UDP_TIMEOUT trong main.cpp
+RECENT_IDS = 32                 # khớp recentIds[] trong main.cpp
+RX_QUEUE_DEPTH = 6              # CONFIG_LWIP_UDP_RECVMBOX_SIZE mặc định của ESP-IDF
+LOOP_PERIOD_MS = 1.0            # mỗi vòng loop() của firmware đọc tối đa một gói
+LATENCY_BIN_MS = 0.1
+LATENCY_MAX_MS = 1000.0
+LAG_WARN_MS = 10.0              # lag = chờ trong socket trước khi simulator đọc; lớn thì buffer kernel dễ tràn
+STOP_POLL_S = 0.1
+DRAIN_S = 0.5
+DRIVE_BPM = 120.0
+FD_RESERVE = 64
+UDP_PACKET = struct.Struct('<BBBBI')
+_TIMESPEC = struct.Struct('@ll')
+# socket module của Python không có hằng này; giá trị Linux (SO_TIMESTAMPNS_OLD / SCM_TIMESTAMPNS)
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+ANC_SIZE = socket.CMSG_SPACE(_TIMESPEC.size)
+STICK_FIELDS = ('kernel_received', 'lost', 'overflow', 'delivered', 'invalid', 'duplicates', 'fallbacks', 'fallback_ms', 'ended_in_fallback')
+
+
+class _Histogram:
+    def __init__(self):
+        self.bins = np.zeros(int(LATENCY_MAX_MS / LATENCY_BIN_MS) + 1, dtype=np.int64)
+        self.max_ms = 0.0
+
+    def add(self, ms):
+        self.bins[min(len(self.bins) - 1, max(0, int(ms / LATENCY_BIN_MS)))] += 1
+        if ms > self.max_ms: self.max_ms = ms
+
+
+def _hist_stats(bins, max_ms):
+    count = int(bins.sum())
+    if not count: return {"count": 0, "p50_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+    cum = np.cumsum(bins)
+    pct = lambda q: float((np.searchsorted(cum, q * count) + 1) * LATENCY_BIN_MS)
+    return {"count": count, "p50_ms": pct(0.5), "p90_ms": pct(0.9), "p99_ms": pct(0.99), "max_ms": float(max_ms)}
+
+
+class VirtualStick:
+    # Một gậy: socket riêng join group trên loopback; độ trễ/mất gói theo NetworkModel, rồi xử lý như loop()
+    # trong main.cpp: hàng nhận lwIP RX_QUEUE_DEPTH gói, mỗi vòng loop một gói, gói 8 byte cập nhật
+    # lastUdpPacketTime + màu, gói 16 byte bỏ trùng theo packet_id, quá UDP_TIMEOUT thì về WIFI_CONNECTED.
+    def __init__(self, loop, network, sim):
+        self.loop = loop
+        self.network = network
+        self.sim = sim
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if sys.platform.startswith('linux'): self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        self.sock.bind(('', MULTICAST_PORT))
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(MULTICAST_GROUP) + socket.inet_aton(LOOPBACK_IP))
+        self.sock.setblocking(False)
+        self.counts = dict.fromkeys(STICK_FIELDS, 0)
+        self.pending = deque()
+        self.next_free_ns = 0
+        self.synced = False
+        self.last_ns = 0
+        self.recent_ids = deque(maxlen=RECENT_IDS)
+        self.inflight = []  # heap (arrival_ns, seq, data, kernel_ns): gói "đang bay" theo độ trễ mô phỏng
+        self.seq = 0
+        loop.add_reader(self.sock, self._on_readable)
+
+    def _on_readable(self):
+        # Không đặt timer cho từng gói: mọi mốc đều theo thời gian mô phỏng (kernel timestamp + độ trễ),
+        # nên chỉ cần xử lý các gói theo thứ tự arrival_ns khi arrival_ns đã qua
+        while True:
+            try: data, ancdata, _, _ = self.sock.recvmsg(64, ANC_SIZE)
+            except (BlockingIOError, InterruptedError): break
+            now_ns = time.time_ns(); kernel_ns = now_ns
+            for level, kind, value in ancdata:
+                if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS and len(value) >= _TIMESPEC.size:
+                    sec, nsec = _TIMESPEC.unpack_from(value); kernel_ns = sec * 1_000_000_000 + nsec
+            self.sim.lag.add((now_ns - kernel_ns) / 1e6)
+            self.counts['kernel_received'] += 1
+            self.sim.seen_ids.add(data[4:8])
+            delay = self.network.delay_ns()
+            if delay is None: self.counts['lost'] += 1; continue
+            self.seq += 1
+            heapq.heappush(self.inflight, (kernel_ns + delay, self.seq, data, kernel_ns))
+        self._drain(time.time_ns())
+
+    def _drain(self, until_ns):
+        # Gói đọc sau này có kernel_ns >= until_ns nên không thể đến trước các gói đã tới hạn
+        while self.inflight and self.inflight[0][0] <= until_ns:
+            arrival_ns, _, data, kernel_ns = heapq.heappop(self.inflight)
+            self._deliver(data, kernel_ns, arrival_ns)
+
+    def _deliver(self, data, kernel_ns, arrival_ns):
+        while self.pending and self.pending[0] <= arrival_ns: self.pending.popleft()
+        if len(self.pending) >= RX_QUEUE_DEPTH: self.counts['overflow'] += 1; return
+        process_ns = max(arrival_ns, self.next_free_ns)
+        self.next_free_ns = process_ns + self.sim.loop_period_ns
+        self.pending.append(process_ns)
+        if len(data) == UDP_PACKET.size: command, _, _, _, packet_id = UDP_PACKET.unpack(data)
+        elif len(data) == TIMED_PACKET.size:
+            command, _, _, _, packet_id, _, _ = TIMED_PACKET.unpack(data)
+        else: self.counts['invalid'] += 1; return
+        # main.cpp: mọi gói đúng kích thước đều làm mới lastUdpPacketTime, kể cả gói hẹn giờ trùng
+        self._touch(process_ns)
+        if len(data) == TIMED_PACKET.size:
+            if command != CMD_BEAT_TIMED: return
+            if packet_id in self.recent_ids: self.counts['duplicates'] += 1; return
+            self.recent_ids.append(packet_id)
+        elif command not in (CMD_BEAT_SYNC, CMD_FX_STATIC, CMD_FX_BLINK): return
+        self.counts['delivered'] += 1
+        self.sim.latency.add((process_ns - kernel_ns) / 1e6)
+
+    def _touch(self, now_ns):
+        if self.synced and now_ns - self.last_ns > self.sim.timeout_ns:
+            self.counts['fallbacks'] += 1; self.counts['fallback_ms'] += (now_ns - self.last_ns - self.sim.timeout_ns) / 1e6
+        self.synced = True; self.last_ns = now_ns
+
+    def finish(self, end_ns):
+        self._drain(sys.maxsize)  # gói đã gửi trước khi dừng thì sớm muộn cũng tới gậy
+        if self.synced and end_ns - self.last_ns > self.sim.timeout_ns:
+            self.counts['fallbacks'] += 1; self.counts['ended_in_fallback'] = 1
+            self.counts['fallback_ms'] += (end_ns - self.last_ns - self.sim.timeout_ns) / 1e6
+        self.loop.remove_reader(self.sock); self.sock.close()
+        return [self.counts[k] for k in STICK_FIELDS]
+
+
+class _ProcessSim:
+    def __init__(self, args):
+        self.latency = _Histogram()
+        self.lag = _Histogram()
+        self.seen_ids = set()
+        self.loop_period_ns = int(args.loop_ms * 1e6)
+        self.timeout_ns = int(args.udp_timeout_ms * 1e6)
+
+
+def _network_for(args, stick_index):
+    bad = stick_index < int(args.sticks * args.bad_fraction)
+    return NetworkModel(base_ms=args.base_ms, jitter_ms=args.jitter_ms, spike_prob=args.spike_prob,
+                        loss=args.bad_loss if bad else args.loss, seed=args.seed * 1_000_003 + stick_index)
+
+
+def _raise_fd_limit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed + FD_RESERVE and hard != soft:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard == resource.RLIM_INFINITY else min(hard, needed + FD_RESERVE), hard))
+
+
+async def _simulate(first, count, args, ready, stop):
+    loop = asyncio.get_running_loop()
+    sim = _ProcessSim(args)
+    sticks = [VirtualStick(loop, _network_for(args, first + i), sim) for i in range(count)]
+    ready.put(count)
+    while not stop.is_set(): await asyncio.sleep(STOP_POLL_S)
+    end_ns = time.time_ns()
+    await asyncio.sleep(DRAIN_S)  # đọc nốt gói còn trong socket
+    return np.array([s.finish(end_ns) for s in sticks], dtype=np.float64).reshape(-1, len(STICK_FIELDS)), sim
+
+
+def _worker(first, count, args, ready, stop, results):
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - [%(processName)s] %(message)s')
+    try:
+        _raise_fd_limit(count)
+        sticks, sim = asyncio.run(_simulate(first, count, args, ready, stop))
+        results.put({"sticks": sticks, "latency": sim.latency.bins, "latency_max": sim.latency.max_ms,
+                     "lag": sim.lag.bins, "lag_max": sim.lag.max_ms, "ids": len(sim.seen_ids)})
+    except Exception as e:
+        ready.put(0)
+        results.put({"error": f"{type(e).__name__}: {e}"})
+
+
+def _drive_program(args):
+    from sender_engine import BeatProgram, TimedBeatProgram, BlinkProgram, StaticProgram
+    from timeline import compile_timeline
+    if args.drive == 'blink': return BlinkProgram()
+    if args.drive == 'static': return StaticProgram(255, 0, 0)
+    times = np.arange(0.0, args.duration, 60.0 / args.bpm)
+    beats = list(zip(times.tolist(), [1.0] * len(times)))
+    track = {"filename": "stick_sim", "beats": beats, "tempo": args.bpm, "timeline": compile_timeline("stick_sim", beats, CMD_BEAT_SYNC, seed=0)}
+    if args.drive == 'timed': return TimedBeatProgram(track, args.lookahead_ms / 1000.0)
+    return BeatProgram(track)
+
+
+def _run_driver(args):
+    # Phát bằng SenderEngine thật (cùng transport/keep-alive như web.py); --pause-at thử keep-alive khi tạm dừng
+    from sender_engine import SenderEngine
+    engine = SenderEngine()
+    engine.submit(_drive_program(args), LOOPBACK_IP)
+    t0 = time.monotonic()
+    if args.pause_at is not None and args.pause_at < args.duration:
+        time.sleep(args.pause_at); engine.control('pause')
+        time.sleep(args.pause_for); engine.control('resume')
+    time.sleep(max(0.0, args.duration - (time.monotonic() - t0)))
+    engine.stop()
+    sent = engine.sent_count; timing = engine.scheduler.stats()
+    engine.shutdown()
+    return sent, timing
+
+
+def run(args):
+    procs = max(1, min(args.procs, args.sticks))
+    ctx = multiprocessing.get_context('spawn')
+    ready, results, stop = ctx.Queue(), ctx.Queue(), ctx.Event()
+    split = np.array_split(np.arange(args.sticks), procs)
+    workers = [ctx.Process(target=_worker, args=(int(part[0]), len(part), args, ready, stop, results), name=f"Sticks-{i}") for i, part in enumerate(split) if len(part)]
+    for w in workers: w.start()
+    joined = sum(ready.get() for _ in workers)
+    print(f"{joined}/{args.sticks} gậy ảo đã join {MULTICAST_GROUP}:{MULTICAST_PORT} ({len(workers)} process)")
+    t0 = time.monotonic()
+    if args.drive != 'none': sent, timing = _run_driver(args)
+    else: time.sleep(args.duration); sent, timing = None, None
+    elapsed = time.monotonic() - t0
+    stop.set()
+    parts = [results.get() for _ in workers]
+    for w in workers: w.join()
+    errors = [p["error"] for p in parts if "error" in p]
+    parts = [p for p in parts if "error" not in p]
+    if not parts: raise RuntimeError(f"Không process nào chạy được: {errors}")
+
+    sticks = np.vstack([p["sticks"] for p in parts])
+    col = {k: sticks[:, i] for i, k in enumerate(STICK_FIELDS)}
+    # Mất theo gậy tính trên số packet_id phân biệt (gói hẹn giờ lặp lại cùng id); không tự phát thì
+    # số gói đã gửi cũng lấy theo số id mà process nhận được nhiều nhất
+    unique = max(p["ids"] for p in parts)
+    expected = sent if sent is not None else unique
+    loss = 1.0 - col['delivered'] / unique if unique else np.zeros(len(sticks))
+    lag = _hist_stats(sum(p["lag"] for p in parts), max(p["lag_max"] for p in parts))
+    report = {
+        "sticks": int(len(sticks)), "processes": len(parts), "errors": errors, "drive": args.drive, "seconds": elapsed, "sent": int(expected), "unique_ids": int(unique),
+        "kernel_loss": float(1.0 - col['kernel_received'].sum() / (expected * len(sticks))) if expected else 0.0,
+        "model_loss": float(col['lost'].sum() / max(1, col['kernel_received'].sum())),
+        "rx_overflow": int(col['overflow'].sum()), "invalid": int(col['invalid'].sum()), "duplicates": int(col['duplicates'].sum()),
+        "device_loss": {"mean": float(loss.mean()), "p50": float(np.percentile(loss, 50)), "p99": float(np.percentile(loss, 99)), "max": float(loss.max())},
+        "latency": _hist_stats(sum(p["latency"] for p in parts), max(p["latency_max"] for p in parts)),
+        "fallbacks": int(col['fallbacks'].sum()), "devices_with_fallback": int((col['fallbacks'] > 0).sum()),
+        "ended_in_fallback": int(col['ended_in_fallback'].sum()), "fallback_seconds": float(col['fallback_ms'].sum() / 1000.0),
+        "simulator_lag": lag, "sender_timing": timing,
+    }
+    if lag["p99_ms"] > LAG_WARN_MS: report["warning"] = f"Simulator quá tải (lag p99 {lag['p99_ms']:.1f} ms): tăng --procs hoặc giảm --sticks"
+    return report
+
+
+def _print_summary(r):
+    d = r["device_loss"]; lat = r["latency"]
+    print(f"Gửi {r['sent']} gói tới {r['sticks']} gậy trong {r['seconds']:.1f}s ({r['drive']})")
+    print(f"  mất ở kernel/simulator {r['kernel_loss'] * 100:.2f}%, mất mô phỏng {r['model_loss'] * 100:.2f}%, tràn hàng nhận {r['rx_overflow']}")
+    print(f"  mất theo gậy: TB {d['mean'] * 100:.2f}%  p50 {d['p50'] * 100:.2f}%  p99 {d['p99'] * 100:.2f}%  max {d['max'] * 100:.2f}%")
+    print(f"  độ trễ: p50 {lat['p50_ms']:.1f} ms  p99 {lat['p99_ms']:.1f} ms  max {lat['max_ms']:.1f} ms")
+    print(f"  UDP_TIMEOUT: {r['fallbacks']} lần trên {r['devices_with_fallback']} gậy, tổng {r['fallback_seconds']:.1f}s, {r['ended_in_fallback']} gậy kết thúc ở chế độ chờ")
+    if r["sender_timing"]: print(f"  sender: p99 trễ {r['sender_timing']['p99_ms']:.3f} ms, max {r['sender_timing']['max_ms']:.3f} ms")
+    print(f"  lag simulator: p99 {r['simulator_lag']['p99_ms']:.1f} ms")
+    if "warning" in r: print(f"  CẢNH BÁO: {r['warning']}")
+    for e in r["errors"]: print(f"  LỖI process: {e}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Mô phỏng hàng nghìn lightstick trên loopback")
+    parser.add_argument('--sticks', type=int, default=1000)
+    parser.add_argument('--procs', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--drive', choices=('beat', 'timed', 'blink', 'static', 'none'), default='beat', help="none: chỉ nghe (chạy web.py riêng)")
+    parser.add_argument('--bpm', type=float, default=DRIVE_BPM)
+    parser.add_argument('--lookahead-ms', type=float, default=150.0)
+    parser.add_argument('--pause-at', type=float, help="tạm dừng beat ở giây này (kiểm tra keep-alive)")
+    parser.add_argument('--pause-for', type=float, default=8.0)
+    parser.add_argument('--loss', type=float, default=0.01)
+    parser.add_argument('--bad-fraction', type=float, default=0.0, help="tỉ lệ gậy sóng yếu")
+    parser.add_argument('--bad-loss', type=float, default=0.2)
+    parser.add_argument('--base-ms', type=float, default=2.0)
+    parser.add_argument('--jitter-ms', type=float, default=3.0)
+    parser.add_argument('--spike-prob', type=float, default=0.01)
+    parser.add_argument('--loop-ms', type=float, default=LOOP_PERIOD_MS)
+    parser.add_argument('--udp-timeout-ms', type=float, default=UDP_TIMEOUT_MS)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help="ghi báo cáo JSON")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    report = run(args)
+    _print_summary(report)
+    if args.json:
+        with open(args.json, 'w') as f: json.dump(report, f, indent=2)
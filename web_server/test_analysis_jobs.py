@@ -0,0 +1,68 @@
+import os
+import time
+import signal
+import threading
+
+import numpy as np
+import pytest
+
+soundfile = pytest.importorskip("soundfile")
+pytest.importorskip("librosa")
+
+import analysis_jobs
+
+SR = 22050
+JOB_TIMEOUT = 120.0
+
+
+def click_track(path, bpm=120, duration=6.0):
+    y = np.zeros(int(duration * SR), dtype=np.float32)
+    for t in np.arange(0.25, duration - 0.1, 60.0 / bpm): y[int(t * SR):int(t * SR) + 200] = 0.8
+    soundfile.write(str(path), y, SR)
+
+
+def wait_for(predicate, timeout=JOB_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate(): return True
+        time.sleep(0.05)
+    return False
+
+
+@pytest.fixture
+def jobs():
+    done = []; errors = []; finished = threading.Event()
+    def on_done(job, result): done.append(job["id"]); finished.set()
+    def on_error(job, error): errors.append((job["id"], error)); finished.set()
+    queue = analysis_jobs.AnalysisJobQueue(2, 8, on_done, on_error)
+    queue.done, queue.errors = done, errors
+    queue.start()
+    yield queue
+    queue.shutdown()
+
+
+def test_killed_worker_pool_is_rebuilt(tmp_path, jobs):
+    path = tmp_path / "click.wav"
+    click_track(path)
+    assert wait_for(lambda: len(jobs.ready_workers) == 2)
+    os.kill(next(iter(jobs.ready_workers)), signal.SIGKILL)
+    time.sleep(0.5)  # để executor kịp phát hiện worker chết
+    job_id = jobs.submit(str(path), "click.wav", None, "key")
+    assert wait_for(lambda: jobs.get(job_id)["status"] in analysis_jobs.JOB_FINAL_STATES)
+    assert jobs.get(job_id)["status"] == 'done' and jobs.done == [job_id]
+    assert jobs.stats()["restarts"] == 1
+
+
+def test_job_running_on_killed_worker_is_marked_error(tmp_path, jobs):
+    path = tmp_path / "click.wav"
+    click_track(path, duration=60.0)
+    assert wait_for(lambda: len(jobs.ready_workers) == 2)
+    job_id = jobs.submit(str(path), "click.wav", None, "key")
+    assert wait_for(lambda: jobs.get(job_id)["status"] == 'running')
+    for pid in list(jobs.ready_workers): os.kill(pid, signal.SIGKILL)
+    assert wait_for(lambda: jobs.get(job_id)["status"] == 'error')
+    assert jobs.errors and jobs.errors[0][0] == job_id
+    assert wait_for(lambda: len(jobs.ready_workers) == 2)
+    next_id = jobs.submit(str(path), "click.wav", 120, "key")
+    assert wait_for(lambda: jobs.get(next_id)["status"] in analysis_jobs.JOB_FINAL_STATES)
+    assert jobs.get(next_id)["status"] == 'done'
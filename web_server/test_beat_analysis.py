@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+soundfile = pytest.importorskip("soundfile")
+librosa = pytest.importorskip("librosa")
+
+import beat_analysis
+
+SR = 44100
+
+
+def click_track(path, bpm, duration=30.0, start=0.5):
+    y = np.zeros(int(duration * SR), dtype=np.float32)
+    click = np.sin(2 * np.pi * 1000 * np.arange(int(0.03 * SR)) / SR).astype(np.float32)
+    truth = np.arange(start, duration - 0.1, 60.0 / bpm)
+    for t in truth:
+        s = int(t * SR); y[s:s + len(click)] += click[:len(y) - s]
+    soundfile.write(str(path), y, SR)
+    return truth
+
+
+def baseline_envelope(path):
+    # Onset envelope trước khi dùng chung STFT: librosa.effects.percussive rồi onset_strength
+    y, sr = librosa.load(str(path), sr=None, mono=True)
+    y_percussive = librosa.effects.percussive(y, margin=beat_analysis.HPSS_MARGIN)
+    return librosa.onset.onset_strength(y=y_percussive, sr=sr, hop_length=beat_analysis.ANALYSIS_HOP_LENGTH, aggregate=np.median)
+
+
+@pytest.mark.parametrize("bpm", [90, 120, 174])
+def test_full_onset_envelope_matches_percussive_baseline(tmp_path, bpm):
+    path = tmp_path / "click.wav"
+    click_track(path, bpm)
+    beat_analysis.load_librosa()
+    env, sr, hop, frame_features = beat_analysis._full_onset_envelope(str(path), lambda *a: None)
+    np.testing.assert_array_equal(env, baseline_envelope(path))
+    assert frame_features.shape == (4, len(env))
+
+
+@pytest.mark.parametrize("bpm", [90, 120])
+def test_click_track_beats(tmp_path, bpm):
+    path = tmp_path / "click.wav"
+    truth = click_track(path, bpm)
+    result = beat_analysis.analyze_beats(str(path), streaming=False)
+    assert result["success"]
+    beats = np.array([b[0] for b in result["beats"]])
+    hits = sum(np.min(np.abs(beats - t)) < 0.07 for t in truth)
+    assert hits == len(truth)
+    assert len(beats) == len(truth)
+
+
+def test_constant_click_is_one_section(tmp_path):
+    path = tmp_path / "click.wav"
+    click_track(path, 150, duration=120.0, start=0.0)
+    result = beat_analysis.analyze_beats(str(path), user_tempo=150, streaming=False)
+    assert result["success"]
+    assert int(result["features"]["section"].max()) == 0
+
+
+def test_beat_windows_partition_between_beats():
+    frames = np.array([10, 20, 31, 100])
+    start, end = beat_analysis._beat_windows(frames)
+    assert start.tolist() == [10 - beat_analysis.BEAT_FEATURE_HALF_FRAMES, 15, 26, 100 - beat_analysis.BEAT_FEATURE_HALF_FRAMES]
+    assert end.tolist() == [15, 26, 31 + beat_analysis.BEAT_FEATURE_HALF_FRAMES, 100 + beat_analysis.BEAT_FEATURE_HALF_FRAMES]
@@ -0,0 +1,72 @@
+import os
+from array import array
+
+import numpy as np
+import pytest
+
+import beat_cache
+from timeline import BEAT_FEATURE_DTYPE
+
+BEATS = [(0.5, 0.25), (1.0, 1.0), (1.5, 0.625)]
+
+
+def v1_entry(tempo, beats):
+    # Định dạng version 1 (trước khi lưu đặc trưng beat): header + time[f64] + intensity[f32]
+    times = array('d', (b[0] for b in beats)); intensities = array('f', (b[1] for b in beats))
+    return beat_cache._HEADER.pack(beat_cache.CACHE_MAGIC, 1, tempo, len(beats)) + times.tobytes() + intensities.tobytes()
+
+
+def test_encode_decode_round_trip():
+    features = np.zeros(len(BEATS), dtype=BEAT_FEATURE_DTYPE)
+    features['low'] = [0.1, 0.5, 1.0]; features['centroid'] = [800, 1200, 3000]
+    features['bar_position'] = [0, 1, 2]; features['section'] = [0, 0, 3]
+    entry = beat_cache.decode_entry(beat_cache.encode_entry(120.0, BEATS, features))
+    assert entry["tempo"] == 120.0
+    assert entry["beats"] == BEATS
+    np.testing.assert_array_equal(entry["features"], features)
+
+
+def test_encode_without_features_stores_zeros():
+    entry = beat_cache.decode_entry(beat_cache.encode_entry(90.0, BEATS))
+    assert entry["features"].dtype == BEAT_FEATURE_DTYPE
+    assert not entry["features"]['section'].any()
+
+
+def test_decode_rejects_truncated_entry():
+    data = beat_cache.encode_entry(120.0, BEATS)
+    with pytest.raises(ValueError): beat_cache.decode_entry(data[:-1])
+
+
+def test_v1_entry_is_a_miss_then_replaced(tmp_path):
+    path = tmp_path / ("k1" + beat_cache.CACHE_SUFFIX)
+    path.write_bytes(v1_entry(128.0, BEATS))
+    cache = beat_cache.BeatCache(str(tmp_path), 1 << 20)
+    assert cache.get("k1") is None
+    assert not path.exists()
+    assert cache.stats()["misses"] == 1 and cache.stats()["entries"] == 0
+    cache.put("k1", 128.0, BEATS)
+    _, version, _, _ = beat_cache._HEADER.unpack_from(path.read_bytes())
+    assert version == beat_cache.CACHE_VERSION
+    assert cache.get("k1")["beats"] == BEATS
+
+
+def test_lru_eviction(tmp_path):
+    size = len(beat_cache.encode_entry(120.0, BEATS))
+    cache = beat_cache.BeatCache(str(tmp_path), size * 2)
+    cache.put("a", 120.0, BEATS); cache.put("b", 120.0, BEATS)
+    assert cache.get("a") is not None  # a mới dùng -> b cũ nhất
+    cache.put("c", 120.0, BEATS)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert sorted(os.listdir(tmp_path)) == ["a" + beat_cache.CACHE_SUFFIX, "c" + beat_cache.CACHE_SUFFIX]
+    assert cache.stats()["bytes"] == size * 2
+
+
+def test_index_reloads_oldest_first(tmp_path):
+    size = len(beat_cache.encode_entry(120.0, BEATS))
+    cache = beat_cache.BeatCache(str(tmp_path), size * 2)
+    cache.put("a", 120.0, BEATS); cache.put("b", 120.0, BEATS)
+    os.utime(tmp_path / ("a" + beat_cache.CACHE_SUFFIX), (1, 1))
+    cache = beat_cache.BeatCache(str(tmp_path), size * 2)
+    cache.put("c", 120.0, BEATS)
+    assert cache.get("a") is None and cache.get("b") is not None
@@ -0,0 +1,76 @@
+import socket
+
+import pytest
+
+import clock_sync
+from clock_sync import ClockSyncServer, CLOCK_SYNC_PACKET, CMD_CLOCK_SYNC_REQUEST, CMD_CLOCK_SYNC_REPLY, WIRE_MASK
+from timed_sync_sim import VirtualStick, NetworkModel, _int32
+
+
+@pytest.fixture
+def server():
+    server = ClockSyncServer(port=0, host='127.0.0.1')
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def client():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); sock.settimeout(2.0)
+    yield sock
+    sock.close()
+
+
+def exchange(server, client, t0):
+    client.sendto(CLOCK_SYNC_PACKET.pack(CMD_CLOCK_SYNC_REQUEST, t0, 0, 0), server._sock.getsockname())
+    return CLOCK_SYNC_PACKET.unpack(client.recv(64))
+
+
+def test_reply_wraps_server_time_to_32_bits(server, client, monkeypatch):
+    ticks = iter([(1 << 32) - 3, (1 << 32) + 9])  # t1 trước, t2 sau khi quay vòng
+    monkeypatch.setattr(clock_sync, "server_time_us", lambda: next(ticks))
+    command, t0, t1, t2 = exchange(server, client, 0xFFFFFFF0)
+    assert (command, t0, t1, t2) == (CMD_CLOCK_SYNC_REPLY, 0xFFFFFFF0, WIRE_MASK - 2, 9)
+    assert _int32(t2 - t1) == 12
+    assert server.stats()["requests"] == 1
+
+
+def test_invalid_requests_are_counted_not_answered(server, client):
+    client.sendto(b"\x10" * 5, server._sock.getsockname())
+    client.sendto(CLOCK_SYNC_PACKET.pack(CMD_CLOCK_SYNC_REPLY, 1, 0, 0), server._sock.getsockname())
+    assert exchange(server, client, 7)[1] == 7
+    assert server.stats()["invalid"] == 2
+
+
+def test_stick_offset_across_local_wraparound():
+    # Gậy: t0 ngay trước khi millis/micros 32 bit quay vòng, t3 sau khi quay vòng
+    stick = VirtualStick(NetworkModel())
+    stick.local_us = lambda ns=None: 0x20
+    stick._on_sync_reply(CLOCK_SYNC_PACKET.pack(CMD_CLOCK_SYNC_REPLY, 0xFFFFFFF0, 100, 110))
+    # rtt = (t3 - t0) - (t2 - t1) = 48 - 10; offset = ((t1 - t0) + (t2 - t3)) / 2 = (116 + 78) / 2
+    assert stick.samples == [(38, 97)] and stick.clock_offset_us == 97
+
+
+def test_stick_keeps_offset_of_fastest_sample():
+    stick = VirtualStick(NetworkModel())
+    for t3, t1 in ((1_000, 5_500), (2_000, 6_100)):
+        stick.local_us = lambda ns=None, t3=t3: t3
+        stick._on_sync_reply(CLOCK_SYNC_PACKET.pack(CMD_CLOCK_SYNC_REPLY, t3 - 600, t1, t1 + 10))
+    assert [rtt for rtt, _ in stick.samples] == [590, 590]
+    stick.local_us = lambda ns=None: 3_050
+    stick._on_sync_reply(CLOCK_SYNC_PACKET.pack(CMD_CLOCK_SYNC_REPLY, 3_000, 7_020, 7_030))
+    assert stick.clock_offset_us == 4_000  # RTT 40 thắng hai mẫu RTT 590
+
+
+def test_live_exchange_recovers_offset(server, client):
+    # Đồng hồ gậy lệch ~2^32 µs so với server và quay vòng ngay sau t0
+    offset = (1 << 32) - clock_sync.server_time_us() - 300
+    local = lambda: (clock_sync.server_time_us() + offset) & WIRE_MASK
+    t0 = local()
+    _, _, t1, t2 = exchange(server, client, t0)
+    t3 = local()
+    rtt = _int32(t3 - t0) - _int32(t2 - t1)
+    estimate = (_int32(t1 - t0) + _int32(t2 - t3)) // 2
+    assert 0 <= rtt < 100_000
+    assert abs(estimate - _int32(-offset)) <= rtt // 2 + 1
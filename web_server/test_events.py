@@ -0,0 +1,60 @@
+import json
+
+import events
+from events import EventBus, sse_format
+
+
+def parse(event):
+    fields = dict(line.split(": ", 1) for line in event.strip().splitlines())
+    return int(fields["id"]) if "id" in fields else None, fields["event"], json.loads(fields["data"])
+
+
+def test_version_changes_only_on_real_change():
+    bus = EventBus()
+    assert bus.set("mode", {"mode": "idle"}) and bus.version == 1
+    assert not bus.set("mode", {"mode": "idle"}) and bus.version == 1  # ETag giữ nguyên -> client nhận 304
+    bus.push("beat", {"index": 3})
+    assert bus.version == 1
+    assert bus.set("mode", {"mode": "beat"}) and bus.set("ip", "10.0.0.2")
+    assert bus.snapshot() == (3, {"mode": {"mode": "beat"}, "ip": "10.0.0.2"})
+
+
+def test_sse_format():
+    assert sse_format("ip", "1.2.3.4", 7) == 'id: 7\nevent: ip\ndata: "1.2.3.4"\n\n'
+    assert sse_format("beat", {"i": 1}) == 'event: beat\ndata: {"i":1}\n\n'
+
+
+def test_subscribe_replays_history_after_last_event_id():
+    bus = EventBus()
+    for i in range(5): bus.set("n", i)
+    sub, initial = bus.subscribe(last_event_id=2)
+    assert [parse(event) for event in initial] == [(3, "n", 2), (4, "n", 3), (5, "n", 4)]
+    bus.set("n", 5); bus.push("beat", 1)
+    assert [parse(sub.queue.get_nowait()) for _ in range(2)] == [(6, "n", 5), (None, "beat", 1)]
+    _, initial = bus.subscribe(last_event_id=6)
+    assert initial == []  # đã cập nhật
+
+
+def test_subscribe_falls_back_to_snapshot(monkeypatch):
+    monkeypatch.setattr(events, "HISTORY_SIZE", 3)
+    bus = EventBus()
+    for i in range(6): bus.set("n", i)
+    bus.set("ip", "10.0.0.2")
+    # Lịch sử chỉ còn version 5..7: client ở version 3 đã lỡ version 4 -> snapshot
+    for last_event_id in (None, 3):
+        _, initial = bus.subscribe(last_event_id=last_event_id)
+        assert [parse(event) for event in initial] == [(7, "snapshot", {"n": 5, "ip": "10.0.0.2"})]
+    _, initial = bus.subscribe(last_event_id=4)
+    assert [parse(event)[0] for event in initial] == [5, 6, 7]
+
+
+def test_slow_subscriber_is_dropped(monkeypatch):
+    monkeypatch.setattr(events, "SUBSCRIBER_QUEUE_SIZE", 2)
+    bus = EventBus()
+    sub, _ = bus.subscribe()
+    for i in range(3): bus.set("n", i)
+    assert sub.dropped and sub not in bus.subscribers
+    stream = bus.stream(last_event_id=2)
+    assert next(stream) == sse_format("n", 2, 3)  # client kết nối lại với Last-Event-ID
+    stream.close()
+    assert not bus.subscribers
@@ -0,0 +1,63 @@
+import io
+import wave
+
+import numpy as np
+import pytest
+
+from live_input import OnsetDetector, PcmStreamSource, LIVE_N_FFT, LIVE_HOP, LIVE_BLOCK
+
+SR = 44100
+
+
+def click_track(times, duration, sr=SR, seed=0):
+    # Click 1 kHz tắt dần trên nền nhiễu nhẹ, như click track của benchmark.py
+    audio = (0.01 * np.random.default_rng(seed).standard_normal(int(duration * sr))).astype(np.float32)
+    t = np.arange(int(0.03 * sr)) / sr
+    click = (np.sin(2 * np.pi * 1000 * t) * np.exp(-t * 150)).astype(np.float32)
+    for start in (np.asarray(times) * sr).astype(np.int64): audio[start:start + len(click)] += click
+    return audio
+
+
+def detect(audio, block=LIVE_BLOCK, sr=SR):
+    detector = OnsetDetector(sr)
+    onsets = []
+    for start in range(0, len(audio), block): onsets.extend(detector.push(audio[start:start + block]))
+    return onsets
+
+
+def test_fires_once_per_click_within_one_frame():
+    clicks = np.arange(0.5, 6.0, 0.5)
+    onsets = detect(click_track(clicks, 6.5))
+    assert len(onsets) == len(clicks)
+    # Mẫu cuối của frame phát hiện nằm sau click, trễ không quá một frame + một hop
+    delays = np.array([end for end, _ in onsets]) - clicks * SR
+    assert (delays > 0).all() and (delays <= LIVE_N_FFT + LIVE_HOP).all()
+    assert all(0.0 < strength <= 1.0 for _, strength in onsets)
+
+
+@pytest.mark.parametrize("block", [1000, 128, 77])
+def test_block_size_does_not_change_onsets(block):
+    audio = click_track(np.arange(0.5, 4.0, 0.25), 4.5, seed=1)
+    assert detect(audio, block) == detect(audio)
+
+
+def test_dead_time_suppresses_double_trigger():
+    onsets = detect(click_track([0.5, 0.55, 1.0, 1.5], 2.0))
+    assert len(onsets) == 3
+    assert [round(end / SR, 1) for end, _ in onsets] == [0.5, 1.0, 1.5]
+
+
+def test_silence_never_fires():
+    assert detect(np.zeros(3 * SR, dtype=np.float32)) == []
+
+
+def test_pcm_stream_source_downmixes_wav():
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(2); wav.setsampwidth(2); wav.setframerate(8000)
+        wav.writeframes(np.array([[16384, 0]] * 300, dtype='<i2').tobytes())
+    buffer.seek(0)
+    source = PcmStreamSource(buffer, block=256)
+    blocks = [samples for samples, _ in source.blocks()]
+    assert [len(b) for b in blocks] == [256, 44] and source.sample_rate == 8000
+    assert np.allclose(np.concatenate(blocks), 0.25)
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+import packet_log
+import log_analyzer
+
+SENT0_NS = 1_700_000_000_000_000_000
+PACKETS = 300
+LOST = [10, 11, 12, 50] + list(range(200, 208))
+OFFSET_MS = 5000
+DRIFT_PPM = 100
+BASE_LATENCY_MS = 2
+
+
+def sent_ns(i):
+    return SENT0_NS + i * 1_000_000_000  # 1 gói/giây -> 5 cửa sổ fit offset
+
+
+def recv_ms(i, extra_ms=0):
+    # millis() của thiết bị: offset + trôi đồng hồ + trễ mạng
+    return OFFSET_MS + int(i * 1000 * (1 + DRIFT_PPM * 1e-6)) + BASE_LATENCY_MS + extra_ms
+
+
+def write_sent(tmp_path, binary):
+    path = tmp_path / ("sent.bin" if binary else "sent.log")
+    if binary:
+        records = np.zeros(PACKETS, dtype=packet_log.PACKET_LOG_DTYPE)
+        records['packet_id'] = np.arange(PACKETS)[::-1]; records['sent_ns'] = [sent_ns(i) for i in range(PACKETS)][::-1]
+        header = packet_log._HEADER.pack(packet_log.PACKET_LOG_MAGIC, packet_log.PACKET_LOG_VERSION, packet_log.PACKET_LOG_DTYPE.itemsize)
+        path.write_bytes(header + records.tobytes())
+    else:
+        path.write_text("".join(f"LOG,SENT,{i},1,255,0,0,{sent_ns(i)}\n" for i in range(PACKETS)) + "khởi động lại\n")
+    return str(path)
+
+
+def write_recv(tmp_path):
+    lines = ["rst:0x1 (POWERON_RESET)", "LOG,RECV,12"]  # dòng rác và dòng cụt
+    for i in range(PACKETS):
+        if i in LOST: continue
+        lines.append(f"LOG,RECV,{i},1,255,0,0,{recv_ms(i, 40 if i == 100 else 0)}")
+        if i == 20: lines.append(lines[-1])  # gói lặp
+    lines.append(f"LOG,RECV,99999,1,0,0,0,{recv_ms(PACKETS)}")
+    path = tmp_path / "stick1.log"
+    path.write_text("\n".join(lines) + "\n")
+    return str(path)
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_join_loss_and_drift(tmp_path, binary):
+    report = log_analyzer.analyze(write_sent(tmp_path, binary), [write_recv(tmp_path)])
+    assert report["sent"] == PACKETS
+    device, = report["devices"]
+    assert device["device"] == "stick1"
+    assert (device["received"], device["matched"], device["unknown_ids"], device["duplicates"]) == (PACKETS - len(LOST) + 1, PACKETS - len(LOST), 1, 1)
+    assert (device["expected"], device["lost"]) == (PACKETS, len(LOST))
+    assert device["burst_loss"]["histogram"] == {"1": 1, "3": 1, "8": 1} and device["burst_loss"]["max"] == 8
+    assert device["clock"]["drift_ppm"] == pytest.approx(DRIFT_PPM, abs=5)
+    assert device["clock"]["offset_ms"] == pytest.approx(OFFSET_MS + BASE_LATENCY_MS - SENT0_NS / 1e6, abs=1.5)
+    assert device["latency_ms"]["p50"] == pytest.approx(0, abs=1.5)
+    assert device["latency_ms"]["max"] == pytest.approx(40, abs=1.5)
+    assert device["gaps"]["over_udp_timeout"] == 1 and device["gaps"]["max_ms"] == pytest.approx(9000, abs=2)
+
+
+def test_block_boundary_does_not_split_lines(tmp_path, monkeypatch):
+    monkeypatch.setattr(log_analyzer, "READ_BLOCK_BYTES", 7)
+    ids, millis, duplicates = log_analyzer.load_recv(write_recv(tmp_path))
+    assert len(ids) == PACKETS - len(LOST) + 1 and duplicates == 1
+    assert millis[ids == 100][0] == recv_ms(100, 40)
+
+
+def test_device_without_matches(tmp_path):
+    recv = tmp_path / "other.log"; recv.write_text("LOG,RECV,5000,1,0,0,0,10\n")
+    device, = log_analyzer.analyze(write_sent(tmp_path, False), [str(recv)])["devices"]
+    assert device["matched"] == 0 and "expected" not in device
@@ -0,0 +1,58 @@
+import math
+
+import pytest
+
+from metrics import Registry, CONTENT_TYPE
+
+
+def test_counter_exposition():
+    registry = Registry()
+    packets = registry.counter('t_packets_total', 'Gói đã gửi', ('mode',))
+    packets.labels('beat').inc(); packets.labels('beat').inc(2); packets.labels('say "hi"\n').inc()
+    registry.counter('t_plain_total', 'Không nhãn').inc(5)
+    assert registry.render() == (
+        '# HELP t_packets_total Gói đã gửi\n'
+        '# TYPE t_packets_total counter\n'
+        't_packets_total{mode="beat"} 3\n'
+        't_packets_total{mode="say \\"hi\\"\\n"} 1\n'
+        '# HELP t_plain_total Không nhãn\n'
+        '# TYPE t_plain_total counter\n'
+        't_plain_total 5\n')
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    hist = registry.histogram('t_seconds', 'Độ trễ', (0.5, 0.1))
+    for value in (0.05, 0.1, 0.3, 2.0): hist.observe(value)
+    assert registry.render().splitlines() == [
+        '# HELP t_seconds Độ trễ', '# TYPE t_seconds histogram',
+        't_seconds_bucket{le="0.1"} 2',  # le là cận trên bao gồm
+        't_seconds_bucket{le="0.5"} 3',
+        't_seconds_bucket{le="+Inf"} 4',
+        't_seconds_sum 2.45', 't_seconds_count 4']
+
+
+def test_labeled_histogram_puts_le_last():
+    registry = Registry()
+    registry.histogram('t_stage_seconds', 'Giai đoạn', (1.0,), ('stage',)).labels('load').observe(0.5)
+    assert 't_stage_seconds_bucket{stage="load",le="1.0"} 1' in registry.render().splitlines()
+    assert 't_stage_seconds_count{stage="load"} 1' in registry.render().splitlines()
+
+
+def test_callbacks_and_special_values():
+    registry = Registry()
+    registry.gauge_callback('t_queue', 'Hàng đợi', lambda: 4)
+    registry.gauge_callback('t_dest_up', 'Đích', lambda: {('239.1.1.1',): 1, ('239.1.1.2',): None, ('239.1.1.3',): math.inf}, ('group',))
+    registry.counter_callback('t_broken_total', 'Lỗi', lambda: 1 / 0)
+    assert registry.render().splitlines() == [
+        '# HELP t_queue Hàng đợi', '# TYPE t_queue gauge', 't_queue 4',
+        '# HELP t_dest_up Đích', '# TYPE t_dest_up gauge', 't_dest_up{group="239.1.1.1"} 1', 't_dest_up{group="239.1.1.3"} +Inf',
+        '# t_broken_total: lỗi đọc số liệu: ZeroDivisionError']
+
+
+def test_reregister_reuses_series():
+    registry = Registry()
+    first = registry.counter('t_total', 'x'); first.inc()
+    assert registry.counter('t_total', 'x') is first
+    with pytest.raises(ValueError): registry.counter('t_l_total', 'x', ('a',)).labels()
+    assert CONTENT_TYPE.startswith('text/plain; version=0.0.4')
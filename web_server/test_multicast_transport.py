@@ -0,0 +1,57 @@
+import errno
+import socket
+
+import pytest
+
+import multicast_transport
+from multicast_transport import MulticastTransport
+
+
+@pytest.fixture
+def receivers():
+    socks = []
+    for _ in range(2):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); sock.bind(("127.0.0.1", 0)); sock.settimeout(1.0)
+        socks.append(sock)
+    yield socks
+    for sock in socks: sock.close()
+
+
+@pytest.fixture
+def transport():
+    transport = MulticastTransport()
+    yield transport
+    transport.close()
+
+
+@pytest.mark.parametrize("batched", [True, False])
+def test_error_is_charged_to_failing_destination_only(receivers, transport, monkeypatch, batched):
+    if not batched: monkeypatch.setattr(multicast_transport, "_sendmmsg", None)
+    elif multicast_transport._sendmmsg is None: pytest.skip("không có sendmmsg")
+    # Broadcast khi chưa bật SO_BROADCAST -> EACCES chỉ cho đích giữa lô
+    a, b = (sock.getsockname()[1] for sock in receivers)
+    transport.configure([("127.0.0.1", a, "127.0.0.1"), ("255.255.255.255", a, "127.0.0.1"), ("127.0.0.1", b, "127.0.0.1")])
+    assert transport.send(b"\x01\x02\x03\x04\x05\x06\x07\x08") == 2
+    assert [sock.recv(64) for sock in receivers] == [b"\x01\x02\x03\x04\x05\x06\x07\x08"] * 2
+    good, bad, other = transport.stats()
+    assert (good["sent"], good["errors"], other["sent"], other["errors"]) == (1, 0, 1, 0)
+    assert bad["sent"] == 0 and bad["errors"] == 1 and "PermissionError" in bad["last_error"]
+    assert not transport.all_down()
+
+
+def test_full_socket_buffer_drops_rest_of_run(transport, monkeypatch):
+    transport.configure([("127.0.0.1", port, "127.0.0.1") for port in (9, 10, 11)])
+    endpoint = transport.endpoints["127.0.0.1"]
+    monkeypatch.setattr(endpoint, "_send_run", lambda frame, start, end: (1, OSError(errno.EAGAIN, "full")) if start == 0 else pytest.fail("gửi tiếp khi buffer đầy"))
+    assert transport.send(b"\x00" * 8) == 1
+    assert [(d["sent"], d["dropped"], d["errors"]) for d in transport.stats()] == [(1, 0, 0), (0, 1, 0), (0, 1, 0)]
+
+
+def test_down_destination_splits_batch(transport, monkeypatch):
+    transport.configure([("127.0.0.1", port, "127.0.0.1") for port in (9, 10, 11)])
+    transport.destinations[1].down_until = float("inf")
+    endpoint = transport.endpoints["127.0.0.1"]
+    runs = []
+    monkeypatch.setattr(endpoint, "_send_run", lambda frame, start, end: runs.append((start, end)) or (end - start, None))
+    assert transport.send(b"\x00" * 8) == 2
+    assert runs == [(0, 1), (2, 3)]
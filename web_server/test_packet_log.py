@@ -0,0 +1,74 @@
+import numpy as np
+
+from packet_log import PacketLog, read_packet_log, iter_csv_lines
+
+
+def log_with(tmp_path, capacity):
+    log = PacketLog(str(tmp_path), capacity=capacity, flush_interval=3600)
+    log.wall_offset_ns = 1000
+    return log
+
+
+def start_without_writer(log):
+    # Mở file nhưng dừng thread writer ngay: test tự gọi flush(), không tranh với writer
+    log.start()
+    log._stop = True; log._wake.set(); log._thread.join()
+
+
+def record(log, ids):
+    for i in ids: log.record(i, 0x01, i % 256, 2, 3, i * 10, i * 10 + 5)
+
+
+def test_flush_across_ring_wraparound(tmp_path):
+    log = log_with(tmp_path, 8)
+    start_without_writer(log)
+    try:
+        record(log, range(6)); assert log.flush() == 6
+        record(log, range(6, 13))  # head 13, tail 6: khối [6 % 8, 13 % 8) vòng qua cuối ring
+        assert log.flush() == 7
+        assert log.flush() == 0
+    finally:
+        log.close()
+    records = read_packet_log(log.path)
+    assert records['packet_id'].tolist() == list(range(13))
+    assert records['scheduled_ns'].tolist() == [i * 10 + 1000 for i in range(13)]
+    assert records['sent_ns'].tolist() == [i * 10 + 1005 for i in range(13)]
+    assert log.stats()["written"] == 13 and log.stats()["dropped"] == 0
+
+
+def test_flush_when_ring_is_exactly_full(tmp_path):
+    log = log_with(tmp_path, 4)
+    start_without_writer(log)
+    try:
+        record(log, range(2)); log.flush()
+        record(log, range(2, 6))  # head - tail == capacity, start == end
+        assert log.flush() == 4
+    finally:
+        log.close()
+    assert read_packet_log(log.path)['packet_id'].tolist() == list(range(6))
+
+
+def test_full_ring_drops_instead_of_overwriting(tmp_path):
+    log = log_with(tmp_path, 4)
+    record(log, range(6))
+    assert log.dropped == 2 and log.head - log.tail == 4
+    assert log.ring['packet_id'].tolist() == [0, 1, 2, 3]
+
+
+def test_iter_csv_lines_chunks(tmp_path):
+    log = log_with(tmp_path, 8)
+    start_without_writer(log)
+    try:
+        record(log, range(6)); log.flush(); record(log, range(6, 11))
+    finally:
+        log.close()
+    lines = "".join(iter_csv_lines(log.path, chunk=3)).splitlines()
+    assert lines[0] == "packet_id,command,r,g,b,scheduled_ns,sent_ns"
+    assert lines[1:] == [f"{i},1,{i},2,3,{i * 10 + 1000},{i * 10 + 1005}" for i in range(11)]
+
+
+def test_empty_log_reads_as_no_records(tmp_path):
+    log = log_with(tmp_path, 4)
+    start_without_writer(log); log.close()
+    assert len(read_packet_log(log.path)) == 0
+    assert list(iter_csv_lines(log.path)) == ["packet_id,command,r,g,b,scheduled_ns,sent_ns\n"]
@@ -0,0 +1,64 @@
+import time
+import queue
+import threading
+
+import scheduler
+from scheduler import LatenessHistogram, BeatScheduler
+
+
+def histogram(*samples):
+    hist = LatenessHistogram(bin_ns=10, max_ns=100)
+    for late_ns in samples: hist.record(late_ns)
+    return hist
+
+
+def test_record_bucket_edges():
+    hist = histogram(-5, 0, 9, 10, 99, 100, 10 ** 9)
+    assert len(hist.bins) == 11
+    assert hist.bins[0] == 3 and hist.bins[1] == 1 and hist.bins[9] == 1
+    assert hist.bins[10] == 2  # bin tràn: >= max_ns của histogram
+    assert hist.max_ns == 10 ** 9 and hist.total_ns == 9 + 10 + 99 + 100 + 10 ** 9
+
+
+def test_percentile_is_bin_upper_edge():
+    hist = histogram(*([5] * 99), 95)
+    assert hist.percentile_ns(0.50) == 10
+    assert hist.percentile_ns(0.99) == 10
+    assert histogram(10, 10).percentile_ns(0.5) == 10  # mẫu đúng mép bin 1 -> cận trên 20, kẹp về max 10
+    assert histogram(0, 10, 20, 30).percentile_ns(0.5) == 20
+
+
+def test_percentile_clamped_to_max_sample():
+    assert histogram(3).percentile_ns(0.5) == 3
+    assert histogram(*([5] * 99), 95).percentile_ns(1.0) == 95
+    assert histogram(1, 250).percentile_ns(0.99) == 250  # bin tràn không có cận trên
+    assert histogram().percentile_ns(0.99) == 0
+
+
+def test_within_ns_counts_whole_bins_below_limit():
+    hist = histogram(0, 9, 10, 19, 20, 500)
+    assert hist.within_ns(20) == 4 / 6
+    assert hist.within_ns(10) == 2 / 6
+    assert histogram().within_ns(20) == 1.0
+
+
+def test_wait_until_returns_early_on_inbox_message():
+    sched = BeatScheduler()
+    inbox = queue.Queue()
+    threading.Timer(0.02, inbox.put, args=("stop",)).start()
+    t0 = time.monotonic()
+    assert sched.wait_until(scheduler.clock_ns() + 2_000_000_000, inbox) == "stop"
+    assert time.monotonic() - t0 < 0.5
+
+
+def test_wait_until_reaches_target_without_message():
+    sched = BeatScheduler()
+    inbox = queue.Queue()
+    target = scheduler.clock_ns() + 20_000_000
+    assert sched.wait_until(target, inbox) is None
+    assert scheduler.clock_ns() >= target
+
+
+def test_wait_until_without_target_blocks_on_inbox():
+    inbox = queue.Queue(); inbox.put("cmd")
+    assert BeatScheduler().wait_until(None, inbox) == "cmd"
@@ -0,0 +1,102 @@
+import time
+import threading
+
+import pytest
+
+import sender_engine
+from sender_engine import SenderEngine, SenderBusy, Program, BlinkProgram
+
+
+class RecordingProgram(Program):
+    # mode 'idle': _apply không cần cấu hình socket
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+
+    def slow(self, engine):
+        self.calls.append('slow'); self.release.wait(5.0)
+        return 'slow'
+
+    def seek(self, engine, position):
+        self.calls.append(('seek', position))
+        return {'position': position}
+
+
+@pytest.fixture
+def engine():
+    engine = SenderEngine()
+    yield engine
+    engine.shutdown()
+
+
+def test_control_returns_result(engine):
+    program = RecordingProgram()
+    engine.submit(program)
+    assert engine.control('seek', 3.0) == {'position': 3.0}
+    assert engine.control('pause') is None
+
+
+def test_control_timeout_cancels_command(engine, monkeypatch):
+    monkeypatch.setattr(sender_engine, 'SUBMIT_ACK_TIMEOUT', 0.1)
+    program = RecordingProgram()
+    engine.submit(program)
+    slow = threading.Thread(target=engine.control, args=('slow',)); slow.start()
+    time.sleep(0.05)
+    with pytest.raises(SenderBusy): engine.control('seek', 1.0)
+    program.release.set(); slow.join()
+    assert engine.control('seek', 2.0) == {'position': 2.0}
+    assert program.calls == ['slow', ('seek', 2.0)]
+
+
+def test_control_running_past_timeout_still_returns_result(engine, monkeypatch):
+    monkeypatch.setattr(sender_engine, 'SUBMIT_ACK_TIMEOUT', 0.1)
+    program = RecordingProgram()
+    engine.submit(program)
+    threading.Timer(0.3, program.release.set).start()
+    assert engine.control('slow') == 'slow'
+
+
+class ResourceProgram(Program):
+    mode = 'static'
+
+    def __init__(self):
+        self.begun = False; self.ended = False
+
+    def begin(self, engine): self.begun = True
+
+    def end(self, engine): self.ended = True
+
+
+def test_submit_reports_rejected_program(engine):
+    program = ResourceProgram()
+    assert engine.submit(program, 'không-phải-ip', ['239.1.1.1']) is False
+    assert program.ended and not program.begun
+
+
+def test_submit_timeout_cancels_and_releases_program(engine, monkeypatch):
+    monkeypatch.setattr(sender_engine, 'SUBMIT_ACK_TIMEOUT', 0.1)
+    current = RecordingProgram()
+    assert engine.submit(current) is True
+    slow = threading.Thread(target=engine.control, args=('slow',)); slow.start()
+    time.sleep(0.05)
+    program = ResourceProgram()
+    with pytest.raises(SenderBusy): engine.submit(program, '127.0.0.1', ['239.1.1.1'])
+    current.release.set(); slow.join()
+    assert engine.control('seek', 1.0) == {'position': 1.0}
+    assert engine.program is current
+    assert program.ended and not program.begun
+
+
+@pytest.mark.parametrize("bad_ip", ['không-phải-ip', '10.254.254.254'])
+def test_rejected_program_keeps_current_one_running(engine, bad_ip):
+    # IP sai cú pháp (ValueError/OSError khi parse) hoặc không bind được (EADDRNOTAVAIL khi mở socket)
+    assert engine.submit(BlinkProgram(), '127.0.0.1', ['239.1.1.1']) is True
+    current = engine.program
+    program = ResourceProgram()
+    assert engine.submit(program, bad_ip, ['239.1.1.1']) is False
+    assert program.ended and not program.begun
+    assert engine.program is current and engine.mode == 'blink'
+    assert [d["iface"] for d in engine.destinations()] == ['127.0.0.1']
+    sent = engine.sent_count
+    time.sleep(sender_engine.BLINK_INTERVAL * 2.5)
+    assert engine.sent_count > sent
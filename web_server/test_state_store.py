@@ -0,0 +1,145 @@
+import time
+import threading
+
+import pytest
+
+from events import EventBus
+from state_store import TrackQueue, StateStore
+
+
+def track(filename, tempo=120.0):
+    return {"filename": filename, "tempo": tempo}
+
+
+def filled(*filenames):
+    queue = TrackQueue()
+    ids = [queue.add(track(name)) for name in filenames]
+    return queue, ids
+
+
+def order(queue):
+    return [t["filename"] for t in queue.summary()]
+
+
+def test_add_appends_and_assigns_ids():
+    queue, ids = filled("a", "b", "c")
+    assert len(queue) == 3 and len(set(ids)) == 3
+    assert order(queue) == ["a", "b", "c"]
+    assert queue.get(ids[1])["filename"] == "b"
+
+
+def test_add_at_position():
+    queue, _ = filled("a", "b", "c")
+    queue.add(track("front"), position=0)
+    queue.add(track("middle"), position=2)
+    queue.add(track("end"), position=99)
+    assert order(queue) == ["front", "a", "middle", "b", "c", "end"]
+
+
+def test_pop_next_and_remove():
+    queue, ids = filled("a", "b", "c")
+    assert queue.pop_next()["filename"] == "a"
+    assert queue.remove(ids[2])["filename"] == "c"
+    assert queue.remove(ids[2]) is None
+    assert order(queue) == ["b"]
+    assert queue.find("a") is None and queue.find("c") is None
+    queue.pop_next()
+    assert queue.pop_next() is None
+
+
+def test_move():
+    queue, ids = filled("a", "b", "c", "d")
+    assert queue.move(ids[3], 0)
+    assert order(queue) == ["d", "a", "b", "c"]
+    assert queue.move(ids[3], 2)
+    assert order(queue) == ["a", "b", "d", "c"]
+    assert queue.move(ids[0], 10)
+    assert order(queue) == ["b", "d", "c", "a"]
+    assert not queue.move("t999", 0)
+
+
+def test_duplicate_filenames():
+    queue, ids = filled("a", "b", "a", "c", "a")
+    assert queue.find("a")["id"] == ids[0]
+    queue.move(ids[4], 0)
+    assert queue.find("a")["id"] == ids[4]
+    queue.remove(ids[4])
+    assert queue.find("a")["id"] == ids[0]
+    assert queue.remove_filename("a") == 2
+    assert order(queue) == ["b", "c"]
+    assert queue.find("a") is None and queue.remove_filename("a") == 0
+
+
+def test_first_and_get_by_id_with_duplicate_filenames():
+    queue = TrackQueue()
+    assert queue.first() is None
+    queue, ids = filled("a", "b", "a")
+    assert queue.first()["id"] == ids[0]
+    assert queue.get(ids[2])["id"] == ids[2] and queue.get("t999") is None
+    queue.move(ids[2], 0)
+    assert queue.first()["id"] == ids[2]
+
+
+def test_on_change_receives_version_outside_lock():
+    seen = []
+    queue = TrackQueue()
+    # Callback chạy sau khi nhả lock: thread khác lấy được lock ngay trong callback
+    def on_change(version):
+        probe = threading.Thread(target=queue.summary); probe.start(); probe.join(1.0)
+        seen.append((version, not probe.is_alive()))
+    queue.on_change = on_change
+    track_id = queue.add(track("a", tempo=128.0))
+    queue.remove_filename("missing")
+    queue.remove(track_id)
+    assert seen == [(1, True), (2, True)]
+
+
+def test_mutations_do_not_build_summary(monkeypatch):
+    queue, ids = filled(*[f"s{i}" for i in range(100)])
+    monkeypatch.setattr(TrackQueue, "summary", lambda self: pytest.fail("summary() trong thao tác ghi"))
+    queue.on_change = lambda version: None
+    queue.add(track("x")); queue.add(track("y"), position=0); queue.add(track("z"), position=50)
+    queue.move(ids[10], 99); queue.move(ids[20], 0); queue.remove(ids[30]); queue.pop_next(); queue.remove_filename("s40")
+    assert queue.version == 108
+
+
+def mutation_seconds(size, rounds=2000):
+    queue, _ = filled(*[f"s{i}" for i in range(size)])
+    queue.on_change = lambda version: None
+    start = time.perf_counter()
+    for i in range(rounds):
+        track_id = queue.add(track(f"n{i}"))
+        queue.move(track_id, 0); queue.move(track_id, size + 1)
+        queue.remove(queue.pop_next()["id"] if i % 2 else track_id)
+    return time.perf_counter() - start
+
+
+def test_mutation_cost_does_not_grow_with_queue():
+    # O(1): hàng đợi lớn gấp 100 lần không được chậm hơn đáng kể (O(n) sẽ chậm ~100 lần)
+    small = min(mutation_seconds(100) for _ in range(3))
+    large = min(mutation_seconds(10000) for _ in range(3))
+    assert large < small * 5
+
+
+def test_move_to_middle_touches_only_tail():
+    queue, ids = filled(*"abcdefgh")
+    queue.move(ids[0], 6)
+    assert order(queue) == list("bcdefgah")
+    queue.move(ids[7], 1)
+    assert order(queue) == list("bhcdefga")
+    queue.add(track("x"), position=3)
+    assert order(queue) == list("bhcxdefga")
+
+
+def test_state_store_publishes_queue_lazily():
+    bus = EventBus()
+    woken = []
+    store = StateStore(bus, on_queue_change=woken.append)
+    store.queue.add(track("a")); store.queue.add(track("b"))
+    assert woken == [1, 2]
+    assert bus.snapshot()[1]["queue"] == []
+    store.publish_queue()
+    version, state = bus.snapshot()
+    assert [t["filename"] for t in state["queue"]] == ["a", "b"]
+    store.publish_queue()
+    assert bus.snapshot()[0] == version
@@ -0,0 +1,65 @@
+import struct
+
+import numpy as np
+
+import timeline
+
+
+def hsv_to_rgb(h, s, v):
+    # Bản vô hướng trong web.py trước khi biên dịch timeline (baseline), giữ nguyên để so sánh
+    h_i = int(h * 6); f = h * 6 - h_i; p = v * (1 - s); q = v * (1 - f * s); t = v * (1 - (1 - f) * s)
+    if h_i == 0: r, g, b = v, t, p
+    elif h_i == 1: r, g, b = q, v, p
+    elif h_i == 2: r, g, b = p, v, t
+    elif h_i == 3: r, g, b = p, q, v
+    elif h_i == 4: r, g, b = t, p, v
+    elif h_i == 5: r, g, b = v, p, q
+    return int(r * 255), int(g * 255), int(b * 255)
+
+
+def baseline_packet(command_byte, intensity, hue, packet_id):
+    # Vòng gửi beat cũ: màu tính lúc gửi rồi struct.pack
+    value = timeline.MIN_INTENSITY + ((1.0 - timeline.MIN_INTENSITY) * intensity)
+    r, g, b = hsv_to_rgb(hue, 1.0, value)
+    return struct.pack('<BBBB I', command_byte, r, g, b, packet_id)
+
+
+def test_hsv_to_rgb_array_matches_scalar():
+    h, s, v = np.meshgrid(np.linspace(0, 1, 241, endpoint=False), np.linspace(0, 1, 11), np.linspace(0, 1, 11), indexing='ij')
+    h, s, v = h.ravel(), s.ravel(), v.ravel()
+    r, g, b = timeline.hsv_to_rgb_array(h, s, v)
+    expected = np.array([hsv_to_rgb(*x) for x in zip(h.tolist(), s.tolist(), v.tolist())])
+    np.testing.assert_array_equal(np.stack([r, g, b], axis=1), expected)
+
+
+def test_hsv_to_rgb_array_broadcasts_scalar_saturation():
+    h = np.array([0.0, 0.25, 0.5, 0.9]); v = np.array([1.0, 0.5, 0.3, 0.8])
+    r, g, b = timeline.hsv_to_rgb_array(h, 1.0, v)
+    assert list(zip(r.tolist(), g.tolist(), b.tolist())) == [hsv_to_rgb(x, 1.0, y) for x, y in zip(h.tolist(), v.tolist())]
+
+
+def test_compile_timeline_packets_match_baseline():
+    rng = np.random.default_rng(3)
+    beats = list(zip(np.sort(rng.uniform(0, 180, 400)).tolist(), rng.random(400).tolist()))
+    compiled = timeline.compile_timeline("song.mp3", beats, 0x01, seed=7)
+    hues = np.random.default_rng(7).random(len(beats)).tolist()
+    assert len(compiled) == len(beats) and len(compiled.buffer) == len(beats) * timeline.PACKET_SIZE
+    for i, ((t, intensity), hue) in enumerate(zip(beats, hues)):
+        assert bytes(compiled.packet(i, 1000 + i)) == baseline_packet(0x01, intensity, hue, 1000 + i)
+        assert compiled.times[i] == round(t * 1e9) / 1e9
+
+
+def test_compile_timeline_sorts_beats_and_features():
+    features = np.zeros(3, dtype=timeline.BEAT_FEATURE_DTYPE)
+    features['section'] = [2, 0, 1]; features['low'] = 1.0
+    compiled = timeline.compile_timeline("x", [(3.0, 1.0), (1.0, 1.0), (2.0, 1.0)], 0x01, features=features)
+    assert compiled.times == [1.0, 2.0, 3.0]
+    assert compiled.features['section'].tolist() == [0, 1, 2]
+    assert compiled.describe()["sections"] == 3
+
+
+def test_packet_stamps_id_in_place():
+    compiled = timeline.compile_timeline("x", [(0.5, 1.0), (1.0, 0.0)], 0x01, seed=1)
+    first = bytes(compiled.packet(1, 7)); second = bytes(compiled.packet(1, 0xFFFFFFFF))
+    assert first[:4] == second[:4]
+    assert struct.unpack_from('<I', first, 4)[0] == 7 and struct.unpack_from('<I', second, 4)[0] == 0xFFFFFFFF
@@ -0,0 +1,224 @@
+import sys
+import json
+import heapq
+import random
+import select
+import socket
+import struct
+import logging
+import argparse
+import threading
+
+import numpy as np
+
+from scheduler import clock_ns
+from clock_sync import ClockSyncServer, CLOCK_SYNC_PACKET, CMD_CLOCK_SYNC_REQUEST, CMD_CLOCK_SYNC_REPLY, WIRE_MASK, EPOCH_NS, server_time_us
+from sender_engine import SenderEngine, BeatProgram, TimedBeatProgram, TIMED_PACKET, CMD_BEAT_TIMED, CMD_BEAT_SYNC, MULTICAST_GROUP, MULTICAST_PORT
+from timeline import compile_timeline
+
+# So sánh gói 8 byte (sáng khi nhận) với gói hẹn giờ (sáng theo đồng hồ chung) qua loopback,
+# chèn độ trễ/mất gói kiểu Wi-Fi ở phía gậy ảo: python timed_sync_sim.py [--lookahead-ms 150]
+LOOPBACK_IP = '127.0.0.1'
+SIM_CLOCK_SYNC_PORT = 1245
+CLOCK_SYNC_INTERVAL = 1.0   # khớp CLOCK_SYNC_INTERVAL trong main.cpp
+CLOCK_SYNC_RETRY_INTERVAL = 0.05  # khớp CLOCK_SYNC_RETRY_INTERVAL: chưa đồng bộ thì hỏi dồn
+CLOCK_SAMPLES = 8
+RECENT_IDS = 32
+WARMUP_S = 3.0
+BEAT_INTERVAL_S = 0.25
+LEGACY_PACKET = struct.Struct('<BBBBI')
+
+
+def _int32(x):
+    x &= WIRE_MASK
+    return x - (1 << 32) if x & 0x80000000 else x
+
+
+class NetworkModel:
+    # Độ trễ = nền + phân phối mũ + thỉnh thoảng một "gai" lớn (power-save, retransmit); mất gói độc lập
+    def __init__(self, base_ms=2.0, jitter_ms=5.0, spike_prob=0.05, spike_min_ms=30.0, spike_max_ms=150.0, loss=0.05, seed=0):
+        self.base_ms = base_ms; self.jitter_ms = jitter_ms
+        self.spike_prob = spike_prob; self.spike_min_ms = spike_min_ms; self.spike_max_ms = spike_max_ms
+        self.loss = loss
+        self.rng = random.Random(seed)
+
+    def delay_ns(self):
+        if self.rng.random() < self.loss: return None
+        ms = self.base_ms + self.rng.expovariate(1.0 / self.jitter_ms) if self.jitter_ms > 0 else self.base_ms
+        if self.rng.random() < self.spike_prob: ms += self.rng.uniform(self.spike_min_ms, self.spike_max_ms)
+        return int(ms * 1e6)
+
+
+class VirtualStick:
+    # Cùng logic với loop() trong main.cpp: gói 8 byte sáng ngay; gói hẹn giờ bỏ trùng theo packet_id,
+    # đổi target_us sang đồng hồ gậy bằng offset có RTT nhỏ nhất trong CLOCK_SAMPLES mẫu gần nhất;
+    # trước lần đồng bộ đầu, gói hẹn giờ bị bỏ (không đánh dấu đã thấy) để bản lặp sau được hẹn giờ.
+    def __init__(self, network, drift_ppm=30.0, offset_us=123_456_789, sync_port=SIM_CLOCK_SYNC_PORT):
+        self.network = network
+        self.drift = drift_ppm * 1e-6
+        self.offset_us = offset_us
+        self.sync_port = sync_port
+        self.samples = []
+        self.clock_offset_us = None
+        self.recent_ids = []
+        self.fired = {}
+        self.received = 0; self.lost = 0; self.duplicates = 0; self.unsynced = 0
+        self._events = []
+        self._seq = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def local_us(self, ns=None):
+        server_us = ((clock_ns() if ns is None else ns) - EPOCH_NS) / 1000.0
+        return int(server_us * (1.0 + self.drift)) + self.offset_us
+
+    def _local_to_ns(self, local_us):
+        return EPOCH_NS + int((local_us - self.offset_us) / (1.0 + self.drift) * 1000)
+
+    def _push(self, due_ns, kind, *payload):
+        self._seq += 1
+        heapq.heappush(self._events, (due_ns, self._seq, kind, payload))
+
+    def start(self):
+        self.mc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.mc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.mc.bind(('', MULTICAST_PORT))
+        self.mc.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(MULTICAST_GROUP) + socket.inet_aton(LOOPBACK_IP))
+        self.sync = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sync.bind((LOOPBACK_IP, 0))
+        self._thread = threading.Thread(target=self._run, name="VirtualStick", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=2.0)
+        self.mc.close(); self.sync.close()
+
+    def true_offset_us(self):
+        now = clock_ns()
+        return (now - EPOCH_NS) / 1000.0 - self.local_us(now)
+
+    def _fire(self, packet_id, ideal_us):
+        if packet_id not in self.fired: self.fired[packet_id] = (ideal_us, server_time_us())
+
+    def _on_packet(self, data, sent_ns):
+        if len(data) == LEGACY_PACKET.size:
+            command, r, g, b, packet_id = LEGACY_PACKET.unpack(data)
+            # Bỏ keep-alive đen, chỉ tính beat; "đúng giờ" của gói thường là lúc server gửi
+            if command == CMD_BEAT_SYNC and (r or g or b): self._fire(packet_id, (sent_ns - EPOCH_NS) // 1000)
+        elif len(data) == TIMED_PACKET.size:
+            command, r, g, b, packet_id, target_us, _ = TIMED_PACKET.unpack(data)
+            if command != CMD_BEAT_TIMED: return
+            if self.clock_offset_us is None: self.unsynced += 1; return
+            if packet_id in self.recent_ids: self.duplicates += 1; return
+            self.recent_ids.append(packet_id); del self.recent_ids[:-RECENT_IDS]
+            ideal_us = (sent_ns - EPOCH_NS) // 1000 + _int32(target_us - ((sent_ns - EPOCH_NS) // 1000))
+            now_local = self.local_us()
+            fire_local = now_local + _int32((target_us - self.clock_offset_us) - now_local)
+            if fire_local <= now_local: self._fire(packet_id, ideal_us)
+            else: self._push(self._local_to_ns(fire_local), 'fire', packet_id, ideal_us)
+
+    def _on_sync_reply(self, data):
+        t3 = self.local_us()
+        command, t0, t1, t2 = CLOCK_SYNC_PACKET.unpack(data)
+        if command != CMD_CLOCK_SYNC_REPLY: return
+        rtt = _int32(t3 - t0) - _int32(t2 - t1)
+        offset = (_int32(t1 - t0) + _int32(t2 - t3)) // 2
+        self.samples.append((rtt, offset)); del self.samples[:-CLOCK_SAMPLES]
+        self.clock_offset_us = min(self.samples)[1]
+
+    def _run(self):
+        next_sync = clock_ns()
+        while not self._stop.is_set():
+            now = clock_ns()
+            if now >= next_sync:
+                next_sync = now + int((CLOCK_SYNC_INTERVAL if self.clock_offset_us is not None else CLOCK_SYNC_RETRY_INTERVAL) * 1e9)
+                delay = self.network.delay_ns()
+                request = CLOCK_SYNC_PACKET.pack(CMD_CLOCK_SYNC_REQUEST, self.local_us() & WIRE_MASK, 0, 0)
+                if delay is not None: self._push(now + delay, 'sync_send', request)
+            wake = min(self._events[0][0] if self._events else now + 50_000_000, next_sync)
+            readable, _, _ = select.select([self.mc, self.sync], [], [], max(0, wake - clock_ns()) / 1e9)
+            for sock in readable:
+                data = sock.recv(64); recv_ns = clock_ns()
+                delay = self.network.delay_ns()
+                if sock is self.mc:
+                    self.received += 1
+                    if delay is None: self.lost += 1; continue
+                    self._push(recv_ns + delay, 'packet', data, recv_ns)
+                elif delay is not None: self._push(recv_ns + delay, 'sync_reply', data)
+            while self._events and self._events[0][0] <= clock_ns():
+                _, _, kind, payload = heapq.heappop(self._events)
+                if kind == 'packet': self._on_packet(*payload)
+                elif kind == 'sync_reply': self._on_sync_reply(*payload)
+                elif kind == 'sync_send': self.sync.sendto(payload[0], (LOOPBACK_IP, self.sync_port))
+                elif kind == 'fire': self._fire(*payload)
+
+
+def _error_stats(stick, expected):
+    errors_ms = np.array([(fire - ideal) / 1000.0 for ideal, fire in stick.fired.values()]) if stick.fired else np.zeros(0)
+    abs_ms = np.abs(errors_ms)
+    report = {"beats": expected, "fired": len(errors_ms), "missed": max(0, expected - len(errors_ms)),
+              "miss_rate": max(0, expected - len(errors_ms)) / expected if expected else 0.0,
+              "within_5ms": float((abs_ms <= 5).sum() / expected) if expected else 0.0,
+              "within_20ms": float((abs_ms <= 20).sum() / expected) if expected else 0.0,
+              "packets_received": stick.received, "packets_lost": stick.lost, "duplicates": stick.duplicates, "unsynced_dropped": stick.unsynced}
+    if len(errors_ms):
+        report["error_ms"] = {"mean": float(errors_ms.mean()), "p50": float(np.percentile(abs_ms, 50)), "p90": float(np.percentile(abs_ms, 90)),
+                              "p99": float(np.percentile(abs_ms, 99)), "max": float(abs_ms.max())}
+    if stick.clock_offset_us is not None:
+        report["clock_offset_error_us"] = float(stick.clock_offset_us - stick.true_offset_us())
+    return report
+
+
+def run_mode(mode, duration, network, lookahead_ms, repeats, drift_ppm):
+    times = np.arange(0.5, duration, BEAT_INTERVAL_S)
+    beats = list(zip(times.tolist(), [1.0] * len(times)))
+    track = {"filename": "sim", "beats": beats, "tempo": 60.0 / BEAT_INTERVAL_S,
+             "timeline": compile_timeline("sim", beats, CMD_BEAT_SYNC, seed=0)}
+    clock_server = ClockSyncServer(port=SIM_CLOCK_SYNC_PORT, host=LOOPBACK_IP); clock_server.start()
+    stick = VirtualStick(network, drift_ppm=drift_ppm); stick.start()
+    engine = SenderEngine()
+    stop = threading.Event()
+    stop.wait(WARMUP_S)  # vài mẫu đồng bộ đồng hồ trước khi phát
+    program = TimedBeatProgram(track, lookahead_ms / 1000.0, repeats) if mode == 'timed' else BeatProgram(track)
+    engine.submit(program, LOOPBACK_IP)
+    stop.wait(duration + 0.5)
+    engine.stop(); stop.wait(0.3)
+    engine.shutdown(); stick.stop(); clock_server.stop()
+    report = _error_stats(stick, len(times))
+    report.update({"mode": mode, "packets_sent": engine.sent_count, "timing": engine.scheduler.stats()})
+    if mode == 'timed': report.update({"lookahead_ms": lookahead_ms, "repeats": repeats})
+    return report
+
+
+def _print(report):
+    err = report.get("error_ms", {})
+    print(f"  {report['mode']:>6}: gửi {report['packets_sent']} gói, sáng {report['fired']}/{report['beats']} beat "
+          f"(trượt {report['miss_rate'] * 100:.1f}%), lệch p50 {err.get('p50', 0):.2f} ms p99 {err.get('p99', 0):.2f} ms "
+          f"max {err.get('max', 0):.2f} ms, trong 5 ms: {report['within_5ms'] * 100:.1f}%"
+          + (f", sai số offset {report['clock_offset_error_us'] / 1000:.2f} ms" if 'clock_offset_error_us' in report else ""))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Mô phỏng gói beat hẹn giờ vs gói thường qua loopback")
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--lookahead-ms', type=float, default=150.0)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--loss', type=float, default=0.05)
+    parser.add_argument('--jitter-ms', type=float, default=5.0)
+    parser.add_argument('--spike-prob', type=float, default=0.05)
+    parser.add_argument('--drift-ppm', type=float, default=30.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help="ghi kết quả JSON")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    results = []
+    print(f"Mạng mô phỏng: mất {args.loss * 100:.0f}%, jitter {args.jitter_ms} ms, gai {args.spike_prob * 100:.0f}%")
+    for mode in ('legacy', 'timed'):
+        network = NetworkModel(jitter_ms=args.jitter_ms, spike_prob=args.spike_prob, loss=args.loss, seed=args.seed)
+        results.append(run_mode(mode, args.duration, network, args.lookahead_ms, args.repeats, args.drift_ppm))
+        _print(results[-1])
+    if args.json:
+        with open(args.json, 'w') as f: json.dump(results, f, indent=2)
+    sys.exit(0)
@@ -0,0 +1,102 @@
+import struct
+
+import numpy as np
+
+# Khớp struct UdpPacket (packed, little-endian) trong firmware_esp32/src/main.cpp
+PACKET_DTYPE = np.dtype([('command', 'u1'), ('r', 'u1'), ('g', 'u1'), ('b', 'u1'), ('packet_id', '<u4')])
+PACKET_SIZE = PACKET_DTYPE.itemsize
+TIMELINE_DTYPE = np.dtype([('time_ns', '<i8'), ('packet', PACKET_DTYPE)])
+MIN_INTENSITY = 0.3
+
+# Đặc trưng từng beat tính lúc upload (beat_analysis), lưu kèm beat cache: năng lượng 3 dải (0..1 theo max
+# của bài), spectral centroid (Hz), vị trí trong ô nhịp (0 = phách mạnh) và số thứ tự đoạn nhạc
+BEAT_FEATURE_DTYPE = np.dtype([('low', '<f4'), ('mid', '<f4'), ('high', '<f4'), ('centroid', '<f4'), ('bar_position', 'u1'), ('section', '<u2')])
+SECTION_HUE_STEP = 0.618034  # mỗi đoạn một màu gốc, cách nhau theo tỉ lệ vàng
+CENTROID_HUE_RANGE = 0.12
+HIGH_DESATURATION = 0.4
+DOWNBEAT_BOOST = 0.2
+
+_PACKET_ID = struct.Struct('<I')
+
+
+def hsv_to_rgb_array(h, s, v):
+    # Bản vector hoá của hsv_to_rgb cũ, giữ nguyên cách làm tròn int(x * 255)
+    h = np.asarray(h, dtype=np.float64); s = np.broadcast_to(s, h.shape); v = np.broadcast_to(v, h.shape)
+    h_i = (h * 6).astype(np.int64) % 6
+    f = h * 6 - np.floor(h * 6)
+    p = v * (1 - s); q = v * (1 - f * s); t = v * (1 - (1 - f) * s)
+    r = np.choose(h_i, [v, q, p, p, t, v])
+    g = np.choose(h_i, [t, v, v, q, p, p])
+    b = np.choose(h_i, [p, p, t, v, v, q])
+    return (r * 255).astype(np.uint8), (g * 255).astype(np.uint8), (b * 255).astype(np.uint8)
+
+
+class CompiledTimeline:
+    def __init__(self, filename, entries, features=None):
+        self.filename = filename
+        self.entries = entries
+        self.features = features
+        self.buffer = bytearray(entries['packet'].tobytes())
+        self.view = memoryview(self.buffer)
+        # list Python cho vòng gửi: so sánh float/tuple nhanh hơn truy cập phần tử NumPy
+        self.times = (entries['time_ns'] / 1e9).tolist()
+        self.fields = list(zip(*(entries['packet'][k].tolist() for k in ('command', 'r', 'g', 'b'))))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def packet(self, index, packet_id):
+        # Packet ID chỉ biết lúc gửi (bộ đếm chung của server), ghi thẳng vào buffer
+        offset = index * PACKET_SIZE
+        _PACKET_ID.pack_into(self.buffer, offset + 4, packet_id)
+        return self.view[offset:offset + PACKET_SIZE]
+
+    def describe(self, start=0, limit=50):
+        entries = self.entries[start:start + limit]
+        return {
+            "filename": self.filename,
+            "beats": len(self.entries),
+            "duration": float(self.entries['time_ns'][-1] / 1e9) if len(self.entries) else 0.0,
+            "bytes": len(self.buffer),
+            "start": start,
+            "sections": int(self.features['section'].max()) + 1 if self.features is not None and len(self.features) else 0,
+            "entries": [
+                {"index": start + i, "time": int(e['time_ns']) / 1e9, "command": int(e['packet']['command']),
+                 "r": int(e['packet']['r']), "g": int(e['packet']['g']), "b": int(e['packet']['b']),
+                 **({"section": int(self.features['section'][start + i]), "bar_position": int(self.features['bar_position'][start + i])} if self.features is not None else {})}
+                for i, e in enumerate(entries)
+            ]
+        }
+
+
+def feature_colors(features, intensity):
+    # Màu theo nhạc thay cho hue ngẫu nhiên: hue gốc theo đoạn, lệch theo độ sáng âm sắc (centroid),
+    # dải cao nhiều thì nhạt màu hơn, phách mạnh sáng hơn
+    centroid = features['centroid'].astype(np.float64)
+    span = centroid.max() - centroid.min() if len(centroid) else 0.0
+    brightness = (centroid - centroid.min()) / span if span > 0 else np.zeros(len(centroid))
+    hue = (features['section'] * SECTION_HUE_STEP + (brightness - 0.5) * CENTROID_HUE_RANGE) % 1.0
+    total = features['low'] + features['mid'] + features['high']
+    high_ratio = np.divide(features['high'], total, out=np.zeros(len(total), dtype=np.float32), where=total > 0)
+    saturation = 1.0 - HIGH_DESATURATION * high_ratio
+    value = MIN_INTENSITY + (1.0 - MIN_INTENSITY) * np.clip(intensity, 0.0, 1.0)
+    value = np.minimum(1.0, value + DOWNBEAT_BOOST * (features['bar_position'] == 0))
+    return hsv_to_rgb_array(hue, saturation, value)
+
+
+def compile_timeline(filename, beats, command, seed=None, features=None):
+    beats = np.asarray(beats, dtype=np.float64).reshape(-1, 2)
+    order = np.argsort(beats[:, 0], kind='stable')
+    beats = beats[order]
+    if features is not None and len(features) != len(beats): features = None
+    elif features is not None: features = features[order]
+    entries = np.zeros(len(beats), dtype=TIMELINE_DTYPE)
+    entries['time_ns'] = np.round(beats[:, 0] * 1e9).astype(np.int64)
+    packet = entries['packet']
+    packet['command'] = command
+    if features is not None: packet['r'], packet['g'], packet['b'] = feature_colors(features, beats[:, 1])
+    else:
+        hue = np.random.default_rng(seed).random(len(beats))
+        value = MIN_INTENSITY + (1.0 - MIN_INTENSITY) * np.clip(beats[:, 1], 0.0, 1.0)
+        packet['r'], packet['g'], packet['b'] = hsv_to_rgb_array(hue, 1.0, value)
+    return CompiledTimeline(filename, entries, features)
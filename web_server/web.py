@@ -1,56 +1,53 @@
-import socket
-import struct
-import threading
-import time
 import os
-import random
+import sys
 import logging
-import errno
-from flask import Flask, render_template, request, jsonify, send_from_directory, g
+from flask import Flask, render_template, request, jsonify, send_from_directory, send_file, Response, g
 from werkzeug.utils import secure_filename
 import atexit
-
-try:
-    import librosa
-    import soundfile
-    import numpy as np
-    from scipy import stats
-except ImportError:
-    logging.basicConfig(level=logging.ERROR); logger = logging.getLogger(); logger.error("LỖI: pip install Flask librosa soundfile numpy scipy"); exit()
+import itertools
+import metrics
+from beat_cache import BeatCache, make_key
+from beat_analysis import analysis_params
+from analysis_jobs import AnalysisJobQueue, JobQueueFull, default_worker_count
+from timeline import compile_timeline
+from sender_engine import SenderEngine, SenderBusy, BeatProgram, TimedBeatProgram, BlinkProgram, StaticProgram, CMD_BEAT_SYNC, MULTICAST_GROUP, MULTICAST_PORT, TIMED_REPEATS
+from clock_sync import ClockSyncServer
+from multicast_transport import parse_destinations
+from packet_log import PacketLog, iter_csv_lines
+from events import EventBus, StatusSampler
+from state_store import StateStore
+from live_input import LiveProgram, PcmStreamSource, DeviceSource, LIVE_LATENCY_BUDGET_MS
 
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'mp3', 'wav', 'ogg', 'flac', 'm4a', 'aac'}
-MULTICAST_GROUP = '239.1.1.1'
-MULTICAST_PORT = 1234
-KEEP_ALIVE_INTERVAL = 0.9
-
-CMD_BEAT_SYNC = 0x01
-CMD_FX_BLINK = 0x03 
-CMD_FX_STATIC = 0x04
-
-STATIC_COLORS_LIST = [
-    (255, 0, 0), (255, 128, 0), (255, 255, 0), (0, 255, 0), 
-    (0, 255, 255), (0, 0, 255), (128, 0, 255), (255, 0, 255)
-]
-
-active_thread = None
-is_syncing = False
-current_sync_mode = "idle" 
-current_ip = ""
-last_error = ""
-udp_socket = None
-
-current_track_info = { "filename": None, "beats": [], "tempo": 0.0, "playback_start_time": 0.0, "next_beat_index": 0 }
-last_packet_sent_time = 0.0
-audio_queue = [] 
-blink_color_index = 0
-
-packet_counter = 0
-packet_counter_lock = threading.Lock()
+
+BEAT_CACHE_FOLDER = 'beat_cache'
+BEAT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+ANALYSIS_WORKERS = default_worker_count()
+ANALYSIS_MAX_PENDING = 32
+# Làm nóng worker phân tích ngay khi khởi động (nền), để upload đầu tiên không chờ nạp librosa/JIT
+ANALYSIS_PREWARM = os.environ.get('ANALYSIS_PREWARM', '1') == '1'
+# Thư mục ghi cProfile + thời gian từng giai đoạn cho mỗi job phân tích (để trống = tắt)
+ANALYSIS_PROFILE_DIR = os.environ.get('ANALYSIS_PROFILE_DIR', '') or None
+PACKET_LOG_FOLDER = 'packet_logs'
+PACKET_TEXT_LOG = os.environ.get('PACKET_TEXT_LOG', '0') == '1'  # bật lại dòng LOG,SENT dạng text
+# > 0: gửi beat hẹn giờ trước N ms (cần firmware có TimedPacket); 0: gói 8 byte như cũ
+BEAT_LOOKAHEAD_MS = int(os.environ.get('BEAT_LOOKAHEAD_MS', '0'))
+MAX_LOOKAHEAD_MS = 2000
+MAX_TIMED_REPEATS = 8
+LIVE_SAMPLE_RATE = int(os.environ.get('LIVE_SAMPLE_RATE', '44100'))
+
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger()
 
+# Process sinh worker phân tích (và pool đầu tiên) được fork ngay tại đây, trước mọi socket (ClockSync, HTTP, multicast)
+# và thread của server, để không worker nào (kể cả worker dựng lại sau này) giữ cổng 1235/5000 sau khi server thoát.
+# Callback tra tên lúc chạy (định nghĩa bên dưới)
+analysis_jobs = AnalysisJobQueue(ANALYSIS_WORKERS, ANALYSIS_MAX_PENDING, lambda job, result: on_analysis_done(job, result),
+                                 lambda job, error: on_analysis_error(job, error), prewarm=ANALYSIS_PREWARM, profile_dir=ANALYSIS_PROFILE_DIR)
+analysis_jobs.start()
+
 app = Flask(__name__) 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024 
@@ -60,242 +57,67 @@ if not os.path.exists(UPLOAD_FOLDER):
     try: os.makedirs(UPLOAD_FOLDER); logger.info(f"Đã tạo thư mục: {os.path.abspath(UPLOAD_FOLDER)}")
     except OSError as e: logger.error(f"Không thể tạo thư mục uploads: {e}")
 
+beat_cache = BeatCache(BEAT_CACHE_FOLDER, BEAT_CACHE_MAX_BYTES)
+
+bus = EventBus()
+# Hàng đợi đổi -> đánh thức StatusSampler, thread đó dựng summary và đẩy lên bus (định nghĩa bên dưới)
+store = StateStore(bus, on_queue_change=lambda version: status_sampler.wake())
+error_ids = itertools.count(1)
+
+def report_error(message):
+    # Lỗi là một sự kiện có id: mọi client (SSE hoặc poll) đều thấy, không bị client đầu tiên "đọc mất"
+    bus.set('server_error', {'message': message, 'id': next(error_ids)})
+
+def on_sender_error(message):
+    report_error(message)
+
+packet_log = PacketLog(PACKET_LOG_FOLDER)
+sender = SenderEngine(on_error=on_sender_error, packet_log=packet_log, text_log=PACKET_TEXT_LOG)
+EFFECT_PROGRAMS = {'blink': BlinkProgram}
+clock_sync = ClockSyncServer()
+clock_sync.start()
+
+def mode_state():
+    current_track = sender.track
+    progress = sender.progress
+    return {'is_syncing': sender.is_syncing, 'current_sync_mode': sender.mode,
+            'current_audio_file': current_track["filename"] if current_track else None,
+            'paused': bool(progress and progress.get("paused"))}
+
+def publish_mode():
+    bus.set('mode', mode_state())
+
+def submit_program(program, req_ip, groups):
+    # None khi chế độ mới đã chạy; ngược lại (response lỗi, mã): 503 = thread gửi không nhận lệnh kịp (đã huỷ),
+    # 500 = sender từ chối (lỗi socket, program đã được giải phóng; chế độ và IP đang dùng giữ nguyên)
+    try: applied = sender.submit(program, req_ip, groups)
+    except SenderBusy as e: return jsonify({'status': 'error', 'message': f"{e}, thử lại"}), 503
+    if not applied: return jsonify({'status': 'error', 'message': f"Không khởi động được chế độ {program.mode}, chế độ hiện tại vẫn chạy (xem lỗi server)"}), 500
+    store.set_destination(req_ip, groups)
+    publish_mode()
+    return None
+
+def sample_status():
+    store.publish_queue()
+    return {'mode': mode_state()}, sender.progress
+
+status_sampler = StatusSampler(bus, sample_status)
+publish_mode()
+status_sampler.start()
+
+def request_destinations(data):
+    # ip: một hoặc nhiều IP giao diện cách nhau dấu phẩy; groups (tuỳ chọn): danh sách group multicast/vùng
+    ips = data.get('ip', '').strip()
+    groups = data.get('groups') or [MULTICAST_GROUP]
+    if isinstance(groups, str): groups = groups.split(',')
+    try: parse_destinations(ips, groups, MULTICAST_PORT)
+    except (OSError, TypeError, AttributeError): return ips, None
+    return ips, [g.strip() for g in groups if g.strip()]
+
 def allowed_file(filename): 
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def hsv_to_rgb(h, s, v):
-    h_i = int(h * 6); f = h * 6 - h_i; p = v * (1 - s); q = v * (1 - f * s); t = v * (1 - (1 - f) * s)
-    if h_i == 0: r, g, b = v, t, p
-    elif h_i == 1: r, g, b = q, v, p
-    elif h_i == 2: r, g, b = p, v, t
-    elif h_i == 3: r, g, b = p, q, v
-    elif h_i == 4: r, g, b = t, p, v
-    elif h_i == 5: r, g, b = v, p, q
-    return int(r * 255), int(g * 255), int(b * 255)
-
-def analyze_beats(filepath, user_tempo=None):
-    global last_error
-    try:
-        logger.info(f"Phân tích (HPSS + Cường độ): {os.path.basename(filepath)}...")
-        y, sr = librosa.load(filepath, sr=None, mono=True)
-        duration = librosa.get_duration(y=y, sr=sr)
-        logger.info(f"Đã tải. SR: {sr} Hz, Dài: {duration:.2f}s.")
-        hop_length_analysis = 512
-        logger.info("Thực hiện tách Harmonic/Percussive (HPSS)...")
-        y_percussive = librosa.effects.percussive(y, margin=3.0)
-        logger.info("HPSS hoàn tất.")
-        
-        onset_env_perc = librosa.onset.onset_strength(y=y_percussive, sr=sr, hop_length=hop_length_analysis, aggregate=np.median)
-        
-        local_tempo = 0.0
-        if user_tempo and user_tempo > 0:
-            logger.info(f"Sử dụng Tempo do người dùng cung cấp: {user_tempo:.0f} BPM.")
-            local_tempo = float(user_tempo)
-        else:
-            logger.info("Ước tính tempo từ Librosa...")
-            tempo_estimate = librosa.beat.tempo(onset_envelope=onset_env_perc, sr=sr, hop_length=hop_length_analysis)
-            if isinstance(tempo_estimate, np.ndarray): tempo_value = float(tempo_estimate[0]) if len(tempo_estimate) > 0 else 0.0
-            else: tempo_value = float(tempo_estimate)
-            local_tempo = round(tempo_value)
-            logger.info(f"Tempo ước tính (làm tròn): {local_tempo:.0f} BPM.")
-        
-        calculated_tempo = float(local_tempo)
-        beats_with_intensity = [] 
-
-        if calculated_tempo > 0 and len(onset_env_perc) > 0:
-            _, beat_frames = librosa.beat.beat_track(onset_envelope=onset_env_perc, sr=sr, hop_length=hop_length_analysis, units='frames', start_bpm=calculated_tempo, tightness=200)
-            beat_times = librosa.frames_to_time(beat_frames, sr=sr, hop_length=hop_length_analysis)
-            beat_intensities_raw = onset_env_perc[beat_frames]
-            
-            max_intensity = np.max(beat_intensities_raw)
-            if max_intensity > 0:
-                beat_intensities_norm = beat_intensities_raw / max_intensity
-                logger.info(f"Đã chuẩn hóa {len(beat_intensities_norm)} cường độ (Max: {max_intensity:.2f})")
-            else:
-                logger.warning("Không phát hiện cường độ, dùng 1.0 cho tất cả.")
-                beat_intensities_norm = np.ones_like(beat_intensities_raw)
-
-            beats_with_intensity = list(zip(beat_times.tolist(), beat_intensities_norm.tolist()))
-            logger.info(f"Căn chỉnh {len(beats_with_intensity)} beats theo tempo {calculated_tempo:.0f} BPM.")
-
-        if len(beats_with_intensity) == 0:
-            logger.warning("Beat track thất bại, dùng onset detect dự phòng...")
-            onset_frames = librosa.onset.onset_detect(onset_envelope=onset_env_perc, sr=sr, hop_length=hop_length_analysis, units='frames', backtrack=False)
-            onset_times = librosa.frames_to_time(onset_frames, sr=sr, hop_length=hop_length_analysis)
-            beats_with_intensity = list(zip(onset_times.tolist(), np.ones_like(onset_times).tolist()))
-            logger.info(f"Dự phòng cuối: Sử dụng {len(beats_with_intensity)} onsets.")
-            
-        last_error = ""
-        return {
-            "filename": os.path.basename(filepath),
-            "beats": beats_with_intensity, 
-            "tempo": calculated_tempo,
-            "success": True
-        }
-    except Exception as e:
-        logger.error(f"Lỗi phân tích beat (HPSS Style): {e}", exc_info=True)
-        last_error = f"Lỗi phân tích file: {type(e).__name__}"
-        return {"success": False, "error": last_error}
-
-def send_udp_packet(command_byte, r, g, b):
-    global udp_socket, last_packet_sent_time, last_error, is_syncing, current_ip, packet_counter, packet_counter_lock
-    
-    if udp_socket and is_syncing:
-        
-        with packet_counter_lock:
-            packet_counter += 1
-            current_packet_id = packet_counter
-        
-        message = struct.pack('<BBBB I', command_byte, r, g, b, current_packet_id)
-        
-        try:
-            udp_socket.sendto(message, (MULTICAST_GROUP, MULTICAST_PORT))
-            sent_time_ns = time.time_ns() 
-            last_packet_sent_time = sent_time_ns / 1_000_000_000.0 
-            
-            logger.info(f"LOG,SENT,{current_packet_id},{command_byte},{r},{g},{b},{sent_time_ns}")
-            
-            return True
-        
-        except OSError as e:
-            if e.errno in (errno.EADDRNOTAVAIL, errno.ENETUNREACH): logger.error(f"Lỗi UDP ({e.errno}): IP {current_ip}?. Dừng..."); last_error = f"Lỗi UDP: IP {current_ip}?"; is_syncing = False
-            else: logger.error(f"Lỗi UDP khác ({e.errno}): {e}")
-            return False
-        except Exception as e: logger.error(f"Lỗi UDP không xác định: {e}"); return False
-    return False
-
-def start_playback_sync_thread(ip_to_bind):
-    global is_syncing, last_error, udp_socket, last_packet_sent_time, current_sync_mode, current_track_info
-    local_beats = current_track_info["beats"] 
-    if not local_beats: 
-        logger.error("Thread: No beats."); last_error = "Lỗi: No beats."; is_syncing = False; return
-    local_udp_socket = None
-    try:
-        local_udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); local_udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        local_udp_socket.bind((ip_to_bind, 0)); logger.info(f"Thread (Beat): Bind IP: {ip_to_bind}")
-        local_udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(ip_to_bind))
-        ttl = struct.pack('b', 1); local_udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
-        udp_socket = local_udp_socket
-        current_track_info["playback_start_time"] = time.time()
-        current_track_info["next_beat_index"] = 0
-        last_packet_sent_time = current_track_info["playback_start_time"]
-        logger.info(f"Thread (Beat): Bắt đầu gửi {len(local_beats)} beats (có cường độ)...")
-        min_intensity = 0.3 
-        
-        while is_syncing and current_sync_mode == 'beat' and current_track_info["next_beat_index"] < len(local_beats):
-            current_time = time.time()
-            elapsed_time = current_time - current_track_info["playback_start_time"]
-            next_beat_data = local_beats[current_track_info["next_beat_index"]]
-            next_beat_time = next_beat_data[0]
-            
-            if elapsed_time >= next_beat_time:
-                next_beat_intensity = next_beat_data[1] 
-                hue = random.random() 
-                value = min_intensity + ((1.0 - min_intensity) * next_beat_intensity)
-                r, g, b = hsv_to_rgb(hue, 1.0, value) 
-                
-                if send_udp_packet(CMD_BEAT_SYNC, r, g, b): 
-                    logger.debug(f"Beat {current_track_info['next_beat_index']+1} (Int: {next_beat_intensity:.2f})"); 
-                    current_track_info["next_beat_index"] += 1
-                else: 
-                    logger.error("Thread (Beat): Lỗi gửi beat."); break
-            
-            elif (current_time - last_packet_sent_time) > KEEP_ALIVE_INTERVAL:
-                if not send_udp_packet(CMD_BEAT_SYNC, 0, 0, 0): 
-                    logger.error("Thread (Beat): Lỗi gửi keep-alive."); break
-            
-            sleep_time = 0.005
-            if current_track_info["next_beat_index"] < len(local_beats):
-                current_next_beat_time = local_beats[current_track_info["next_beat_index"]][0]
-            else:
-                current_next_beat_time = float('inf')
-            
-            time_to_next_beat = current_next_beat_time - elapsed_time
-            time_to_keep_alive = (last_packet_sent_time + KEEP_ALIVE_INTERVAL) - current_time
-            sleep_until = float('inf');
-            
-            if time_to_next_beat > 0.01: sleep_until = min(sleep_until, time_to_next_beat - 0.005)
-            if time_to_keep_alive > 0.01: sleep_until = min(sleep_until, time_to_keep_alive - 0.005)
-            if sleep_until != float('inf') and sleep_until > 0: sleep_time = max(0.005, sleep_until)
-            
-            time.sleep(sleep_time)
-            
-        if is_syncing and current_sync_mode == 'beat' and current_track_info["next_beat_index"] >= len(local_beats): 
-            logger.info("Thread (Beat): Gửi hết beats."); 
-            is_syncing = False
-            
-    except OSError as e: logger.error(f"Thread (Beat): LỖI SOCKET: {e}"); last_error = f"Lỗi Socket: {e}. IP?"; is_syncing = False
-    except Exception as e: logger.error(f"Thread (Beat): LỖI LUỒNG: {e}", exc_info=True); last_error = f"Lỗi: {e}"; is_syncing = False
-    finally:
-        logger.info("Thread (Beat): Dọn dẹp...");
-        if local_udp_socket: local_udp_socket.close()
-        if current_sync_mode == 'beat': 
-            udp_socket = None; is_syncing = False; current_sync_mode = 'idle'
-            current_track_info = {"filename": None, "beats": [], "tempo": 0.0, "playback_start_time": 0.0, "next_beat_index": 0} 
-        logger.info("Thread (Beat): Hoàn tất dọn dẹp.")
-
-def start_preset_effect_thread(effect_mode, ip_to_bind):
-    global is_syncing, last_error, udp_socket, last_packet_sent_time, current_sync_mode, blink_color_index
-    local_udp_socket = None
-    try:
-        local_udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); local_udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        local_udp_socket.bind((ip_to_bind, 0)); logger.info(f"Thread (Effect): Bind IP: {ip_to_bind}")
-        local_udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(ip_to_bind))
-        ttl = struct.pack('b', 1); local_udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
-        udp_socket = local_udp_socket
-        logger.info(f"Thread (Effect): Bắt đầu hiệu ứng {effect_mode}...")
-        blink_state_on = True 
-        blink_color_index = 0 
-        
-        while is_syncing and current_sync_mode == effect_mode:
-            command_byte = 0x00
-            if effect_mode == 'blink':
-                command_byte = CMD_FX_BLINK
-                if blink_state_on:
-                    r, g, b = STATIC_COLORS_LIST[blink_color_index]
-                    blink_color_index = (blink_color_index + 1) % len(STATIC_COLORS_LIST)
-                else:
-                    r, g, b = 0, 0, 0
-                blink_state_on = not blink_state_on
-                sleep_time = 0.5 
-            else: 
-                logger.warning(f"Hiệu ứng không xác định: {effect_mode}"); break
-            if not send_udp_packet(command_byte, r, g, b):
-                logger.error(f"Thread (Effect): Lỗi gửi {effect_mode}."); break
-            time.sleep(sleep_time)
-    except OSError as e: logger.error(f"Thread (Effect): LỖI SOCKET: {e}"); last_error = f"Lỗi Socket: {e}. IP?"; is_syncing = False
-    except Exception as e: logger.error(f"Thread (Effect): LỖI LUỒNG: {e}", exc_info=True); last_error = f"Lỗi: {e}"; is_syncing = False
-    finally:
-        logger.info(f"Thread (Effect): Dọn dẹp {effect_mode}...");
-        if local_udp_socket: local_udp_socket.close()
-        if current_sync_mode == effect_mode:
-            udp_socket = None; is_syncing = False; current_sync_mode = 'idle'
-        logger.info("Thread (Effect): Hoàn tất dọn dẹp.")
-
-def start_static_color_thread(r, g, b, ip_to_bind):
-    global is_syncing, last_error, udp_socket, last_packet_sent_time, current_sync_mode
-    local_udp_socket = None
-    try:
-        local_udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); local_udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        local_udp_socket.bind((ip_to_bind, 0)); logger.info(f"Thread (Static): Bind IP: {ip_to_bind}")
-        local_udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(ip_to_bind))
-        ttl = struct.pack('b', 1); local_udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
-        udp_socket = local_udp_socket
-        logger.info(f"Thread (Static): Bắt đầu màu {r},{g},{b}...")
-        while is_syncing and current_sync_mode == 'static':
-            if not send_udp_packet(CMD_FX_STATIC, r, g, b):
-                logger.error(f"Thread (Static): Lỗi gửi màu."); break
-            time.sleep(KEEP_ALIVE_INTERVAL) 
-    except OSError as e: logger.error(f"Thread (Static): LỖI SOCKET: {e}"); last_error = f"Lỗi Socket: {e}. IP?"; is_syncing = False
-    except Exception as e: logger.error(f"Thread (Static): LỖI LUỒNG: {e}", exc_info=True); last_error = f"Lỗi: {e}"; is_syncing = False
-    finally:
-        logger.info(f"Thread (Static): Dọn dẹp...");
-        if local_udp_socket: local_udp_socket.close()
-        if current_sync_mode == 'static':
-            udp_socket = None; is_syncing = False; current_sync_mode = 'idle'
-        logger.info("Thread (Static): Hoàn tất dọn dẹp.")
-
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -309,25 +131,89 @@ def serve_upload(filename):
 
 @app.route('/status', methods=['GET'])
 def get_status():
-    global last_error, audio_queue
-    queue_data = []
-    for track in audio_queue:
-        queue_data.append({"filename": track["filename"], "tempo": track["tempo"]})
-    
-    server_error = last_error
-    last_error = "" 
+    # ETag = version của bus: client poll nhận 304 khi không có gì thay đổi
+    version, state = bus.snapshot()
+    etag = str(version)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        error = state.get('server_error') or {}
+        response = jsonify({
+            **state.get('mode', {}),
+            'audio_queue': state.get('queue', []), 
+            'current_ip': state.get('ip', ""),
+            'server_error': error.get('message', ""),
+            'error_id': error.get('id', 0)
+        })
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/events', methods=['GET'])
+def stream_events():
+    try: last_event_id = int(request.headers.get('Last-Event-ID', ''))
+    except ValueError: last_event_id = None
+    return Response(bus.stream(last_event_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
     return jsonify({
-        'is_syncing': is_syncing,
-        'current_sync_mode': current_sync_mode,
-        'current_audio_file': current_track_info["filename"], 
-        'audio_queue': queue_data, 
-        'current_ip': current_ip,
-        'server_error': server_error
+        'beat_cache': beat_cache.stats(),
+        'timing': sender.scheduler.stats(),
+        'mode_switch': sender.stats(),
+        'destinations': sender.destinations(),
+        'packet_log': packet_log.stats(),
+        'clock_sync': clock_sync.stats(),
+        'analysis_workers': {**analysis_jobs.stats(), 'stack_loaded_in_server': 'librosa' in sys.modules},
+        'progress': sender.progress
     })
 
+def enqueue_analyzed_track(analysis_result, position=None):
+    queue_track = {
+        "filename": analysis_result["filename"],
+        "beats": analysis_result["beats"],
+        "tempo": analysis_result["tempo"],
+        "timeline": compile_timeline(analysis_result["filename"], analysis_result["beats"], CMD_BEAT_SYNC, features=analysis_result.get("features"))
+    }
+    track_id = store.queue.add(queue_track, position)
+    logger.info(f"Đã thêm '{analysis_result['filename']}' ({track_id}) vào hàng đợi. Queue size: {len(store.queue)}")
+    return track_id
+
+def on_analysis_done(job, analysis_result):
+    beat_cache.put(job["cache_key"], analysis_result["tempo"], analysis_result["beats"], analysis_result.get("features"))
+    enqueue_analyzed_track(analysis_result, job.get("position"))
+
+def on_analysis_error(job, error):
+    report_error(f"{job['filename']}: {error}")
+
+
+def per_destination(key):
+    return {(d["group"], d["iface"]): d[key] for d in sender.destinations()}
+
+# Số liệu đã có trong các stats() chỉ đọc lúc scrape /metrics; đường gửi gói tự ghi counter/histogram trong sender_engine
+metrics.gauge_callback('lightstick_mode', 'Chế độ gửi hiện tại (1 = đang chạy)', lambda: {(m,): int(sender.mode == m) for m in ('idle', 'beat', 'blink', 'static', 'live')}, ('mode',))
+metrics.gauge_callback('lightstick_queue_tracks', 'Số bài trong hàng đợi phát', lambda: len(store.queue))
+metrics.gauge_callback('lightstick_sse_subscribers', 'Client đang nghe /events', lambda: len(bus.subscribers))
+metrics.gauge_callback('lightstick_scheduler_oversleep_seconds', 'Bù ngủ quá của scheduler (EWMA)', lambda: sender.scheduler.oversleep_ns / 1e9)
+metrics.gauge_callback('lightstick_destination_up', 'Đích multicast (group, giao diện) còn gửi được', lambda: {k: int(v) for k, v in per_destination("up").items()}, ('group', 'iface'))
+metrics.counter_callback('lightstick_destination_sent_total', 'Frame đã gửi tới từng đích', lambda: per_destination("sent"), ('group', 'iface'))
+metrics.counter_callback('lightstick_destination_errors_total', 'Lỗi gửi theo từng đích', lambda: per_destination("errors"), ('group', 'iface'))
+metrics.counter_callback('lightstick_beat_cache_hits_total', 'Upload dùng lại kết quả phân tích trong cache', lambda: beat_cache.stats()["hits"])
+metrics.counter_callback('lightstick_beat_cache_misses_total', 'Upload phải phân tích lại', lambda: beat_cache.stats()["misses"])
+metrics.gauge_callback('lightstick_beat_cache_bytes', 'Dung lượng cache kết quả phân tích', lambda: beat_cache.stats()["bytes"])
+metrics.counter_callback('lightstick_packet_log_written_total', 'Bản ghi gói đã ghi xuống đĩa', lambda: packet_log.stats()["written"])
+metrics.counter_callback('lightstick_packet_log_dropped_total', 'Bản ghi gói bị bỏ do ring buffer đầy', lambda: packet_log.stats()["dropped"])
+metrics.counter_callback('lightstick_clock_sync_requests_total', 'Yêu cầu đồng bộ đồng hồ đã trả lời', lambda: clock_sync.requests)
+metrics.gauge_callback('lightstick_analysis_workers_ready', 'Worker phân tích đã làm nóng xong', lambda: len(analysis_jobs.ready_workers))
+metrics.gauge_callback('lightstick_analysis_jobs', 'Job phân tích đang chờ/chạy', lambda: {(k,): analysis_jobs.stats()[k] for k in ('queued', 'running')}, ('status',))
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    global audio_queue
     if 'audiofile' not in request.files:
         return jsonify({'status': 'error', 'message': 'Chưa chọn file'}), 400
     file = request.files['audiofile']
@@ -344,139 +230,251 @@ def upload_file():
                 try: user_tempo = float(user_tempo_str)
                 except ValueError: user_tempo = 0.0
             
-            analysis_result = analyze_beats(filepath, user_tempo)
-            
-            if analysis_result["success"]:
-                queue_track = {
-                    "filename": analysis_result["filename"],
-                    "beats": analysis_result["beats"] if len(analysis_result["beats"]) < 5000 else analysis_result["beats"][:5000],
-                    "tempo": analysis_result["tempo"]
-                }
-                if len(analysis_result["beats"]) >= 5000:
-                    logger.warning(f"File quá dài, chỉ lưu 5000 beats đầu tiên.")
-
-                audio_queue.append(queue_track) 
-                logger.info(f"Đã thêm '{analysis_result['filename']}' vào hàng đợi. Queue size: {len(audio_queue)}")
-                
+            position = request.form.get('position', '').strip()
+            try: position = int(position) if position else None
+            except ValueError: return jsonify({'status': 'error', 'message': 'Vị trí không hợp lệ'}), 400
+
+            cache_key = make_key(filepath, analysis_params(user_tempo))
+            cached = beat_cache.get(cache_key)
+            if cached:
+                logger.info(f"Beat cache HIT: {filename} ({len(cached['beats'])} beats), bỏ qua phân tích.")
+                track_id = enqueue_analyzed_track({"filename": filename, "beats": cached["beats"], "tempo": cached["tempo"], "features": cached["features"]}, position)
                 return jsonify({
                     'status': 'success', 
-                    'message': f"Phân tích '{analysis_result['filename']}' OK.",
-                    'filename': analysis_result['filename'],
-                    'beats': len(analysis_result['beats']),
-                    'tempo': analysis_result['tempo']
+                    'message': f"Phân tích '{filename}' OK (cache).",
+                    'filename': filename,
+                    'beats': len(cached['beats']),
+                    'tempo': cached['tempo'],
+                    'track_id': track_id,
+                    'cached': True
                 })
-            else:
-                return jsonify({'status': 'error', 'message': analysis_result["error"]}), 400
+
+            try:
+                job_id = analysis_jobs.submit(filepath, filename, user_tempo, cache_key, position)
+            except JobQueueFull as e:
+                return jsonify({'status': 'error', 'message': str(e)}), 503
+            return jsonify({
+                'status': 'queued',
+                'message': f"Đã xếp hàng phân tích '{filename}'.",
+                'filename': filename,
+                'job_id': job_id
+            }), 202
         except Exception as e:
             logger.error(f"Lỗi lưu/phân tích file: {e}"); 
             return jsonify({'status': 'error', 'message': f'Lỗi lưu file: {e}'}), 500
     else:
         return jsonify({'status': 'error', 'message': 'Định dạng file không hợp lệ'}), 400
 
-def stop_sending_internal():
-    global is_syncing, active_thread, current_sync_mode, current_track_info
-    if is_syncing or active_thread is not None:
-        logger.info(f"Dừng thread nội bộ (mode: {current_sync_mode})...");
-        is_syncing = False
-        current_sync_mode = 'idle'
-        if active_thread and active_thread.is_alive():
-            active_thread.join(timeout=1.0)
-            if active_thread.is_alive(): logger.warning("Thread không dừng kịp!")
-        active_thread = None
-        current_track_info = {"filename": None, "beats": [], "tempo": 0.0, "playback_start_time": 0.0, "next_beat_index": 0}
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify({'jobs': analysis_jobs.list()})
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = analysis_jobs.get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Không tìm thấy job'}), 404
+    return jsonify(job)
+
+@app.route('/timeline', methods=['GET'])
+def get_timeline():
+    # ?id=<track_id>: bài đang phát hoặc trong hàng đợi (tên file có thể trùng); ?filename= chỉ là cách tra dự phòng.
+    # Không tham số: bài đang phát, không thì bài đầu hàng đợi
+    track_id = request.args.get('id')
+    filename = request.args.get('filename')
+    try:
+        start = max(0, int(request.args.get('start', 0))); limit = min(1000, max(0, int(request.args.get('limit', 50))))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'start/limit không hợp lệ'}), 400
+    current_track = sender.track
+    if track_id:
+        track = current_track if current_track and current_track.get("id") == track_id else store.queue.get(track_id)
+    elif filename:
+        track = current_track if current_track and current_track["filename"] == filename else store.queue.find(filename)
+    else:
+        track = current_track or store.queue.first()
+    timeline = track["timeline"] if track else None
+    if timeline is None:
+        return jsonify({'status': 'error', 'message': 'Không tìm thấy timeline'}), 404
+    return jsonify(timeline.describe(start, limit))
+
+@app.route('/packet_log', methods=['GET'])
+def export_packet_log():
+    if packet_log.path is None:
+        return jsonify({'status': 'error', 'message': 'Chưa có gói nào được gửi'}), 404
+    packet_log.flush()
+    name = os.path.splitext(os.path.basename(packet_log.path))[0]
+    if request.args.get('format', 'bin') == 'csv':
+        return Response(iter_csv_lines(packet_log.path), mimetype='text/csv',
+                        headers={'Content-Disposition': f'attachment; filename={name}.csv'})
+    return send_file(os.path.abspath(packet_log.path), mimetype='application/octet-stream', as_attachment=True, download_name=f'{name}.bin')
 
 @app.route('/start_beat', methods=['POST'])
 def start_beat_sync():
-    global active_thread, is_syncing, current_ip, last_error, current_sync_mode, audio_queue, current_track_info
     data = request.json
-    req_ip = data.get('ip', '').strip()
+    req_ip, groups = request_destinations(data)
     if not req_ip:
         return jsonify({'status': 'error', 'message': 'IP trống'}), 400
-    if is_syncing:
-        return jsonify({'status': 'error', 'message': 'Hệ thống đang bận, vui lòng Dừng trước'}), 400
-    if not audio_queue:
+    if not groups:
+        return jsonify({'status': 'error', 'message': 'IP hoặc group multicast không hợp lệ'}), 400
+    try:
+        lookahead_ms = int(data.get('lookahead_ms', BEAT_LOOKAHEAD_MS)); repeats = int(data.get('repeats', TIMED_REPEATS))
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'lookahead_ms/repeats không hợp lệ'}), 400
+    if not (0 <= lookahead_ms <= MAX_LOOKAHEAD_MS and 1 <= repeats <= MAX_TIMED_REPEATS):
+        return jsonify({'status': 'error', 'message': 'lookahead_ms/repeats ngoài phạm vi'}), 400
+    # Lấy bài đầu hàng đợi nguyên tử: hai request đồng thời không thể cùng lấy một bài
+    track_to_play = store.queue.pop_next()
+    if track_to_play is None:
         return jsonify({'status': 'error', 'message': 'Hàng đợi trống. Vui lòng upload file nhạc.'}), 400
-    stop_sending_internal(); time.sleep(0.1) 
-    track_to_play = audio_queue.pop(0) 
-    current_track_info["filename"] = track_to_play["filename"]
-    current_track_info["beats"] = track_to_play["beats"]
-    current_track_info["tempo"] = track_to_play["tempo"]
-    current_ip = req_ip
-    logger.info(f"Yêu cầu START BEAT sync IP {current_ip} file {current_track_info['filename']}");
-    is_syncing = True; last_error = ""; current_sync_mode = 'beat'
-    active_thread = threading.Thread(target=start_playback_sync_thread, args=(current_ip,), name="PlaybackSyncThread");
-    active_thread.daemon = True; active_thread.start()
+    logger.info(f"Yêu cầu START BEAT sync IP {req_ip} file {track_to_play['filename']} lookahead {lookahead_ms} ms");
+    program = TimedBeatProgram(track_to_play, lookahead_ms / 1000.0, repeats) if lookahead_ms > 0 else BeatProgram(track_to_play)
+    error = submit_program(program, req_ip, groups)
+    if error:
+        store.queue.add(track_to_play, position=0)  # trả bài về đầu hàng đợi
+        return error
     return jsonify({
         'status': 'success', 
-        'message': f"Bắt đầu đồng bộ BEAT: {current_track_info['filename']}",
-        'filename': current_track_info['filename'] 
+        'message': f"Bắt đầu đồng bộ BEAT: {track_to_play['filename']}",
+        'filename': track_to_play['filename'] 
     })
 
+@app.route('/queue', methods=['GET'])
+def get_queue():
+    return jsonify({'queue': store.queue.summary()})
+
 @app.route('/queue/delete', methods=['POST'])
 def delete_from_queue():
-    global audio_queue
+    # Xoá theo id (một bài) hoặc theo filename (mọi bài trùng tên, như trước)
     data = request.json
+    track_id = data.get('id')
     filename_to_delete = data.get('filename')
-    if not filename_to_delete:
-        return jsonify({'status': 'error', 'message': 'Thiếu tên file'}), 400
-    original_len = len(audio_queue)
-    audio_queue = [track for track in audio_queue if track['filename'] != filename_to_delete]
-    new_len = len(audio_queue)
-    if new_len < original_len:
+    if not track_id and not filename_to_delete:
+        return jsonify({'status': 'error', 'message': 'Thiếu id hoặc tên file'}), 400
+    if track_id:
+        track = store.queue.remove(track_id)
+        removed = 1 if track else 0
+        filename_to_delete = track['filename'] if track else track_id
+    else:
+        removed = store.queue.remove_filename(filename_to_delete)
+    if removed:
         logger.info(f"Đã xóa '{filename_to_delete}' khỏi hàng đợi.")
         return jsonify({'status': 'success', 'message': f"Đã xóa '{filename_to_delete}'."})
     else:
         logger.warning(f"Không tìm thấy file '{filename_to_delete}' để xóa.")
         return jsonify({'status': 'error', 'message': 'Không tìm thấy file trong hàng đợi'}), 404
 
+@app.route('/queue/move', methods=['POST'])
+def move_in_queue():
+    data = request.json
+    track_id = data.get('id')
+    try: position = int(data.get('position'))
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'Vị trí không hợp lệ'}), 400
+    if not track_id or not store.queue.move(track_id, position):
+        return jsonify({'status': 'error', 'message': 'Không tìm thấy bài trong hàng đợi'}), 404
+    return jsonify({'status': 'success', 'queue': store.queue.summary()})
+
 @app.route('/set_color', methods=['POST'])
 def set_static_color():
-    global active_thread, is_syncing, current_ip, last_error, current_sync_mode
     data = request.json
-    req_ip = data.get('ip', '').strip()
+    req_ip, groups = request_destinations(data)
     if not req_ip:
         return jsonify({'status': 'error', 'message': 'IP trống'}), 400
-    if is_syncing:
-        return jsonify({'status': 'error', 'message': 'Hệ thống đang bận, vui lòng Dừng trước'}), 400
+    if not groups:
+        return jsonify({'status': 'error', 'message': 'IP hoặc group multicast không hợp lệ'}), 400
     try:
         r = int(data.get('r', 0)); g = int(data.get('g', 0)); b = int(data.get('b', 0))
     except ValueError:
         return jsonify({'status': 'error', 'message': 'Màu không hợp lệ'}), 400
-    stop_sending_internal(); time.sleep(0.1)
-    current_ip = req_ip
-    logger.info(f"Yêu cầu START STATIC COLOR {r},{g},{b} IP {current_ip}");
-    is_syncing = True; last_error = ""; current_sync_mode = 'static'
-    active_thread = threading.Thread(target=start_static_color_thread, args=(r, g, b, current_ip,), name="StaticColorThread");
-    active_thread.daemon = True; active_thread.start()
+    if not all(0 <= c <= 255 for c in (r, g, b)):
+        return jsonify({'status': 'error', 'message': 'Màu không hợp lệ'}), 400
+    logger.info(f"Yêu cầu START STATIC COLOR {r},{g},{b} IP {req_ip}");
+    error = submit_program(StaticProgram(r, g, b), req_ip, groups)
+    if error: return error
     return jsonify({'status': 'success', 'message': f"Bắt đầu màu tĩnh: {r},{g},{b}"})
 
 @app.route('/start_effect', methods=['POST'])
 def start_effect_sync():
-    global active_thread, is_syncing, current_ip, last_error, current_sync_mode
     data = request.json
-    req_ip = data.get('ip', '').strip()
+    req_ip, groups = request_destinations(data)
     effect_name = data.get('effect_name')
     if not req_ip: return jsonify({'status': 'error', 'message': 'IP trống'}), 400
-    if effect_name not in ['blink']: 
+    if not groups: return jsonify({'status': 'error', 'message': 'IP hoặc group multicast không hợp lệ'}), 400
+    if effect_name not in EFFECT_PROGRAMS: 
         return jsonify({'status': 'error', 'message': 'Hiệu ứng không hợp lệ'}), 400
-    if is_syncing:
-        return jsonify({'status': 'error', 'message': 'Hệ thống đang bận, vui lòng Dừng trước'}), 400
-    stop_sending_internal(); time.sleep(0.1)
-    current_ip = req_ip
-    logger.info(f"Yêu cầu START EFFECT {effect_name} IP {current_ip}");
-    is_syncing = True; last_error = ""; current_sync_mode = effect_name
-    active_thread = threading.Thread(target=start_preset_effect_thread, args=(effect_name, current_ip,), name="PresetEffectThread");
-    active_thread.daemon = True; active_thread.start()
+    logger.info(f"Yêu cầu START EFFECT {effect_name} IP {req_ip}");
+    error = submit_program(EFFECT_PROGRAMS[effect_name](), req_ip, groups)
+    if error: return error
     return jsonify({'status': 'success', 'message': f"Bắt đầu hiệu ứng: {effect_name}"})
 
+@app.route('/start_live', methods=['POST'])
+def start_live_sync():
+    # source 'device': card âm thanh (sounddevice); 'file': phát lại một WAV đã upload theo tốc độ thật (để thử)
+    data = request.json
+    req_ip, groups = request_destinations(data)
+    if not req_ip: return jsonify({'status': 'error', 'message': 'IP trống'}), 400
+    if not groups: return jsonify({'status': 'error', 'message': 'IP hoặc group multicast không hợp lệ'}), 400
+    try: budget_ms = float(data.get('budget_ms', LIVE_LATENCY_BUDGET_MS))
+    except (TypeError, ValueError): return jsonify({'status': 'error', 'message': 'budget_ms không hợp lệ'}), 400
+    try:
+        if data.get('source') == 'file':
+            filename = secure_filename(data.get('filename', ''))
+            if not filename.lower().endswith('.wav'): return jsonify({'status': 'error', 'message': 'Chỉ hỗ trợ file WAV'}), 400
+            source = PcmStreamSource(open(os.path.join(app.config['UPLOAD_FOLDER'], filename), 'rb'), realtime=True)
+        else: source = DeviceSource(data.get('device'), int(data.get('sample_rate', LIVE_SAMPLE_RATE)))
+    except (OSError, ValueError, RuntimeError) as e:
+        logger.error(f"Không mở được nguồn âm thanh live: {e}")
+        return jsonify({'status': 'error', 'message': f"Không mở được nguồn âm thanh: {e}"}), 400
+    logger.info(f"Yêu cầu START LIVE IP {req_ip} nguồn {source.describe()}");
+    # Bị từ chối hay bị huỷ thì LiveProgram.end() đã đóng nguồn
+    error = submit_program(LiveProgram(source, budget_ms), req_ip, groups)
+    if error: return error
+    return jsonify({'status': 'success', 'message': f"Bắt đầu live: {source.describe()}"})
+
+def playback_control(action, position_required):
+    data = request.get_json(silent=True) or {}
+    position = data.get('position')
+    if position is None and position_required:
+        return jsonify({'status': 'error', 'message': 'Thiếu vị trí (giây)'}), 400
+    try: args = () if position is None else (float(position),)
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'Vị trí không hợp lệ'}), 400
+    try: progress = sender.control(action, *args)
+    except SenderBusy as e:
+        return jsonify({'status': 'error', 'message': f"{e}, thử lại"}), 503
+    if progress is None:
+        return jsonify({'status': 'error', 'message': 'Không ở chế độ beat'}), 409
+    publish_mode()
+    return jsonify({'status': 'success', **progress})
+
+@app.route('/seek', methods=['POST'])
+def seek_playback():
+    return playback_control('seek', True)
+
+@app.route('/pause', methods=['POST'])
+def pause_playback():
+    return playback_control('pause', False)
+
+@app.route('/resume', methods=['POST'])
+def resume_playback():
+    return playback_control('resume', False)
+
+@app.route('/position', methods=['POST'])
+def report_playback_position():
+    # Trình phát nhạc báo currentTime định kỳ để bù trôi giữa đèn và nhạc
+    return playback_control('report_position', True)
+
 @app.route('/stop', methods=['POST'])
 def stop_sending():
-    stop_sending_internal()
     logger.info("Yêu cầu DỪNG TỪ CLIENT.")
+    try: sender.stop()
+    except SenderBusy as e: return jsonify({'status': 'error', 'message': f"{e}, thử lại"}), 503
+    publish_mode()
     return jsonify({'status': 'success', 'message': 'Đã dừng đồng bộ.'})
 
 def shutdown_server():
-    logger.info("Server đang tắt..."); stop_sending_internal()
+    logger.info("Server đang tắt..."); status_sampler.stop(); clock_sync.stop(); sender.shutdown(); analysis_jobs.shutdown()
     logger.info("Đã dừng các tác vụ.")
 if __name__ == '__main__':
     logger.info("Khởi động Web Server...")